@@ -0,0 +1,360 @@
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# benchmark.py
+# --basepath <Base directory of event, metric and other files - default '..' >
+# --model <Shortname of the model benchmarked - default SPR>
+# --repeat <Number of times each benchmark is run - default 5>
+# <benchmark> <Name of the benchmark to run - default all>
+#
+# ASSUMES: That the script is being run in the scripts folder of the repo.
+# OUTPUT: The best time of each variant of each benchmark.
+#
+# EXAMPLE: python benchmark.py metric-table
+import argparse
+import ast
+import create_perf_json
+import glob
+import json
+import math
+import metric
+import os
+import random
+import re
+import tempfile
+import timeit
+from typing import Callable, Dict
+import urllib.request
+
+
+def _find_model(basepath: str, shortname: str) -> create_perf_json.Model:
+    for model in create_perf_json.Mapfile(basepath).archs:
+        if model.shortname == shortname:
+            return model
+    raise ValueError(f'Unknown model {shortname}')
+
+
+def _report(name: str, variants: Dict[str, Callable[[], None]], repeat: int):
+    """Time each variant of a benchmark reporting the best run."""
+    times = {}
+    for (variant, fn) in variants.items():
+        times[variant] = min(timeit.repeat(fn, number=1, repeat=repeat))
+    baseline = next(iter(times.values()))
+    for (variant, t) in times.items():
+        print(f'{name}: {variant}: {t * 1000:.3f}ms ({baseline / t:.1f}x)')
+
+
+def bench_metric_table(model: create_perf_json.Model, repeat: int):
+    """
+    Adding the TMA metrics and then the extra metrics, with every
+    metric added twice to exercise replacing duplicates, using a linear
+    scan of a list compared with the name indexed table used by
+    extract_tma_metrics.
+    """
+    sheet = create_perf_json._load_tma_sheet(model.files['tma metrics'])
+    names = [f'tma_{row.parents[-1].lower()}' for row in sheet.rows if row.level]
+    names += [f'tma_{row.key.lower().replace(".", "_")}_{sheet.field(row, "Level1").lower()}'
+              for row in sheet.rows if row.key.startswith('Info')]
+    if 'extra metrics' in model.files:
+        with urllib.request.urlopen(model.files['extra metrics']) as extra_json:
+            names += [em['MetricName'] for em in json.load(extra_json)]
+    names += names
+
+    def linear():
+        jo = []
+        for name in names:
+            dups = [m for m in jo if m['MetricName'] == name]
+            if dups:
+                jo.remove(dups[0])
+            jo.append({'MetricName': name})
+
+    def indexed():
+        jo = {}
+        for name in names:
+            if name in jo:
+                jo.pop(name)
+            jo[name] = {'MetricName': name}
+
+    _report(f'metric-table {model.shortname} ({len(names)} additions)',
+            {'linear': linear, 'indexed': indexed}, repeat)
+
+
+class _RewriteIfExpToSelect(ast.NodeTransformer):
+    """Transformer to convert if-else nodes to Select expressions."""
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        call = ast.Call(
+            func=ast.Name(id='Select', ctx=ast.Load()),
+            args=[node.body, node.test, node.orelse],
+            keywords=[])
+        ast.copy_location(call, node.test)
+        return call
+
+
+def _python_parse_perf_json(orig: str) -> metric.Expression:
+    """
+    The previous metric.ParsePerfJson that rewrote the expression
+    into python with regular expressions and then evaluated it.
+    """
+    py = orig.strip()
+    py = re.sub(r'([a-zA-Z][^-+/\* \\\(\),]*(?:\\.[^-+/\* \\\(\),]*)*)',
+                r'Event(r"\1")', py)
+    py = re.sub(r'#Event\(r"([^"]*)"\)', r'Literal("#\1")', py)
+    py = re.sub(r'([0-9]+)Event\(r"(e[0-9]+)"\)', r'\1\2', py)
+    py = py.replace('#( ', '(')
+    keywords = ['if', 'else', 'min', 'max', 'd_ratio', 'source_count', 'has_event']
+    for kw in keywords:
+        py = re.sub(rf'Event\(r"{kw}"\)', kw, py)
+    parsed = ast.parse(py, mode='eval')
+    _RewriteIfExpToSelect().visit(parsed)
+    parsed = ast.fix_missing_locations(parsed)
+    return metric._Constify(eval(compile(parsed, orig, 'eval'), vars(metric)))
+
+
+class _MadeUpValues(dict):
+    """Counts or literal values made up from a seed and each name."""
+
+    def __init__(self, seed: int):
+        super().__init__()
+        self.seed = seed
+
+    def __missing__(self, name: str) -> float:
+        return random.Random(f'{self.seed}:{name}').uniform(1, 1000)
+
+
+def _same_values(lhs: metric.Expression, rhs: metric.Expression) -> bool:
+    """Do the expressions evaluate to close values on made up counts?"""
+    lhs_fn, rhs_fn = lhs.Compile(), rhs.Compile()
+    for seed in range(3):
+        values = _MadeUpValues(seed)
+        x, y = lhs_fn(values, values), rhs_fn(values, values)
+        if not (math.isclose(x, y, rel_tol=1e-9) or (math.isnan(x) and math.isnan(y))):
+            return False
+    return True
+
+
+def bench_parse(model: create_perf_json.Model, repeat: int):
+    """
+    Parsing the expressions and thresholds of a model's extra metrics
+    with metric.ParsePerfJson, with and without its cache, compared with
+    the previous python eval based parser. The parsers fold constants
+    differently, so their expressions are checked to evaluate the same.
+    """
+    with urllib.request.urlopen(model.files['extra metrics']) as extra_json:
+        forms = [em[key] for em in json.load(extra_json)
+                 for key in ['MetricExpr', 'MetricThreshold'] if key in em]
+    for form in forms:
+        assert _same_values(metric.ParsePerfJson(form), _python_parse_perf_json(form)), form
+
+    def python_eval():
+        for form in forms:
+            _python_parse_perf_json(form)
+
+    def parser():
+        metric.ClearParseCache()
+        for form in forms:
+            metric.ParsePerfJson(form)
+
+    def cached_parser():
+        for form in forms:
+            metric.ParsePerfJson(form)
+
+    _report(f'parse {model.shortname} ({len(forms)} expressions)',
+            {'python eval': python_eval, 'parser': parser,
+             'cached parser': cached_parser}, repeat)
+
+
+def _walk(e: metric.Expression, counts: Dict[str, float],
+          literals: Dict[str, float]) -> float:
+    """Evaluate an expression by walking its tree, as Compile avoids."""
+    if isinstance(e, metric.Event):
+        return counts[e.ToPerfJson()]
+    if isinstance(e, metric.Constant):
+        return float(e.value)
+    if isinstance(e, metric.Literal):
+        return literals[e.value]
+    if isinstance(e, metric.Select):
+        if _walk(e.cond, counts, literals):
+            return _walk(e.true_val, counts, literals)
+        return _walk(e.false_val, counts, literals)
+    if isinstance(e, metric.Function):
+        if e.fn == 'has_event':
+            return 1.0 if e.lhs.ToPerfJson() in counts else 0.0
+        if e.fn == 'source_count':
+            return 1.0
+        lhs = _walk(e.lhs, counts, literals)
+        rhs = _walk(e.rhs, counts, literals)
+        if e.fn == 'd_ratio':
+            return lhs / rhs if rhs else 0.0
+        if e.fn == 'min':
+            return lhs if lhs < rhs else rhs
+        return lhs if lhs > rhs else rhs
+    lhs = _walk(e.lhs, counts, literals)
+    rhs = _walk(e.rhs, counts, literals)
+    if e.operator == '/':
+        return lhs / rhs if rhs else math.nan
+    if e.operator == '%':
+        return float(int(lhs) % int(rhs)) if rhs else math.nan
+    if e.operator in ('|', '&', '^'):
+        lhs, rhs = bool(lhs), bool(rhs)
+    return float({'|': lambda: lhs or rhs, '&': lambda: lhs and rhs,
+                  '^': lambda: lhs != rhs, '<': lambda: lhs < rhs,
+                  '>': lambda: lhs > rhs, '+': lambda: lhs + rhs,
+                  '-': lambda: lhs - rhs, '*': lambda: lhs * rhs}[e.operator]())
+
+
+def bench_evaluate(model: create_perf_json.Model, repeat: int):
+    """
+    Evaluating the extra metrics' expressions 100 times, as for 100
+    intervals of counts, walking the expression trees compared with
+    the functions from Expression.Compile.
+    """
+    with urllib.request.urlopen(model.files['extra metrics']) as extra_json:
+        exprs = [metric.ParsePerfJson(em['MetricExpr'])
+                 for em in json.load(extra_json)]
+    counts = {}
+    for e in exprs:
+        for leaf in e.Leaves():
+            if isinstance(leaf, metric.Event):
+                counts[leaf.ToPerfJson()] = float(len(counts) + 1)
+    literals = {'#SMT_on': 1.0, '#core_wide': 1.0, '#num_dies': 2.0,
+                '#num_packages': 2.0, '#num_cores': 2.0, '#has_pmem': 0.0,
+                '#SYSTEM_TSC_FREQ': 2e9}
+    compiled = [e.Compile() for e in exprs]
+    for (e, fn) in zip(exprs, compiled):
+        expected = _walk(e, counts, literals)
+        assert fn(counts, literals) == expected or math.isnan(expected), e
+
+    def walk():
+        for _ in range(100):
+            for e in exprs:
+                _walk(e, counts, literals)
+
+    def compiled_fns():
+        for _ in range(100):
+            for fn in compiled:
+                fn(counts, literals)
+
+    _report(f'evaluate {model.shortname} ({len(exprs)} expressions)',
+            {'tree walk': walk, 'compiled': compiled_fns}, repeat)
+
+
+def bench_batch(model: create_perf_json.Model, repeat: int):
+    """
+    Evaluating the extra metrics over 10000 rows of counts with a
+    metric.BatchEvaluator, row by row compared with NumPy when it is
+    installed.
+    """
+    with urllib.request.urlopen(model.files['extra metrics']) as extra_json:
+        metrics = {em['MetricName']: metric.ParsePerfJson(em['MetricExpr'])
+                   for em in json.load(extra_json)}
+    events = sorted({leaf.ToPerfJson() for e in metrics.values()
+                     for leaf in e.Leaves() if isinstance(leaf, metric.Event)})
+    columns = {name: [float((row * 7 + i) % 1000) for row in range(10000)]
+               for (i, name) in enumerate(events)}
+    literals = {'#SMT_on': 1.0, '#core_wide': 1.0, '#num_dies': 2.0,
+                '#num_packages': 2.0, '#num_cores': 2.0, '#has_pmem': 0.0,
+                '#SYSTEM_TSC_FREQ': 2e9}
+    variants = {'rows': metric.BatchEvaluator(metrics, use_numpy=False)}
+    if metric.numpy is not None:
+        variants['numpy'] = metric.BatchEvaluator(metrics, use_numpy=True)
+    _report(f'batch {model.shortname} ({len(metrics)} metrics)',
+            {name: (lambda e=e: e.Evaluate(columns, literals))
+             for (name, e) in variants.items()}, repeat)
+
+
+def _expand(e: metric.Expression, metrics: Dict[str, metric.Expression]
+            ) -> metric.Expression:
+    """Replace references to metrics with their expanded expressions."""
+    if isinstance(e, metric.Event):
+        if e.name.lower() in metrics:
+            return _expand(metrics[e.name.lower()], metrics)
+        return e
+    if isinstance(e, metric.Operator):
+        return metric.Operator(e.operator, _expand(e.lhs, metrics),
+                               _expand(e.rhs, metrics))
+    if isinstance(e, metric.Select):
+        return metric.Select(_expand(e.true_val, metrics),
+                             _expand(e.cond, metrics),
+                             _expand(e.false_val, metrics))
+    if isinstance(e, metric.Function) and e.rhs:
+        return metric.Function(e.fn, _expand(e.lhs, metrics),
+                               _expand(e.rhs, metrics))
+    return e
+
+
+def bench_dag(model: create_perf_json.Model, repeat: int):
+    """
+    Evaluating every metric of the model's generated perf json 100
+    times, as for 100 intervals, with each metric expanded and compiled
+    on its own compared with a metric.MetricDag sharing metric
+    references and duplicate subtrees.
+    """
+    with tempfile.TemporaryDirectory() as outdir:
+        model.to_perf_json(outdir)
+        [metrics_json] = glob.glob(os.path.join(outdir, '*metrics.json'))
+        with open(metrics_json, 'r') as f:
+            json_metrics = json.load(f)
+    metrics = {m['MetricName'].lower(): metric.ParsePerfJson(m['MetricExpr'])
+               for m in json_metrics}
+    expanded = {name: _expand(e, metrics) for (name, e) in metrics.items()}
+    counts = {}
+    for e in expanded.values():
+        for leaf in e.Leaves():
+            if isinstance(leaf, metric.Event):
+                counts[leaf.ToPerfJson()] = float(len(counts) + 1)
+    literals = {'#SMT_on': 1.0, '#core_wide': 1.0, '#num_dies': 2.0,
+                '#num_packages': 2.0, '#num_cores': 2.0, '#has_pmem': 0.0,
+                '#SYSTEM_TSC_FREQ': 2e9}
+    compiled = {name: e.Compile() for (name, e) in expanded.items()}
+    dag = metric.MetricDag.FromPerfJson(json_metrics)
+    values = dag.Evaluate(counts, literals)
+    for (name, fn) in compiled.items():
+        expected = fn(counts, literals)
+        actual = values[name] if name in values else next(
+            v for (n, v) in values.items() if n.lower() == name)
+        assert actual == expected or math.isnan(expected), name
+
+    def each_metric():
+        for _ in range(100):
+            for fn in compiled.values():
+                fn(counts, literals)
+
+    def dag_evaluate():
+        for _ in range(100):
+            dag.Evaluate(counts, literals)
+
+    _report(f'dag {model.shortname} ({len(metrics)} metrics, {dag.Nodes()} nodes)',
+            {'each metric': each_metric, 'dag': dag_evaluate}, repeat)
+
+
+_benchmarks: Dict[str, Callable[[create_perf_json.Model, int], None]] = {
+    'metric-table': bench_metric_table,
+    'parse': bench_parse,
+    'evaluate': bench_evaluate,
+    'batch': bench_batch,
+    'dag': bench_dag,
+}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--basepath', default=f'file://{os.getcwd()}/..',
+                    help='Base directory containing event, metric and other files.')
+    ap.add_argument('--model', default='SPR',
+                    help='Shortname of the model to benchmark.')
+    ap.add_argument('--repeat', type=int, default=5,
+                    help='Number of times each benchmark is run.')
+    ap.add_argument('benchmark', nargs='?', default='all',
+                    choices=['all'] + list(_benchmarks.keys()),
+                    help='Benchmark to run.')
+    args = ap.parse_args()
+
+    model = _find_model(args.basepath, args.model)
+    for (name, bench) in _benchmarks.items():
+        if args.benchmark in ['all', name]:
+            bench(model, args.repeat)
+
+if __name__ == '__main__':
+    main()
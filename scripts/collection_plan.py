@@ -0,0 +1,231 @@
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# collection_plan.py
+# --metrics-json <Perf metrics json written by create_perf_json.py, like perf/skylake/skl-metrics.json>
+# --events-json <Perfmon core events json of the model, like SKL/events/skylake_core.json>
+# --metrics <Comma separated metric or metric group names, or metric name patterns,
+#            like TopdownL1,tma_L2_group,tma_info_memory_*>
+# --pmu <Core PMU of the metrics and events - default cpu>
+# --smt <on or off - default on>
+# --nmi-watchdog <on or off - default on>
+# --system-wide <Plan for perf stat -a, counting all of a core's threads>
+#
+# OUTPUT: A perf stat command line opening each event the metrics need
+#         once, with the events packed into as few groups as the core
+#         PMU's counters allow. Each group is followed by a comment
+#         naming the metrics computed from it.
+#
+# EXAMPLE: python collection_plan.py --metrics-json perf/skylake/skl-metrics.json \
+#            --events-json SKL/events/skylake_core.json --metrics TopdownL1
+import argparse
+from dataclasses import dataclass
+import event_groups
+import json
+import metric
+from perf_stat_metrics import select_metrics
+from script_args import on_off
+import sys
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+# The key of an event, with spellings of the same event sharing a key.
+EventKey = Tuple[str, str, Tuple[str, ...]]
+
+
+def event_key(spec: str, pmu: str) -> EventKey:
+    """
+    The PMU, upper case name and config of an event as written in a
+    metric. Events differing only in case, escaping, '@' or '/'
+    separators, an implied core PMU, the order of modifiers or in the
+    precise modifiers that don't change counts, share a key.
+    """
+    event_pmu, name, config = event_groups.parse_event(spec)
+    terms = []
+    for term in config:
+        if '=' in term:
+            terms.append(term.lower())
+            continue
+        modifiers = ''.join(sorted(set(term) - set('pP')))
+        if modifiers:
+            terms.append(modifiers)
+    return (event_pmu or pmu, name.upper(), tuple(sorted(terms)))
+
+
+def perf_event(spec: str, pmu: str) -> str:
+    """
+    An event as written in a metric, as written for perf stat -e. On
+    hybrid systems, events without a PMU are given the core PMU's name.
+    """
+    spec = spec.replace('\\', '').replace('@', '/')
+    if pmu != 'cpu' and event_groups.parse_event(spec)[0] is None:
+        name, _, modifiers = spec.partition(':')
+        spec = f'{pmu}/{name}/{modifiers}'
+    return spec
+
+
+@dataclass
+class CollectionPlan:
+    """The events to count and the metrics computed from them."""
+    # Groups of events counted together.
+    groups: List[List[str]]
+    # Events counted outside of a group, either not on the core PMU or
+    # from metrics whose events can never be counted together.
+    ungrouped: List[str]
+    # The metrics computed from each group.
+    group_metrics: List[List[str]]
+    # Metrics computed from ungrouped events.
+    ungrouped_metrics: List[str]
+
+    def command_line(self, system_wide: bool = False, output: Optional[str] = None) -> str:
+        """perf stat counting the events, writing JSON to output if given."""
+        events = [f'{{{",".join(group)}}}' for group in self.groups] + self.ungrouped
+        options = ['-a'] if system_wide else []
+        if output:
+            options += ['-j', '-o', output]
+        return f"perf stat {''.join(o + ' ' for o in options)}-e '{','.join(events)}'"
+
+
+@dataclass
+class EventNeeds:
+    """The events of metrics by how they are counted."""
+    # The first spelling in a metric of each event.
+    spellings: Dict[EventKey, str]
+    # The counters of the events counted by the core PMU's counters.
+    counters: Dict[EventKey, event_groups.EventCounters]
+    # The core PMU events, topdown events and other events of each metric.
+    metrics: Dict[str, Tuple[Set[EventKey], Set[EventKey], Set[EventKey]]]
+
+
+def event_needs(core_pmu: event_groups.CorePmu,
+                metric_events: Dict[str, Sequence[str]]) -> EventNeeds:
+    """Key the events of each metric and find the counters they need."""
+    needs = EventNeeds({}, {}, {})
+    for (name, specs) in metric_events.items():
+        needs.metrics[name] = (set(), set(), set())
+        for spec in specs:
+            key = event_key(spec, core_pmu.name)
+            needs.spellings.setdefault(key, perf_event(spec, core_pmu.name))
+            event = core_pmu.event_counters(spec)
+            if event:
+                needs.counters[key] = event[1]
+                needs.metrics[name][0].add(key)
+            elif event_groups.is_topdown(spec) and key[0] == core_pmu.name:
+                needs.metrics[name][1].add(key)
+            else:
+                needs.metrics[name][2].add(key)
+    return needs
+
+
+def plan_collection(core_pmu: event_groups.CorePmu,
+                    metric_events: Dict[str, Sequence[str]],
+                    smt_on: bool = True,
+                    nmi_watchdog: bool = True) -> CollectionPlan:
+    """
+    Plan counting the events of each metric, including those of metrics
+    it references, so that each metric's events are counted in one group
+    when its events can fit, in as few groups as possible. An event is
+    opened once in each group whose metrics need it, and once outside of
+    the groups when no group holds it.
+    """
+    found = event_needs(core_pmu, metric_events)
+    spellings = found.spellings
+    counters = found.counters
+    needs = found.metrics
+
+    def fits(keys: Set[EventKey]) -> bool:
+        # Topdown events need no counter.
+        return event_groups.schedulable(core_pmu, [counters[k] for k in keys if k in counters],
+                                        smt_on, nmi_watchdog)
+
+    groups: List[Set[EventKey]] = []
+    group_metrics: List[List[str]] = []
+    ungrouped: Dict[EventKey, None] = {}
+    ungrouped_metrics = []
+    # Place the metrics with the most events first, then add smaller
+    # metrics to the group they grow least.
+    for name in sorted(needs, key=lambda n: (-len(needs[n][0]), n)):
+        core, free, other = needs[name]
+        for key in sorted(other):
+            ungrouped[key] = None
+        if not core and not free:
+            ungrouped_metrics.append(name)
+            continue
+        if not fits(core):
+            for key in sorted(core | free):
+                ungrouped[key] = None
+            ungrouped_metrics.append(name)
+            continue
+        best: Optional[int] = None
+        for (i, group) in enumerate(groups):
+            if (best is None or len(core - group) < len(core - groups[best])) and \
+               fits(group | core):
+                best = i
+        if best is None:
+            groups.append(set())
+            group_metrics.append([])
+            best = len(groups) - 1
+        groups[best].update(core | free)
+        group_metrics[best].append(name)
+
+    grouped = set().union(*groups)
+    return CollectionPlan(
+        groups=[[spellings[k] for k in sorted(group)] for group in groups],
+        ungrouped=[spellings[k] for k in ungrouped if k not in grouped],
+        group_metrics=[sorted(names) for names in group_metrics],
+        ungrouped_metrics=sorted(ungrouped_metrics))
+
+
+def metric_events(json_metrics: List[Dict[str, str]], names: Sequence[str],
+                  literals: Dict[str, float]) -> Dict[str, List[str]]:
+    """
+    The events of the named metrics, including those of metrics they
+    reference, without those of if-else branches literals exclude.
+    """
+    parsed = {m['MetricName']: metric.ParsePerfJson(m['MetricExpr'])
+              for m in json_metrics}
+    closures = metric.MetricClosures(parsed, literals)
+    return {name: sorted(e.ToPerfJson() for e in closures[name][0]
+                         if isinstance(e, metric.Event))
+            for name in names}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--metrics-json', required=True,
+                    help='Perf metrics json written by create_perf_json.py.')
+    ap.add_argument('--events-json', required=True,
+                    help='Perfmon core events json of the model.')
+    ap.add_argument('--metrics', required=True,
+                    help='Comma separated metric or metric group names, or metric name '
+                    'patterns like tma_*.')
+    ap.add_argument('--pmu', default='cpu',
+                    help='Core PMU of the metrics and events, like cpu_core.')
+    ap.add_argument('--smt', type=on_off, default=True,
+                    help='Whether SMT is on or off.')
+    ap.add_argument('--nmi-watchdog', type=on_off, default=True,
+                    help='Whether the NMI watchdog holds a counter.')
+    ap.add_argument('--system-wide', action='store_true',
+                    help='Plan for perf stat -a, counting all of a core\'s threads.')
+    args = ap.parse_args()
+
+    with open(args.metrics_json, 'r') as f:
+        json_metrics = [m for m in json.load(f) if m.get('Unit', 'cpu') == args.pmu]
+    with open(args.events_json, 'r') as f:
+        core_pmu = event_groups.CorePmu.from_json(args.pmu, json.load(f)['Events'])
+    try:
+        names = select_metrics(json_metrics, args.metrics.split(','))
+        # perf's #core_wide is only true when counting system wide.
+        literals = {'#SMT_on': 1 if args.smt else 0,
+                    '#core_wide': 1 if args.system_wide else 0}
+        events = metric_events(json_metrics, names, literals)
+    except ValueError as e:
+        sys.exit(str(e))
+    plan = plan_collection(core_pmu, events, args.smt, args.nmi_watchdog)
+    print(plan.command_line(args.system_wide))
+    for (i, group) in enumerate(plan.groups):
+        print(f'# {{{",".join(group)}}}: {", ".join(plan.group_metrics[i])}')
+    if plan.ungrouped_metrics:
+        print(f'# Ungrouped: {", ".join(plan.ungrouped_metrics)}')
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@
 # --outdir <Output directory where files are written - default perf>
 # --basepath <Base directory of event, metric and other files - default '..' >
 # --verbose/-v/-vv/-vvv <Print verbosity during generation>
+# --jobs/-j <Number of models to generate in parallel - default 1>
+# --manifest <Build manifest used to skip models whose inputs are unchanged - default none>
 #
 # ASSUMES: That the script is being run in the scripts folder of the repo.
 # OUTPUT: A perf json directory suitable for the tools/perf folder.
@@ -12,13 +14,21 @@
 # EXAMPLE: python create_perf_json.py
 import argparse
 import collections
+import concurrent.futures
+import contextlib
 from dataclasses import dataclass
 import csv
+import event_groups
+import functools
+import hashlib
+import io
 from itertools import takewhile
 import json
 import metric
 import os
 import re
+import sys
+import traceback
 from typing import DefaultDict, Dict, Optional, Set, TextIO, Tuple
 import urllib.request
 
@@ -155,12 +165,67 @@ _topics: Dict[str, Set[tuple[str, int]]] = {
         (r'TLB_FLUSH.*', 1),
     }
 }
-# Sort the matches with the highest priority first to allow the loop
-# to exit early when a lower priority match to the current is found.
+# Sort the matches with the highest priority first.
 for topic in _topics.keys():
     _topics[topic] = sorted(_topics[topic],
                             key=lambda match: (-match[1], match[0]))
 
+# A single regular expression matching an event name against every
+# topic. Alternatives are ordered by descending priority and, for
+# equal priorities, reverse topic name so that the first alternative
+# to match is the highest priority topic. Each alternative is a named
+# group whose name maps back to the topic.
+_topic_matches = sorted(((regexp, priority, topic)
+                         for (topic, matches) in _topics.items()
+                         for (regexp, priority) in matches),
+                        key=lambda match: match[2], reverse=True)
+_topic_matches.sort(key=lambda match: -match[1])
+_topic_groups: Dict[str, str] = {}
+_topic_alternatives: list[str] = []
+for (regexp, priority, topic) in _topic_matches:
+    group = f't{len(_topic_alternatives)}'
+    _topic_groups[group] = topic
+    _topic_alternatives.append(f'(?P<{group}>{regexp})')
+_topic_regex = re.compile('|'.join(_topic_alternatives))
+
+# Map from an uncore PMU (lower case) to its topic.
+_unit_to_topic = {
+    'cha': 'Uncore-Cache',
+    'cbox': 'Uncore-Cache',
+    'ha': 'Uncore-Cache',
+    'hac_cbo': 'Uncore-Cache',
+    'cxlcm': 'Uncore-CXL',
+    'cxldp': 'Uncore-CXL',
+    'arb': 'Uncore-Interconnect',
+    'hac_arb': 'Uncore-Interconnect',
+    'irp': 'Uncore-Interconnect',
+    'm2m': 'Uncore-Interconnect',
+    'mdf': 'Uncore-Interconnect',
+    'r3qpi': 'Uncore-Interconnect',
+    'qpi': 'Uncore-Interconnect',
+    'sbox': 'Uncore-Interconnect',
+    'ubox': 'Uncore-Interconnect',
+    'upi': 'Uncore-Interconnect',
+    'm3upi': 'Uncore-Interconnect',
+    'iio': 'Uncore-IO',
+    'iio_free_running': 'Uncore-IO',
+    'm2pcie': 'Uncore-IO',
+    'r2pcie': 'Uncore-IO',
+    'edc_eclk': 'Uncore-Memory',
+    'edc_uclk': 'Uncore-Memory',
+    'imc': 'Uncore-Memory',
+    'imc_free_running': 'Uncore-Memory',
+    'imc_free_running_0': 'Uncore-Memory',
+    'imc_free_running_1': 'Uncore-Memory',
+    'imc_dclk': 'Uncore-Memory',
+    'imc_uclk': 'Uncore-Memory',
+    'm2hbm': 'Uncore-Memory',
+    'mchbm': 'Uncore-Memory',
+    'clock': 'Uncore-Other',
+    'pcu': 'Uncore-Power',
+}
+
+@functools.lru_cache(maxsize=None)
 def topic(event_name: str, unit: str) -> str:
     """
     Map an event name to its associated topic.
@@ -169,56 +234,12 @@ def topic(event_name: str, unit: str) -> str:
     @param unit: The PMU responsible for the event or None for CPU events.
     """
     if unit and unit not in ['cpu', 'cpu_atom', 'cpu_core']:
-        unit_to_topic = {
-            'cha': 'Uncore-Cache',
-            'cbox': 'Uncore-Cache',
-            'ha': 'Uncore-Cache',
-            'hac_cbo': 'Uncore-Cache',
-            'cxlcm': 'Uncore-CXL',
-            'cxldp': 'Uncore-CXL',
-            'arb': 'Uncore-Interconnect',
-            'hac_arb': 'Uncore-Interconnect',
-            'irp': 'Uncore-Interconnect',
-            'm2m': 'Uncore-Interconnect',
-            'mdf': 'Uncore-Interconnect',
-            'r3qpi': 'Uncore-Interconnect',
-            'qpi': 'Uncore-Interconnect',
-            'sbox': 'Uncore-Interconnect',
-            'ubox': 'Uncore-Interconnect',
-            'upi': 'Uncore-Interconnect',
-            'm3upi': 'Uncore-Interconnect',
-            'iio': 'Uncore-IO',
-            'iio_free_running': 'Uncore-IO',
-            'm2pcie': 'Uncore-IO',
-            'r2pcie': 'Uncore-IO',
-            'edc_eclk': 'Uncore-Memory',
-            'edc_uclk': 'Uncore-Memory',
-            'imc': 'Uncore-Memory',
-            'imc_free_running': 'Uncore-Memory',
-            'imc_free_running_0': 'Uncore-Memory',
-            'imc_free_running_1': 'Uncore-Memory',
-            'imc_dclk': 'Uncore-Memory',
-            'imc_uclk': 'Uncore-Memory',
-            'm2hbm': 'Uncore-Memory',
-            'mchbm': 'Uncore-Memory',
-            'clock': 'Uncore-Other',
-            'pcu': 'Uncore-Power',
-        }
-        if unit.lower() not in  unit_to_topic:
+        if unit.lower() not in  _unit_to_topic:
             raise ValueError(f'Unexpected PMU (aka Unit): {unit}')
-        return unit_to_topic[unit.lower()]
-
-    result = None
-    result_priority = -1
-    for topic in sorted(_topics.keys()):
-        for regexp, priority in _topics[topic]:
-            if re.match(regexp, event_name) and priority >= result_priority:
-                result = topic
-                result_priority = priority
-            if priority < result_priority:
-                break
+        return _unit_to_topic[unit.lower()]
 
-    return result if result else 'Other'
+    m = _topic_regex.match(event_name)
+    return _topic_groups[m.lastgroup] if m else 'Other'
 
 def freerunning_counter_type_and_index(shortname: str,
                                        pmu: str,
@@ -454,6 +475,109 @@ class PerfmonJsonEvent:
         add_to_result('Unit', self.unit)
         return result
 
+@dataclass(frozen=True)
+class TmaRow:
+    """A row of the TMA metrics spreadsheet."""
+    # The first column such as 'BE/Mem', 'Info.Thread' or 'Aux'.
+    key: str
+    # The whitespace stripped value of every column.
+    cells: Tuple[str, ...]
+    # For topdown rows, the level of the metric, 1 for Level1.
+    level: Optional[int] = None
+    # For topdown rows, the metric names from Level1 down to this row's metric.
+    parents: Tuple[str, ...] = ()
+
+
+class TmaSheet:
+    """
+    A TMA metrics spreadsheet like TMA_Metrics-full.csv. The sheet is
+    the same for every model, so it is parsed once and shared with each
+    model reading the formulas from its CPU's column.
+    """
+
+    def __init__(self, csvfile: TextIO):
+        """
+        Parses the rows following the 'Key' heading row.
+
+        @param csvfile: the spreadsheet in CSV form as text.
+        """
+        # Map from the column heading to the index of that column.
+        self.col_heading: Dict[str, int] = {}
+        # A list of topdown levels such as 'Level1'.
+        self.levels: list[str] = []
+        self.rows: list[TmaRow] = []
+        # The parents of the current topdown level.
+        parents: list[str] = []
+        found_key = False
+        for l in csv.reader(csvfile):
+            if l[0] == 'Key':
+                found_key = True
+                for ind, name in enumerate(l):
+                    self.col_heading[name] = ind
+                    if name.startswith('Level'):
+                        self.levels.append(name)
+                _verboseprint3(f'Columns: {self.col_heading}. Levels: {self.levels}')
+                continue
+            elif not found_key:
+                continue
+
+            cells = tuple(x.strip() for x in l)
+            if not TmaSheet.is_topdown_row(l[0]):
+                self.rows.append(TmaRow(l[0], cells))
+                continue
+
+            for j in self.levels:
+                metric_name = cells[self.col_heading[j]]
+                if metric_name:
+                    break
+            assert metric_name, f'Missing metric in: {l}'
+            level = int(j[-1])
+            if level > len(parents):
+                parents.append(metric_name)
+            else:
+                while level != len(parents):
+                    parents.pop()
+                parents[-1] = metric_name
+            _verboseprint3(f'{metric_name} => {str(parents)}')
+            self.rows.append(TmaRow(l[0], cells, level, tuple(parents)))
+
+    @staticmethod
+    def is_topdown_row(key: str) -> bool:
+        topdown_keys = ['BE', 'BAD', 'RET', 'FE']
+        return any(key.startswith(td_key) for td_key in topdown_keys)
+
+    def field(self, row: TmaRow, heading: str) -> str:
+        """Given the name of a column, return the value of it in row."""
+        return row.cells[self.col_heading[heading]]
+
+
+# The TMA spreadsheets parsed by this process, or given to it by the
+# parent process, by url.
+_tma_sheets: Dict[str, TmaSheet] = {}
+
+
+def _load_tma_sheet(url: str) -> TmaSheet:
+    """Parse the TMA spreadsheet at url once."""
+    if url not in _tma_sheets:
+        _verboseprint2(f'Parsing TMA metrics from {url}')
+        with urllib.request.urlopen(url) as metric_csv:
+            _tma_sheets[url] = TmaSheet(io.TextIOWrapper(metric_csv, encoding='utf-8'))
+    return _tma_sheets[url]
+
+
+def _set_tma_sheets(sheets: Dict[str, TmaSheet]) -> None:
+    """Initialize a worker process with the sheets parsed by its parent."""
+    _tma_sheets.update(sheets)
+
+
+# A name in a TMA formula, such as an event, metric like IPC, auxiliary
+# formula like #Pipeline_Width or the children of a node like ##?Frontend_Bound.
+_tma_name = re.compile(r'#?#?\??([A-Z_a-z0-9.]|\\-)+')
+
+# An identifier in a formula, such as an event name, optionally followed
+# by the ':' of a modifier.
+_identifier_with_modifier = re.compile(r'([A-Za-z0-9_.]+)(:(?=[a-zA-Z]))?')
+
 def rewrite_metrics_in_terms_of_others(metrics: list[Dict[str,str]]) -> list[Dict[str,str]]:
     parsed: list[Tuple[str, metric.Expression]] = []
     for m in metrics:
@@ -475,6 +599,141 @@ def rewrite_metrics_in_terms_of_others(metrics: list[Dict[str,str]]) -> list[Dic
                 m['MetricExpr'] = updates[name].ToPerfJson()
     return metrics
 
+
+# Metrics whose events count incorrectly when grouped with SMT on,
+# because of the erratas SNB: BJ122, IVB: BV98, HSW: HSD29.
+_SMT_ERRATA_MODELS = {'JKT', 'SNB', 'IVB', 'IVT', 'HSW', 'HSX', 'BDW', 'BDX', 'BDW-DE'}
+_SMT_ERRATA_METRICS = {'tma_dram_bound', 'tma_l3_bound'}
+
+
+def _metric_constraints(parsed: Dict[str, metric.Expression],
+                        core_pmu: event_groups.CorePmu) -> Dict[str, Optional[str]]:
+    """The MetricConstraint, or None, of each metric from its events."""
+    # perf only collects the events of the if-else branches selected
+    # by #SMT_on and #core_wide, so each choice must fit.
+    closures = {
+        (smt_on, core_wide): metric.MetricClosures(parsed, {'#SMT_on': smt_on,
+                                                            '#core_wide': core_wide})
+        for smt_on in [0, 1] for core_wide in [0, 1]
+    }
+
+    def events(name: str, smt_on: int) -> list[list[str]]:
+        return [[e.ToPerfJson() for e in closures[(smt_on, core_wide)][name][0]
+                 if isinstance(e, metric.Event)]
+                for core_wide in [0, 1]]
+
+    return {name: event_groups.metric_constraint(core_pmu, events(name, 1), events(name, 0))
+            for name in parsed}
+
+
+# MetricConstraints from the least to the most restrictive.
+_CONSTRAINT_ORDER = [None, event_groups.NO_GROUP_EVENTS_NMI, event_groups.NO_GROUP_EVENTS_SMT,
+                     event_groups.NO_GROUP_EVENTS]
+
+
+def prefer_fixed_counters(metrics: list[Dict[str,str]], core_pmu: event_groups.CorePmu,
+                          equivalents: Dict[str, str]) -> list[Dict[str,str]]:
+    """
+    Rewrite metrics to use fixed counter events in place of the
+    programmable events counting the same, mapped from upper case names
+    by equivalents, freeing programmable counters. Events configured
+    other than by their privilege level, like with cmask, can't use a
+    fixed counter. A rewrite is only made when it leaves every metric's
+    events as schedulable as before, as two events needing the same
+    fixed counter, like CPU_CLK_UNHALTED.THREAD:k and
+    CPU_CLK_UNHALTED.THREAD, can't be grouped.
+    """
+    parsed = {m['MetricName']: metric.ParsePerfJson(m['MetricExpr']) for m in metrics}
+    references = {name: refs for (name, (_, refs)) in metric.MetricClosures(parsed).items()}
+    constraints = None
+    # Rewrite referenced metrics before the metrics referencing them.
+    for name in sorted(parsed, key=lambda n: len(references[n])):
+        names = {}
+        for leaf in parsed[name].Leaves():
+            if not isinstance(leaf, metric.Event):
+                continue
+            _, event, config = event_groups.parse_event(leaf.name)
+            if event.upper() in equivalents and \
+               all(re.fullmatch('[ukpP]+', term) for term in config):
+                names[leaf.name] = leaf.name.replace(event, equivalents[event.upper()], 1)
+        if not names:
+            continue
+        if constraints is None:
+            constraints = _metric_constraints(parsed, core_pmu)
+        trial = dict(parsed)
+        trial[name] = metric.RenameEvents(parsed[name], names).Simplify()
+        trial_constraints = _metric_constraints(trial, core_pmu)
+        affected = [n for n in parsed if n == name or name in references[n]]
+        if any(_CONSTRAINT_ORDER.index(trial_constraints[n]) >
+               _CONSTRAINT_ORDER.index(constraints[n]) for n in affected):
+            continue
+        _verboseprint2(f'Using fixed counters in {name}')
+        parsed = trial
+        constraints = trial_constraints
+    for m in metrics:
+        m['MetricExpr'] = parsed[m['MetricName']].ToPerfJson()
+    return metrics
+
+
+def add_metric_constraints(metrics: list[Dict[str,str]], core_pmu: event_groups.CorePmu,
+                           smt_errata: bool) -> list[Dict[str,str]]:
+    """
+    Set the MetricConstraint of metrics whose events, including those of
+    the metrics they reference, can't always be scheduled as one group
+    on the core PMU's counters.
+    """
+    parsed = {m['MetricName']: metric.ParsePerfJson(m['MetricExpr']) for m in metrics}
+    constraints = _metric_constraints(parsed, core_pmu)
+    for m in metrics:
+        name = m['MetricName']
+        constraint = constraints[name]
+        if smt_errata and name in _SMT_ERRATA_METRICS and not constraint:
+            constraint = event_groups.NO_GROUP_EVENTS_SMT
+        if constraint:
+            m['MetricConstraint'] = constraint
+    return metrics
+
+
+def metrics_index(metrics: list[Dict[str,str]]) -> Dict[str, Dict[str, Dict[str, list[str]]]]:
+    """
+    Index metrics by their unit, the PMU like cpu or cpu_core. For each
+    unit, map each metric to the events, metrics and runtime literals it
+    uses, including through the metrics it references. Also map each
+    event to the metrics using it and each metric group to its metrics.
+    """
+    by_unit: Dict[str, list[Dict[str,str]]] = collections.defaultdict(list)
+    for m in metrics:
+        by_unit[m.get('Unit', 'cpu')].append(m)
+    index = {}
+    for unit, unit_metrics in sorted(by_unit.items()):
+        closures = metric.MetricClosures({
+            m['MetricName']: metric.ParsePerfJson(m['MetricExpr']) for m in unit_metrics
+        })
+        metric_index: Dict[str, Dict[str, list[str]]] = {}
+        event_metrics: DefaultDict[str, list[str]] = collections.defaultdict(list)
+        group_metrics: DefaultDict[str, list[str]] = collections.defaultdict(list)
+        for m in unit_metrics:
+            name = m['MetricName']
+            leaves, references = closures[name]
+            events = sorted({e.ToPerfJson() for e in leaves if isinstance(e, metric.Event)})
+            metric_index[name] = {
+                'Events': events,
+                'Metrics': sorted(references),
+                'Literals': sorted({l.value for l in leaves if isinstance(l, metric.Literal)}),
+            }
+            for event in events:
+                event_metrics[event].append(name)
+            for group in m.get('MetricGroup', '').split(';'):
+                if group:
+                    group_metrics[group].append(name)
+        index[unit] = {
+            'Metrics': metric_index,
+            'Events': {e: sorted(names) for e, names in event_metrics.items()},
+            'MetricGroups': {g: sorted(names) for g, names in group_metrics.items()},
+        }
+    return index
+
+
 class Model:
     """
     Data related to 1 CPU model such as Skylake or Broadwell.
@@ -506,6 +765,14 @@ class Model:
         return f'{self.shortname} / {self.longname}\n\tmodels={self.models}\n\tfiles:\n\t\t' + \
             '\n\t\t'.join([f'{type} = {url}' for (type, url) in self.files.items()])
 
+    def input_hashes(self) -> Dict[str, str]:
+        """
+        Content hashes of the files the model's perf json is generated from.
+
+        @return: a mapping from a type of file to the hash of its contents.
+        """
+        return {type: _content_hash(url) for (type, url) in sorted(self.files.items())}
+
     def mapfile_line(self) -> str:
         """
         Generates a line for this model in Linux perf style CSV.
@@ -626,7 +893,7 @@ class Model:
         ])
 
 
-    def extract_tma_metrics(self, csvfile: TextIO, pmu_prefix: str,
+    def extract_tma_metrics(self, sheet: TmaSheet, pmu_prefix: str,
                             events: Dict[str, PerfmonJsonEvent]):
         """Process a TMA metrics spreadsheet generating perf metrics."""
 
@@ -704,36 +971,47 @@ class Model:
         nodes : Dict[str, str] = {}
         # Mapping from the TMA CSV metric name to the name used in the perf json.
         tma_metric_names : Dict[str, str] = {}
-        # Map from the column heading to the list index of that column.
-        col_heading : Dict[str, int] = {}
-        # A list of topdown levels such as 'Level1'.
-        levels : list[str] = []
-        # A list of parents of the current topdown level.
-        parents : list[str] = []
         # Map from a parent topdown metric name to its children's names.
         children: Dict[str, Set[str]] = collections.defaultdict(set)
         # Map from a metric name to the metric threshold expression.
         thresholds: Dict[str, str] = {}
         issue_to_metrics: Dict[str, Set[str]] = collections.defaultdict(set)
-        found_key = False
-        csvf = csv.reader([l.decode('utf-8') for l in csvfile.readlines()])
-        for l in csvf:
-            if l[0] == 'Key':
-                found_key = True
-                for ind, name in enumerate(l):
-                    col_heading[name] = ind
-                    if name.startswith('Level'):
-                        levels.append(name)
-                if tma_cpu not in col_heading:
-                    if tma_cpu == 'ADL/RPL' and 'GRT' in col_heading:
-                        tma_cpu = 'GRT'
-                _verboseprint3(f'Columns: {col_heading}. Levels: {levels}')
-            elif not found_key:
-                continue
+        # Names of the events on the CPU PMUs that need the PMU prefix
+        # adding on hybrid models.
+        cpu_events: Set[str] = set()
+        if pmu_prefix != 'cpu':
+            cpu_events = {name for (name, event) in events.items()
+                          if event.unit.startswith('cpu')}
+
+        def prefix_cpu_events(form: str) -> str:
+            """
+            Add the PMU prefix to CPU events in form like
+            'cpu_atom@INST_RETIRED.ANY@'. Events at the start or end
+            of the formula, or following an '@', aren't rewritten. An
+            event followed by a modifier like ':u' becomes
+            'cpu_atom@INST_RETIRED.ANY@u'.
+            """
+            if form in cpu_events:
+                return f'{pmu_prefix}@{form}@'
+
+            def prefix(m: re.Match) -> str:
+                name = m.group(1)
+                start, end = m.span(1)
+                if name not in cpu_events or start == 0 or \
+                   form[start - 1] == '@' or end == len(form):
+                    return m.group(0)
+                return f'{pmu_prefix}@{name}@'
+
+            return _identifier_with_modifier.sub(prefix, form)
+
+        if tma_cpu not in sheet.col_heading:
+            if tma_cpu == 'ADL/RPL' and 'GRT' in sheet.col_heading:
+                tma_cpu = 'GRT'
+        for row in sheet.rows:
 
             def field(x: str) -> str:
-                """Given the name of a column, return the value in the current line of it."""
-                return l[col_heading[x]].strip()
+                """Given the name of a column, return the value in the current row of it."""
+                return sheet.field(row, x)
 
             def find_form() -> Optional[str]:
                 """Find the formula for CPU in the current CSV line."""
@@ -789,24 +1067,10 @@ class Model:
                 group = field('Metric Group')
                 return group if group else groups.get(metric_name)
 
-            def is_topdown_row(key: str) -> bool:
-                topdown_keys = ['BE', 'BAD', 'RET', 'FE']
-                return any(key.startswith(td_key) for td_key in topdown_keys)
-
-            if is_topdown_row(l[0]):
-                for j in levels:
-                    metric_name = field(j)
-                    if metric_name:
-                        break
-                assert metric_name, f'Missing metric in: {l}'
-                level = int(j[-1])
-                if level > len(parents):
-                    parents.append(metric_name)
-                else:
-                    while level != len(parents):
-                        parents.pop()
-                    parents[-1] = field(j)
-                _verboseprint3(f'{field(j)} => {str(parents)}')
+            if row.level:
+                level = row.level
+                parents = row.parents
+                metric_name = parents[-1]
                 form = find_form()
                 if not form:
                     _verboseprint2(f'Missing formula for {metric_name} on CPU {self.shortname}')
@@ -852,11 +1116,11 @@ class Model:
                 ))
                 infoname[metric_name] = form
                 tma_metric_names[metric_name] = tma_metric_name
-            elif l[0].startswith('Info'):
+            elif row.key.startswith('Info'):
                 metric_name = field('Level1')
                 form = find_form()
                 if form:
-                    tma_metric_name = f'tma_{l[0].lower().replace(".","_")}_{metric_name.lower()}'
+                    tma_metric_name = f'tma_{row.key.lower().replace(".","_")}_{metric_name.lower()}'
                     mgroups = []
                     csv_groups = metric_group(metric_name)
                     if csv_groups:
@@ -884,7 +1148,7 @@ class Model:
                     ))
                     infoname[metric_name] = form
                     tma_metric_names[metric_name] = tma_metric_name
-            elif l[0].startswith('Aux'):
+            elif row.key.startswith('Aux'):
                 form = find_form()
                 if form and form != '#NA':
                     aux_name = field('Level1')
@@ -892,7 +1156,13 @@ class Model:
                     aux[aux_name] = form
                     _verboseprint3(f'Adding aux {aux_name}: {form}')
 
-        jo = []
+        # Memoized resolution of a name within a formula, keyed by the
+        # name and whether metrics are expanded. Names are resolved
+        # depth first so each aux, node or info formula is resolved once.
+        resolved_names: Dict[Tuple[str, bool], str] = {}
+        # The perf json metrics keyed by name in the order they will be
+        # output. A replaced metric moves to the end.
+        jo: Dict[str, Dict[str, str]] = {}
         for i in info:
             if i.name in ignore:
                 _verboseprint2(f'Skipping {i.name}')
@@ -1057,17 +1327,7 @@ class Model:
                             form = new_form
 
                     if pmu_prefix != 'cpu':
-                        for name in events:
-                            if events[name].unit.startswith('cpu') and name in form:
-                                if form == name:
-                                    form = f'{pmu_prefix}@{name}@'
-                                else:
-                                    form = re.sub(rf'([^@]){name}:([a-zA-Z])',
-                                                  rf'\1{pmu_prefix}@{name}@\2',
-                                                  form, re.IGNORECASE)
-                                    form = re.sub(rf'([^@]){name}([^a-zA-Z0-9_])',
-                                                  rf'\1{pmu_prefix}@{name}@\2',
-                                                  form, re.IGNORECASE)
+                        form = prefix_cpu_events(form)
 
                     changed = True
                     while changed:
@@ -1118,9 +1378,6 @@ class Model:
                         if form == '#NA':
                             # Don't refer to empty metrics.
                             return '0'
-                        # Check the expanded formula for bad events, which
-                        # would mean we want to drop this metric too.
-                        form = fixup(form)
                         if v in tma_metric_names:
                             return tma_metric_names[v]
                     return v
@@ -1140,14 +1397,29 @@ class Model:
                         return resolve_aux(v)
                     return resolve_info(v)
 
-                # Iterate until form stabilizes to handle deeper nesting.
-                changed = True
-                while changed:
-                    orig_form = form
-                    form = re.sub(r'#?#?\??([A-Z_a-z0-9.]|\\-)+',
-                                  lambda m: resolve(m.group(0)), form)
-                    changed = orig_form != form
-
+                def resolve_form(form: str, path: Tuple[str, ...]) -> str:
+                    """Replace every name in form with its resolved formula."""
+                    return _tma_name.sub(lambda m: resolve_name(m.group(0), path), form)
+
+                def resolve_name(v: str, path: Tuple[str, ...]) -> str:
+                    """
+                    Resolve the name v, and transitively the names its
+                    formula refers to, memoizing the result. path holds
+                    the names currently being resolved to detect cycles.
+                    """
+                    key = (v, expand_metrics)
+                    if key in resolved_names:
+                        return resolved_names[key]
+                    if v in path:
+                        cycle = ' -> '.join(path[path.index(v):] + (v,))
+                        raise ValueError(f'Cycle in TMA formulas on {self.shortname}: {cycle}')
+                    result = resolve(v)
+                    if result != v:
+                        result = resolve_form(result, path + (v,))
+                    resolved_names[key] = result
+                    return result
+
+                form = resolve_form(form, ())
                 form = fixup(form)
                 return form
 
@@ -1201,10 +1473,8 @@ class Model:
                 # Check for duplicate metrics. Note, done after
                 # verifying the events.
                 parsed_threshold = None
-                dups = [m for m in jo if m['MetricName'] == name]
-                if len(dups) > 0:
-                    assert len(dups) == 1
-                    m = dups[0]
+                if name in jo:
+                    m = jo.pop(name)
                     if form != m['MetricExpr']:
                         _verboseprint2(f'duplicate metric {name} forms differ'
                                        f'\n\tnew: {form}'
@@ -1219,7 +1489,6 @@ class Model:
                     if not threshold:
                         parsed_threshold = m.get('MetricThreshold')
                     group = m['MetricGroup']
-                    jo.remove(m)
 
                 desc = desc.strip()
                 def append_to_desc(s: str):
@@ -1256,141 +1525,6 @@ class Model:
                 else:
                     j['BriefDescription'] = desc
 
-                # Don't group events as there can never be sufficient counters.
-                no_group = 'NO_GROUP_EVENTS'
-                # Inform perf not to group metrics if the NMI watchdog
-                # is enabled.
-                nmi = 'NO_GROUP_EVENTS_NMI'
-                # Inform perf not to group events if SMT is enabled. This is for
-                # the erratas SNB: BJ122, IVB: BV98, HSW: HSD29, as well as when
-                # EBS_Mode causes additional events to be required.
-                smt = 'NO_GROUP_EVENTS_SMT'
-
-                sandybridge_constraints = {
-                    # Metrics with more events than counters.
-                    'tma_branch_mispredicts': no_group,
-                    'tma_contested_accesses': no_group,
-                    'tma_core_bound': no_group,
-                    'tma_data_sharing': no_group,
-                    'tma_fb_full': no_group,
-                    'tma_l3_hit_latency': no_group,
-                    'tma_local_dram': no_group,
-                    'tma_lock_latency': no_group,
-                    'tma_machine_clears': no_group,
-                    'tma_memory_bound': no_group,
-                    'tma_ports_utilization': no_group,
-                    'tma_remote_cache': no_group,
-                    'tma_remote_dram': no_group,
-                    'tma_split_loads': no_group,
-                    'tma_store_latency': no_group,
-                    'tma_info_memory_load_miss_real_latency': no_group,
-                    'tma_info_memory_mlp': no_group,
-                    # Metrics that would fit were the NMI watchdog disabled.
-                    'tma_alu_op_utilization': nmi,
-                    'tma_backend_bound': nmi,
-                    'tma_cisc': nmi,
-                    'tma_load_op_utilization': nmi,
-                    # SMT errata workarounds.
-                    'tma_dram_bound': smt,
-                    'tma_l3_bound': smt,
-                }
-                skylake_constraints = {
-                    # Metrics with more events than counters.
-                    'tma_branch_mispredicts': no_group,
-                    'tma_contested_accesses': no_group,
-                    'tma_core_bound': no_group,
-                    'tma_data_sharing': no_group,
-                    'tma_dram_bound': no_group,
-                    'tma_false_sharing': no_group,
-                    'tma_fp_arith': no_group,
-                    'tma_fp_vector': no_group,
-                    'tma_l2_bound': no_group,
-                    'tma_machine_clears': no_group,
-                    'tma_memory_bound': no_group,
-                    'tma_pmm_bound': no_group,
-                    'tma_info_botlnk_l0_core_bound_likely': no_group,
-                    'tma_info_botlnk_l2_dsb_misses': no_group,
-                    'tma_info_bottleneck_big_code': no_group,
-                    'tma_info_bottleneck_instruction_fetch_bw': no_group,
-                    'tma_info_bottleneck_memory_bandwidth': no_group,
-                    'tma_info_bottleneck_memory_data_tlbs': no_group,
-                    'tma_info_bottleneck_memory_latency': no_group,
-                    'tma_info_bottleneck_mispredictions': no_group,
-                    'tma_info_branches_jump': no_group,
-                    'tma_info_core_flopc': no_group,
-                    'tma_info_fp_arith_utilization': no_group,
-                    'tma_info_inst_mix_iparith': no_group,
-                    'tma_info_inst_mix_ipflop': no_group,
-                    'tma_info_system_gflops': no_group,
-                    # Metrics that would fit were the NMI watchdog disabled.
-                    'tma_dtlb_load': nmi,
-                    'tma_fb_full': nmi,
-                    'tma_load_stlb_hit': nmi,
-                    'tma_remote_cache': nmi,
-                    'tma_split_loads': nmi,
-                    'tma_store_latency': nmi,
-                    'tma_info_memory_tlb_page_walks_utilization': nmi,
-                }
-                icelake_constraints = {
-                    # Metrics with more events than counters.
-                    'tma_contested_accesses': no_group,
-                    'tma_data_sharing': no_group,
-                    'tma_dram_bound': no_group,
-                    'tma_l2_bound': no_group,
-                    'tma_lock_latency': no_group,
-                    'tma_memory_operations': no_group,
-                    'tma_other_light_ops': no_group,
-                    'tma_info_bad_spec_branch_misprediction_cost': no_group,
-                    'tma_info_botlnk_l0_core_bound_likely': no_group,
-                    'tma_info_botlnk_l2_dsb_misses': no_group,
-                    'tma_info_botlnk_l2_dsb_misses': no_group,
-                    'tma_info_botlnk_l2_ic_misses': no_group,
-                    'tma_info_bottleneck_big_code': no_group,
-                    'tma_info_bottleneck_instruction_fetch_bw': no_group,
-                    'tma_info_bottleneck_memory_bandwidth': no_group,
-                    'tma_info_bottleneck_memory_data_tlbs': no_group,
-                    'tma_info_bottleneck_memory_latency': no_group,
-                    'tma_info_bottleneck_mispredictions': no_group,
-                    # Metrics that would fit were the NMI watchdog disabled.
-                    'tma_l3_bound': nmi,
-                    'tma_4k_aliasing': nmi,
-                    'tma_split_stores': nmi,
-                    'tma_store_fwd_blk': nmi,
-                }
-                errata_constraints = {
-                    # 4 programmable, 3 fixed counters per HT
-                    'JKT': sandybridge_constraints,
-                    'SNB': sandybridge_constraints,
-                    'IVB': sandybridge_constraints,
-                    'IVT': sandybridge_constraints,
-                    'HSW': sandybridge_constraints,
-                    'HSX': sandybridge_constraints,
-                    'BDW': sandybridge_constraints,
-                    'BDX': sandybridge_constraints,
-                    'BDW-DE': sandybridge_constraints,
-                    # 4 programmable, 3 fixed counters per HT
-                    'SKL': skylake_constraints,
-                    'KBL': skylake_constraints,
-                    'SKX': skylake_constraints,
-                    'KBLR': skylake_constraints,
-                    'CFL': skylake_constraints,
-                    'CML': skylake_constraints,
-                    'CLX': skylake_constraints,
-                    'CPX': skylake_constraints,
-                    'CNL': skylake_constraints,
-                    # 8 programmable, 5 fixed counters per HT
-                    'ICL': icelake_constraints,
-                    'ICX': icelake_constraints,
-                    'RKL': icelake_constraints,
-                    'TGL': icelake_constraints,
-                    'ADL': icelake_constraints,
-                    'ADLN': icelake_constraints,
-                    'RPL': icelake_constraints,
-                    'SPR': icelake_constraints,
-                }
-                if name in errata_constraints[self.shortname]:
-                    j['MetricConstraint'] = errata_constraints[self.shortname][name]
-
                 if group:
                     if 'TopdownL1' in group:
                         if 'Default' in group:
@@ -1416,7 +1550,7 @@ class Model:
                 elif threshold:
                     j['MetricThreshold'] = metric.ParsePerfJson(threshold).Simplify().ToPerfJson()
 
-                jo.append(j)
+                jo[name] = j
 
             form = resolve_all(form, expand_metrics=False)
             needs_slots = 'topdown\-' in form and 'tma_info_thread_slots' not in form
@@ -1459,12 +1593,12 @@ class Model:
             form = resolve_all(form, expand_metrics=False)
             if form:
                 formula = metric.ParsePerfJson(form)
-                jo.append({
+                jo['UNCORE_FREQ'] = {
                     'MetricName': 'UNCORE_FREQ',
                     'MetricExpr': formula.ToPerfJson(),
                     'BriefDescription': 'Uncore frequency per die [GHZ]',
                     'MetricGroup': 'SoC'
-                })
+                }
 
         if 'extra metrics' in self.files:
             with urllib.request.urlopen(self.files['extra metrics']) as extra_json:
@@ -1488,15 +1622,14 @@ class Model:
                 for em in json.load(extra_json):
                     if em['MetricName'] in skip:
                         continue
-                    dups = [m for m in jo if m['MetricName'] == em['MetricName']]
-                    if dups:
-                        _verboseprint3(f'Not replacing:\n\t{dups[0]["MetricExpr"]}\nwith:\n\t{em["MetricExpr"]}')
+                    if em['MetricName'] in jo:
+                        _verboseprint3(f'Not replacing:\n\t{jo[em["MetricName"]]["MetricExpr"]}\nwith:\n\t{em["MetricExpr"]}')
                         continue
                     save_form(em['MetricName'], em['MetricGroup'], em['MetricExpr'],
                               em['BriefDescription'], None, em.get('ScaleUnit'),
                               em.get('MetricThreshold'), [])
 
-        return jo
+        return list(jo.values())
 
 
     def to_perf_json(self, outdir: str):
@@ -1511,6 +1644,10 @@ class Model:
         # representing the perf json event. The dictionary events may
         # be modified by the uncore CSV file.
         dict_events: Dict[str, Dict[str, str]] = {}
+        # The counters of the core PMUs' events by PMU prefix.
+        core_pmus: Dict[str, event_groups.CorePmu] = {}
+        # Programmable events' fixed counter equivalents by PMU prefix.
+        fixed_equivalents: Dict[str, Dict[str, str]] = {}
         for event_type in ['atom', 'core', 'uncore', 'uncore experimental']:
             if event_type not in self.files:
                 continue
@@ -1520,6 +1657,14 @@ class Model:
                 pmu_prefix = f'cpu_{event_type}' if 'atom' in self.files else 'cpu'
             with urllib.request.urlopen(self.files[event_type]) as event_json:
                 json_data = json.load(event_json)
+                if pmu_prefix:
+                    core_pmus[pmu_prefix] = event_groups.CorePmu(pmu_prefix, {
+                        PerfmonJsonEvent.fix_name(x['EventName']).upper():
+                        event_groups.EventCounters.from_json(x)
+                        for x in json_data['Events']
+                    })
+                    fixed_equivalents[pmu_prefix] = \
+                        event_groups.fixed_counter_equivalents(json_data['Events'])
                 # UNC_IIO_BANDWIDTH_OUT events are broken on Linux pre-SPR so skip if they exist.
                 pmon_events = [PerfmonJsonEvent(self.shortname, pmu_prefix, x)
                                for x in json_data['Events']
@@ -1656,14 +1801,20 @@ class Model:
             if metric_csv_key not in self.files:
                 continue
             pmu_prefix = unit if 'atom' in self.files else 'cpu'
-            with urllib.request.urlopen(self.files[metric_csv_key]) as metric_csv:
-                csv_metrics = self.extract_tma_metrics(metric_csv, pmu_prefix, events)
-                csv_metrics = sorted(csv_metrics,
-                                     key=lambda m: (m['Unit'] if 'Unit' in m else 'cpu',
-                                                    m['MetricName'])
-                                     )
-                csv_metrics = rewrite_metrics_in_terms_of_others(csv_metrics)
-                metrics.extend(csv_metrics)
+            sheet = _load_tma_sheet(self.files[metric_csv_key])
+            csv_metrics = self.extract_tma_metrics(sheet, pmu_prefix, events)
+            csv_metrics = sorted(csv_metrics,
+                                 key=lambda m: (m['Unit'] if 'Unit' in m else 'cpu',
+                                                m['MetricName'])
+                                 )
+            if pmu_prefix in core_pmus:
+                csv_metrics = prefer_fixed_counters(csv_metrics, core_pmus[pmu_prefix],
+                                                    fixed_equivalents[pmu_prefix])
+            csv_metrics = rewrite_metrics_in_terms_of_others(csv_metrics)
+            if pmu_prefix in core_pmus:
+                csv_metrics = add_metric_constraints(csv_metrics, core_pmus[pmu_prefix],
+                                                     self.shortname in _SMT_ERRATA_MODELS)
+            metrics.extend(csv_metrics)
 
         if len(metrics) > 0:
             metrics.extend(self.cstate_json())
@@ -1680,6 +1831,13 @@ class Model:
                 json.dump(metrics, perf_metric_json, sort_keys=True, indent=4,
                           separators=(',', ': '))
                 perf_metric_json.write('\n')
+            # Not named .json as perf's jevents.py reads every json file
+            # in a model's directory as events or metrics.
+            with open(f'{outdir}/{self.shortname.lower().replace("-","")}-metrics.index',
+                      'w', encoding='ascii') as index_json:
+                json.dump(metrics_index(metrics), index_json, sort_keys=True, indent=4,
+                          separators=(',', ': '))
+                index_json.write('\n')
 
         if self.metricgroups:
             with open(f'{outdir}/metricgroups.json', 'w', encoding='ascii') as metricgroups_json:
@@ -1814,20 +1972,124 @@ class Mapfile:
     def __str__(self):
         return ''.join(str(model) for model in self.archs)
 
-    def to_perf_json(self, outdir: str):
+    def to_perf_json(self, outdir: str, jobs: int = 1,
+                     manifest: Optional[str] = None) -> list[str]:
         """
         Create a perf style mapfile.csv.
+
+        @param outdir: directory the mapfile and per-model directories are written to.
+        @param jobs: number of models to generate concurrently.
+        @param manifest: path of a build manifest holding the content hashes
+                         of each model's inputs. Models whose inputs and
+                         generator are unchanged since the manifest was
+                         written are skipped.
+        @return: the shortnames of models that failed to generate.
         """
         _verboseprint(f'Writing mapfile to {outdir}/mapfile.csv')
-        gen_mapfile = open(f'{outdir}/mapfile.csv', 'w', encoding='ascii')
-        for model in self.archs:
-            gen_mapfile.write(model.mapfile_line() + '\n')
-
+        with open(f'{outdir}/mapfile.csv', 'w', encoding='ascii') as gen_mapfile:
+            for model in self.archs:
+                gen_mapfile.write(model.mapfile_line() + '\n')
+
+        # Load the hashes of the inputs of models built by a previous run.
+        generator_hash = _generator_hash()
+        built: Dict[str, Dict[str, str]] = {}
+        if manifest and os.path.exists(manifest):
+            with open(manifest, 'r', encoding='ascii') as manifest_json:
+                previous = json.load(manifest_json)
+            if previous.get('Generator') == generator_hash:
+                built = previous.get('Models', {})
+
+        models = []
+        modeldirs = []
+        hashes: Dict[str, Dict[str, str]] = {}
         for model in self.archs:
             modeldir = outdir + '/' + model.longname
-            _verboseprint(f'Creating event json for {model.shortname} in {modeldir}')
+            if manifest:
+                hashes[model.shortname] = model.input_hashes()
+                if os.path.isdir(modeldir) and \
+                   built.get(model.shortname) == hashes[model.shortname]:
+                    _verboseprint(f'Skipping unchanged {model.shortname} in {modeldir}')
+                    continue
             os.system(f'mkdir -p {modeldir}')
+            models.append(model)
+            modeldirs.append(modeldir)
+
+        if jobs <= 1:
+            results = [_model_to_perf_json(model, modeldir, _verbose, capture=False)
+                       for (model, modeldir) in zip(models, modeldirs)]
+        else:
+            # Parse each TMA spreadsheet once here rather than in every worker.
+            sheets = {model.files[key]: _load_tma_sheet(model.files[key])
+                      for model in models
+                      for key in ['tma metrics', 'e-core tma metrics'] if key in model.files}
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs, initializer=_set_tma_sheets,
+                    initargs=(sheets,)) as executor:
+                futures = [executor.submit(_model_to_perf_json, model, modeldir, _verbose)
+                           for (model, modeldir) in zip(models, modeldirs)]
+                # Gather in submission order so output matches a serial run.
+                results = [future.result() for future in futures]
+
+        failed = []
+        for model, (output, error) in zip(models, results):
+            if output:
+                print(output, end='')
+            if error:
+                print(f'Error: Failed to create json for {model.shortname}:\n{error}',
+                      file=sys.stderr)
+                failed.append(model.shortname)
+
+        if manifest:
+            # Record models that are up to date, failed models are
+            # rebuilt on the next run.
+            models_json = {shortname: model_hashes
+                           for (shortname, model_hashes) in hashes.items()
+                           if shortname not in failed}
+            with open(manifest, 'w', encoding='ascii') as manifest_json:
+                json.dump({'Generator': generator_hash, 'Models': models_json},
+                          manifest_json, sort_keys=True, indent=4,
+                          separators=(',', ': '))
+                manifest_json.write('\n')
+        return failed
+
+
+def _content_hash(url: str) -> str:
+    """Returns the SHA-256 of the contents of url."""
+    with urllib.request.urlopen(url) as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _generator_hash() -> str:
+    """Returns a hash of the scripts that generate the perf json."""
+    h = hashlib.sha256()
+    for path in [__file__, metric.__file__, event_groups.__file__]:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _model_to_perf_json(model: Model, modeldir: str, verbose: int,
+                        capture: bool = True) -> Tuple[str, Optional[str]]:
+    """
+    Generate the perf json for a single model, possibly in a worker process.
+
+    @param model: the model to generate.
+    @param modeldir: the directory to write the model's json files to.
+    @param verbose: the verbosity level, as globals aren't inherited by workers.
+    @param capture: capture printed output so it can be shown in model order.
+    @return: a tuple of the printed output and a traceback if generation failed.
+    """
+    global _verbose
+    _verbose = verbose
+    output = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(output) if capture else contextlib.nullcontext():
+        try:
+            _verboseprint(f'Creating event json for {model.shortname} in {modeldir}')
             model.to_perf_json(modeldir)
+        except Exception:
+            error = traceback.format_exc()
+    return (output.getvalue(), error)
 
 
 def main():
@@ -1838,12 +2100,19 @@ def main():
                     help='Base directory containing event, metric and other files.')
     ap.add_argument('--verbose', '-v', action='count', default=0, dest='verbose',
                     help='Additional output when running.')
+    ap.add_argument('--jobs', '-j', type=int, default=1,
+                    help='Number of models to generate in parallel.')
+    ap.add_argument('--manifest', default=None,
+                    help='Build manifest used to only regenerate models whose inputs changed.')
     args = ap.parse_args()
 
     global _verbose
     _verbose = args.verbose
     os.system(f'mkdir -p {args.outdir}')
-    Mapfile(args.basepath).to_perf_json(args.outdir)
+    failed = Mapfile(args.basepath).to_perf_json(args.outdir, args.jobs,
+                                                args.manifest)
+    if failed:
+        sys.exit(f'Failed to create json for: {", ".join(failed)}')
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,292 @@
+# SPDX-License-Identifier: BSD-3-Clause
+"""Schedule the events of metrics onto the counters of a core PMU.
+
+The fixed and programmable (general purpose) counters an event may use
+come from the Counter and CounterHTOff fields of the perfmon event
+json. Events sharing an MSRIndex, like the OFFCORE_RESPONSE events, are
+limited by the number of MSRs holding their MSRValue and no two
+TakenAlone events may be counted together.
+"""
+from dataclasses import dataclass
+import re
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+# Events computed from the PERF_METRICS MSR alongside the fixed slots
+# counter and so needing no counter of their own.
+_TOPDOWN_EVENT = re.compile(r'topdown-[a-z-]+', re.IGNORECASE)
+
+# Generic perf event names, rather than perfmon event names, that may
+# appear in metrics and the programmable counters they are restricted
+# to, None for any.
+_GENERIC_EVENTS: Dict[str, Optional[FrozenSet[int]]] = {
+    'branch-misses': None,
+    'branches': None,
+    'cycles': None,
+    'cycles-t': None,
+    # in_tx_cp may only be set on counter 2.
+    'cycles-ct': frozenset([2]),
+    'el-abort': None,
+    'el-capacity': None,
+    'el-commit': None,
+    'el-conflict': None,
+    'el-start': None,
+    'instructions': None,
+    'tx-abort': None,
+    'tx-capacity': None,
+    'tx-commit': None,
+    'tx-conflict': None,
+    'tx-start': None,
+}
+
+# PMUs of the core's counters.
+_CORE_PMUS = ['cpu', 'cpu_atom', 'cpu_core']
+
+
+@dataclass(frozen=True)
+class EventCounters:
+    """The counters and other resources needed to count an event."""
+    # The fixed counter of the event or None if it is programmable.
+    fixed: Optional[int]
+    # Programmable counters usable when SMT is on and off.
+    counters: FrozenSet[int]
+    counters_smt_off: FrozenSet[int]
+    taken_alone: bool = False
+    msr_index: Optional[str] = None
+    msr_value: Optional[str] = None
+
+    @staticmethod
+    def from_json(jd: Dict[str, str]) -> 'EventCounters':
+        """Read from a perfmon json event dictionary."""
+        def counters(field: str) -> Tuple[Optional[int], FrozenSet[int]]:
+            value = jd.get(field, '')
+            m = re.fullmatch(r'fixed counter ([0-9]+)', value.strip(), re.IGNORECASE)
+            if m:
+                return (int(m.group(1)), frozenset())
+            return (None, frozenset(int(x) for x in re.findall(r'[0-9]+', value)))
+
+        fixed, smt_on = counters('Counter')
+        smt_off = counters('CounterHTOff')[1] if jd.get('CounterHTOff') else smt_on
+        msr_index = jd.get('MSRIndex')
+        if not msr_index or int(msr_index.split(',')[0], 16) == 0:
+            msr_index = None
+        return EventCounters(fixed, smt_on, smt_off,
+                             jd.get('TakenAlone') == '1',
+                             msr_index.lower() if msr_index else None,
+                             jd.get('MSRValue') if msr_index else None)
+
+
+def parse_event(spec: str) -> Tuple[Optional[str], str, Tuple[str, ...]]:
+    """
+    Split an event as written in a metric, like
+    'cpu_core@INST_RETIRED.ANY@', 'CPU_CLK_UNHALTED.THREAD_P:k' or
+    'cpu@FP_ARITH_INST_RETIRED.SCALAR_SINGLE\\,umask\\=0x03@', into its
+    PMU, name and sorted terms and modifiers that configure it.
+    """
+    spec = spec.replace('\\', '')
+    pmu = None
+    m = re.fullmatch(r'([^@/]+)[@/](.*)[@/]([a-zA-Z]*)', spec)
+    if m:
+        pmu = m.group(1)
+        terms = m.group(2).split(',')
+        modifiers = [m.group(3)] if m.group(3) else []
+    else:
+        terms = [spec]
+        modifiers = []
+    name = terms[0]
+    if ':' in name:
+        name, modifier = name.split(':', 1)
+        modifiers.append(modifier)
+    return (pmu, name, tuple(sorted(terms[1:] + modifiers)))
+
+
+def is_topdown(spec: str) -> bool:
+    """
+    Is the event one of the topdown events, like 'topdown-retiring',
+    read from the PERF_METRICS MSR? These need no counter but must be
+    grouped with the slots event.
+    """
+    return bool(_TOPDOWN_EVENT.fullmatch(parse_event(spec)[1]))
+
+
+class CorePmu:
+    """The counters of a core PMU and the counters usable by its events."""
+
+    def __init__(self, name: str, events: Dict[str, EventCounters]):
+        """
+        Constructed from the PMU's name, like 'cpu' or 'cpu_core', and
+        a map from upper case perfmon event names to their counters.
+        """
+        self.name = name
+        self.events = events
+        self.counters = frozenset().union(*[e.counters for e in events.values()])
+        self.counters_smt_off = frozenset().union(
+            *[e.counters_smt_off for e in events.values()])
+
+    @staticmethod
+    def from_json(name: str, json_events: List[Dict[str, str]]) -> 'CorePmu':
+        """Constructed from the events of a perfmon core event json."""
+        return CorePmu(name, {jd['EventName'].upper(): EventCounters.from_json(jd)
+                              for jd in json_events})
+
+    def event_counters(self, spec: str
+                       ) -> Optional[Tuple[Tuple[str, Tuple[str, ...]], EventCounters]]:
+        """
+        For an event of a metric, its identity and the counters it needs
+        or None if it isn't counted by this PMU's counters.
+        """
+        pmu, name, config = parse_event(spec)
+        if pmu not in [None] + _CORE_PMUS or _TOPDOWN_EVENT.fullmatch(name):
+            return None
+        if name.lower() == 'slots':
+            # perf's name for the fixed counter TOPDOWN.SLOTS.
+            name = 'TOPDOWN.SLOTS'
+        if name.upper() in self.events:
+            return ((name.upper(), config), self.events[name.upper()])
+        if name.lower() in _GENERIC_EVENTS:
+            counters = _GENERIC_EVENTS[name.lower()]
+            return ((name.lower(), config),
+                    EventCounters(None, counters or self.counters,
+                                  counters or self.counters_smt_off))
+        return None
+
+
+# The programmable event encodings, EventCode and UMask, counting the
+# same as the fixed counters. Fixed counter events are given a pseudo
+# encoding of EventCode 0x00 and a UMask identifying the counter. The
+# reference cycles of fixed counter 2 have no programmable equivalent
+# common to all models.
+_FIXED_COUNTER_EQUIVALENTS = {
+    0x01: (0xC0, 0x00),  # Instructions retired.
+    0x02: (0x3C, 0x00),  # Unhalted core cycles.
+    0x04: (0xA4, 0x01),  # Topdown slots.
+}
+
+# Fields of the perfmon event json that, with EventCode and UMask,
+# configure what an event counts.
+_ENCODING_FIELDS = ['CounterMask', 'Invert', 'AnyThread', 'EdgeDetect', 'MSRIndex', 'MSRValue']
+
+
+def fixed_counter_equivalents(json_events: List[Dict[str, str]]) -> Dict[str, str]:
+    """
+    Map the upper case names of programmable events to the name of a
+    fixed counter event counting the same, found from their encodings
+    in a perfmon core event json.
+    """
+    def encoding(jd: Dict[str, str]) -> Optional[Tuple[int, ...]]:
+        try:
+            return tuple(int(jd.get(field) or '0', 16 if field == 'MSRIndex' else 0)
+                         for field in ['EventCode', 'UMask'] + _ENCODING_FIELDS)
+        except ValueError:
+            # Events with several encodings, like '0xB7, 0xBB'.
+            return None
+
+    fixed: Dict[Tuple[int, ...], List[str]] = {}
+    # Prefer events that aren't deprecated, then the first by name.
+    for jd in sorted(json_events, key=lambda jd: (jd.get('Deprecated') == '1', jd['EventName'])):
+        if not jd.get('Counter', '').lower().startswith('fixed counter'):
+            continue
+        e = encoding(jd)
+        if e and e[0] == 0 and e[1] in _FIXED_COUNTER_EQUIVALENTS:
+            fixed.setdefault(_FIXED_COUNTER_EQUIVALENTS[e[1]] + e[2:], []).append(jd['EventName'])
+    result = {}
+    for jd in json_events:
+        if jd.get('Counter', '').lower().startswith('fixed counter'):
+            continue
+        names = fixed.get(encoding(jd))
+        if names:
+            # Prefer the fixed event named like the programmable one,
+            # like CPU_CLK_UNHALTED.THREAD for CPU_CLK_UNHALTED.THREAD_P.
+            name = re.sub(r'_P(?=_|$)', '', jd['EventName'])
+            result[jd['EventName'].upper()] = name if name in names else names[0]
+    return result
+
+
+def _assign(events: List[FrozenSet[int]]) -> bool:
+    """
+    Can every event, given as the set of counters it may use, be given
+    its own counter? Solved as a bipartite matching with augmenting
+    paths.
+    """
+    counter_event: Dict[int, int] = {}
+
+    def augment(event: int, seen: set) -> bool:
+        for counter in events[event]:
+            if counter in seen:
+                continue
+            seen.add(counter)
+            if counter not in counter_event or augment(counter_event[counter], seen):
+                counter_event[counter] = event
+                return True
+        return False
+
+    # Place the most constrained events first.
+    order = sorted(range(len(events)), key=lambda i: len(events[i]))
+    return all(augment(i, set()) for i in order)
+
+
+def schedulable(pmu: CorePmu, events: Iterable[EventCounters], smt_on: bool,
+                nmi_watchdog: bool) -> bool:
+    """
+    Can the events, already without duplicates, be counted together in
+    one group? An enabled NMI watchdog holds one programmable counter.
+    """
+    fixed = set()
+    programmable: List[EventCounters] = []
+    for e in events:
+        if e.fixed is not None:
+            if e.fixed in fixed:
+                return False
+            fixed.add(e.fixed)
+        else:
+            programmable.append(e)
+    if sum(e.taken_alone for e in programmable) > 1:
+        return False
+    msr_values: Dict[str, set] = {}
+    for e in programmable:
+        if e.msr_index:
+            msr_values.setdefault(e.msr_index, set()).add(e.msr_value)
+    if any(len(values) > len(index.split(',')) for (index, values) in msr_values.items()):
+        return False
+    counters = [e.counters if smt_on else e.counters_smt_off for e in programmable]
+    if nmi_watchdog:
+        counters.append(pmu.counters if smt_on else pmu.counters_smt_off)
+    return _assign(counters)
+
+
+# Don't group events as there can never be sufficient counters.
+NO_GROUP_EVENTS = 'NO_GROUP_EVENTS'
+# Don't group events if the NMI watchdog is enabled.
+NO_GROUP_EVENTS_NMI = 'NO_GROUP_EVENTS_NMI'
+# Don't group events if SMT is enabled.
+NO_GROUP_EVENTS_SMT = 'NO_GROUP_EVENTS_SMT'
+
+
+def metric_constraint(pmu: CorePmu, smt_on_events: Iterable[Iterable[str]],
+                      smt_off_events: Iterable[Iterable[str]]) -> Optional[str]:
+    """
+    The MetricConstraint for a metric, or None if its events always fit
+    in a group. The events, including those of metrics it references,
+    are given for SMT on and off, each as the alternative sets of events
+    that runtime literals, like #core_wide, may select between.
+    """
+    def counted(specs: Iterable[str]) -> List[EventCounters]:
+        result = {}
+        for spec in specs:
+            event = pmu.event_counters(spec)
+            if event:
+                result[event[0]] = event[1]
+        return list(result.values())
+
+    smt_on = [counted(events) for events in smt_on_events]
+    smt_off = [counted(events) for events in smt_off_events]
+
+    def fits(alternatives: List[List[EventCounters]], smt: bool, nmi_watchdog: bool) -> bool:
+        return all(schedulable(pmu, events, smt, nmi_watchdog) for events in alternatives)
+
+    if fits(smt_on, True, True) and fits(smt_off, False, True):
+        return None
+    if fits(smt_on, True, False) and fits(smt_off, False, False):
+        return NO_GROUP_EVENTS_NMI
+    if fits(smt_off, False, True):
+        return NO_GROUP_EVENTS_SMT
+    return NO_GROUP_EVENTS
@@ -1,10 +1,17 @@
 # SPDX-License-Identifier: BSD-3-Clause
 """Parse or generate representations of perf metrics."""
-import ast
 import decimal
+import functools
 import json
+import math
 import re
-from typing import Dict, List, Optional, Set, Tuple, Union
+import types
+try:
+  import numpy
+except ImportError:
+  numpy = None
+from typing import (Callable, Dict, FrozenSet, List, Optional, Sequence, Set,
+                    Tuple, Union)
 
 
 class Expression:
@@ -29,9 +36,81 @@ class Expression:
   def Substitute(self, name: str, expression: 'Expression') -> 'Expression':
     raise NotImplementedError()
 
+  def Specialize(self, literals: Dict[str, float]) -> 'Expression':
+    """Returns self with the given runtime literals' values folded in.
+
+    Literals, like '#SMT_on', and source_count of an event, keyed like
+    'source_count(UNC_CHA_CLOCKTICKS)', are matched ignoring case and
+    replaced by their values. Operators and functions of only constants
+    are folded, with perf's semantics, and if-else with a constant
+    condition is replaced by the taken branch, dropping the events only
+    the other branch needed.
+    """
+    raise NotImplementedError()
+
+  def Intern(self, table: 'InternTable') -> 'Expression':
+    """Returns the table's shared instance of an expression equal to self."""
+    raise NotImplementedError()
+
+  def Leaves(self) -> FrozenSet['Expression']:
+    """Returns the events, constants and literals within the expression."""
+    raise NotImplementedError()
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    """Returns python source computing the expression's value.
+
+    The source reads event counts from 'c' and runtime literals from
+    'l', by name or, with an event_index, by position. See Compile. A
+    vector source computes with NumPy arrays of counts, keyed by name,
+    so operators are element-wise and if-else selects per element.
+    """
+    raise NotImplementedError()
+
+  def Compile(self, events: Optional[Sequence[str]] = None
+              ) -> Callable[..., float]:
+    """Returns a function computing the expression's value.
+
+    The expression is translated to python once and compiled to a code
+    object, avoiding walking the tree on every evaluation. The function
+    takes the event counts and optionally a mapping from runtime
+    literals, like '#SMT_on' or '#num_dies', to their values. Counts
+    are a mapping from the event names, as written in perf json, or
+    when events is given a sequence of counts ordered like events. Tool
+    events like duration_time are counts.
+
+    Evaluation follows perf: division or modulo by zero gives NaN,
+    d_ratio by zero gives 0, min and max give their second argument
+    unless the first compares less or greater, so only a NaN second
+    argument gives NaN, comparisons and logical operators give 1
+    or 0 and only the taken side of an if-else is evaluated. has_event
+    is 1 when the event's count is present and not NaN. A missing count
+    raises KeyError when it is evaluated. source_count
+    of an event is the literal 'source_count(event)', defaulting to 1.
+
+    Args:
+      events (Sequence[str]): names of events in the order of counts.
+    Returns:
+      Callable: function of counts and literals returning a float.
+    """
+    event_index = None
+    if events is not None:
+      event_index = {name: i for i, name in enumerate(events)}
+    source = self.ToEvalPython(event_index)
+    code = compile(f'lambda c, l=_no_literals: {source}', '<metric>', 'eval')
+    return eval(code, dict(_EVAL_GLOBALS))  # pylint: disable=eval-used
+
   def __str__(self) -> str:
     return self.ToPerfJson()
 
+  def __eq__(self, other) -> bool:
+    return isinstance(other, Expression) and self.Equals(other)
+
+  def __hash__(self) -> int:
+    # A structural hash computed from the hashes of the children when
+    # the node is constructed.
+    return self._hash
+
   def __or__(self, other: Union[int, float, 'Expression']) -> 'Operator':
     return Operator('|', self, other)
 
@@ -87,6 +166,8 @@ def _Constify(val: Union[bool, int, float, Expression]) -> Expression:
     return Constant(1 if val else 0)
   if isinstance(val, (int, float)):
     return Constant(val)
+  if isinstance(val, decimal.Decimal):
+    return Constant(str(val))
   return val
 
 
@@ -117,6 +198,8 @@ class Operator(Expression):
     self.operator = operator
     self.lhs = _Constify(lhs)
     self.rhs = _Constify(rhs)
+    self._hash = hash((Operator, self.operator, self.lhs, self.rhs))
+    self._leaves = None
 
   def Bracket(self,
               other: Expression,
@@ -159,38 +242,28 @@ class Operator(Expression):
             f'{self.Bracket(self.rhs, self.rhs.ToPython(), True)}')
 
   def Simplify(self) -> Expression:
-    lhs = self.lhs.Simplify()
-    rhs = self.rhs.Simplify()
-    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
-      return Constant(ast.literal_eval(lhs + self.operator + rhs))
-
-    if isinstance(self.lhs, Constant):
-      if self.operator in ('+', '|') and lhs.value == '0':
-        return rhs
-
-      # Simplify multiplication by 0 except for the slot event which
-      # is deliberately introduced using this pattern.
-      if self.operator == '*' and lhs.value == '0' and (
-          not isinstance(rhs, Event) or 'slots' not in rhs.name.lower()):
-        return Constant(0)
-
-      if self.operator == '*' and lhs.value == '1':
-        return rhs
-
-    if isinstance(rhs, Constant):
-      if self.operator in ('+', '|') and rhs.value == '0':
-        return lhs
-
-      if self.operator == '*' and rhs.value == '0':
-        return Constant(0)
-
-      if self.operator == '*' and self.rhs.value == '1':
-        return lhs
-
-    return Operator(self.operator, lhs, rhs)
+    """Returns a simplified and normalized version of self.
+
+    Chains of '&' or '|' are flattened and their operands sorted, so that
+    equal metrics written differently give the same expression. Sums and
+    products keep their order of operations, so that they evaluate the
+    same, and only the operands of each '+' and '*' are sorted.
+    Expressions perf computes as NaN, like a division by a zero count,
+    stay NaN.
+    """
+    e = Operator(self.operator, self.lhs.Simplify(), self.rhs.Simplify())
+    if self.operator in ('+', '-'):
+      return _SimplifySum(e)
+    if self.operator in ('*', '/'):
+      return _SimplifyProduct(e)
+    if self.operator in ('&', '|'):
+      return _SimplifyLogical(e)
+    return _FoldConstants(e)
 
   def Equals(self, other: Expression) -> bool:
-    if isinstance(other, Operator):
+    if self is other:
+      return True
+    if isinstance(other, Operator) and self._hash == other._hash:
       return self.operator == other.operator and self.lhs.Equals(
           other.lhs) and self.rhs.Equals(other.rhs)
     return False
@@ -202,8 +275,49 @@ class Operator(Expression):
     rhs = None
     if self.rhs:
       rhs = self.rhs.Substitute(name, expression)
+    if lhs is self.lhs and rhs is self.rhs:
+      return self
     return Operator(self.operator, lhs, rhs)
 
+  def Specialize(self, literals: Dict[str, float]) -> Expression:
+    return _FoldConstants(Operator(self.operator, self.lhs.Specialize(literals),
+                                   self.rhs.Specialize(literals)))
+
+  def Leaves(self) -> FrozenSet[Expression]:
+    if self._leaves is None:
+      self._leaves = self.lhs.Leaves() | self.rhs.Leaves()
+    return self._leaves
+
+  def Intern(self, table: 'InternTable') -> Expression:
+    lhs = self.lhs.Intern(table)
+    rhs = self.rhs.Intern(table)
+    if lhs is self.lhs and rhs is self.rhs:
+      return table.Lookup(self)
+    return table.Lookup(Operator(self.operator, lhs, rhs))
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    lhs = self.lhs.ToEvalPython(event_index, vector)
+    rhs = self.rhs.ToEvalPython(event_index, vector)
+    if self.operator in ('+', '-', '*'):
+      return f'({lhs} {self.operator} {rhs})'
+    if vector:
+      return f'{_VECTOR_OPERATORS[self.operator]}({lhs}, {rhs})'
+    if self.operator == '/':
+      # Avoid calling _div when the divisor needn't be checked or
+      # checking it doesn't compute it twice.
+      if isinstance(self.rhs, Constant) and float(self.rhs.value) != 0:
+        return f'({lhs} / {rhs})'
+      if isinstance(self.rhs, _Variable):
+        return f'({lhs} / {rhs} if {rhs} else _nan)'
+    if self.operator in ('<', '>'):
+      return f'(1.0 if {lhs} {self.operator} {rhs} else 0.0)'
+    if self.operator == '|':
+      return f'(1.0 if {lhs} or {rhs} else 0.0)'
+    if self.operator == '&':
+      return f'(1.0 if {lhs} and {rhs} else 0.0)'
+    return f'{_EVAL_OPERATORS[self.operator]}({lhs}, {rhs})'
+
 
 class Select(Expression):
   """Represents a select ternary in the parse tree."""
@@ -214,6 +328,8 @@ class Select(Expression):
     self.true_val = _Constify(true_val)
     self.cond = _Constify(cond)
     self.false_val = _Constify(false_val)
+    self._hash = hash((Select, self.true_val, self.cond, self.false_val))
+    self._leaves = None
 
   def ToPerfJson(self):
     true_str = self.true_val.ToPerfJson()
@@ -238,7 +354,9 @@ class Select(Expression):
     return Select(true_val, cond, false_val)
 
   def Equals(self, other: Expression) -> bool:
-    if isinstance(other, Select):
+    if self is other:
+      return True
+    if isinstance(other, Select) and self._hash == other._hash:
       return self.cond.Equals(other.cond) and self.false_val.Equals(
           other.false_val) and self.true_val.Equals(other.true_val)
     return False
@@ -249,8 +367,46 @@ class Select(Expression):
     true_val = self.true_val.Substitute(name, expression)
     cond = self.cond.Substitute(name, expression)
     false_val = self.false_val.Substitute(name, expression)
+    if (true_val is self.true_val and cond is self.cond and
+        false_val is self.false_val):
+      return self
     return Select(true_val, cond, false_val)
 
+  def Specialize(self, literals: Dict[str, float]) -> Expression:
+    cond = self.cond.Specialize(literals)
+    if isinstance(cond, Constant):
+      live = self.false_val if float(cond.value) == 0 else self.true_val
+      return live.Specialize(literals)
+    return Select(self.true_val.Specialize(literals), cond,
+                  self.false_val.Specialize(literals))
+
+  def Leaves(self) -> FrozenSet[Expression]:
+    if self._leaves is None:
+      self._leaves = (self.true_val.Leaves() | self.cond.Leaves() |
+                      self.false_val.Leaves())
+    return self._leaves
+
+  def Intern(self, table: 'InternTable') -> Expression:
+    true_val = self.true_val.Intern(table)
+    cond = self.cond.Intern(table)
+    false_val = self.false_val.Intern(table)
+    if (true_val is self.true_val and cond is self.cond and
+        false_val is self.false_val):
+      return table.Lookup(self)
+    return table.Lookup(Select(true_val, cond, false_val))
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    if vector:
+      # The branches are thunks so that a condition that isn't an
+      # array, like one of runtime literals, evaluates only one.
+      return (f'_select({self.cond.ToEvalPython(event_index, vector)}, '
+              f'lambda: {self.true_val.ToEvalPython(event_index, vector)}, '
+              f'lambda: {self.false_val.ToEvalPython(event_index, vector)})')
+    return (f'({self.true_val.ToEvalPython(event_index, vector)} '
+            f'if {self.cond.ToEvalPython(event_index, vector)} '
+            f'else {self.false_val.ToEvalPython(event_index, vector)})')
+
 
 class Function(Expression):
   """A function in an expression like min, max, d_ratio."""
@@ -262,6 +418,8 @@ class Function(Expression):
     self.fn = fn
     self.lhs = _Constify(lhs)
     self.rhs = _Constify(rhs)
+    self._hash = hash((Function, self.fn, self.lhs, self.rhs))
+    self._leaves = None
 
   def ToPerfJson(self):
     if self.rhs:
@@ -276,20 +434,17 @@ class Function(Expression):
   def Simplify(self) -> Expression:
     lhs = self.lhs.Simplify()
     rhs = self.rhs.Simplify() if self.rhs else None
-    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
-      if self.fn == 'd_ratio':
-        if rhs.value == '0':
-          return Constant(0)
-        Constant(ast.literal_eval(f'{lhs} / {rhs}'))
-      return Constant(ast.literal_eval(f'{self.fn}({lhs}, {rhs})'))
-
-    return Function(self.fn, lhs, rhs)
+    return _FoldConstants(Function(self.fn, lhs, rhs))
 
   def Equals(self, other: Expression) -> bool:
-    if isinstance(other, Function):
+    if self is other:
+      return True
+    if isinstance(other, Function) and self._hash == other._hash:
       result = self.fn == other.fn and self.lhs.Equals(other.lhs)
       if self.rhs:
         result = result and self.rhs.Equals(other.rhs)
+      else:
+        result = result and other.rhs is None
       return result
     return False
 
@@ -300,8 +455,49 @@ class Function(Expression):
     rhs = None
     if self.rhs:
       rhs = self.rhs.Substitute(name, expression)
+    if lhs is self.lhs and rhs is self.rhs:
+      return self
     return Function(self.fn, lhs, rhs)
 
+  def Specialize(self, literals: Dict[str, float]) -> Expression:
+    if self.fn == 'source_count':
+      value = _LookupLiteral(f'source_count({self.lhs.ToPerfJson()})', literals)
+      return self if value is None else Constant(value)
+    if self.fn == 'has_event':
+      return self
+    return _FoldConstants(Function(self.fn, self.lhs.Specialize(literals),
+                                   self.rhs.Specialize(literals) if self.rhs else None))
+
+  def Leaves(self) -> FrozenSet[Expression]:
+    if self._leaves is None:
+      self._leaves = self.lhs.Leaves()
+      if self.rhs:
+        self._leaves = self._leaves | self.rhs.Leaves()
+    return self._leaves
+
+  def Intern(self, table: 'InternTable') -> Expression:
+    lhs = self.lhs.Intern(table)
+    rhs = self.rhs.Intern(table) if self.rhs else None
+    if lhs is self.lhs and rhs is self.rhs:
+      return table.Lookup(self)
+    return table.Lookup(Function(self.fn, lhs, rhs))
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    if self.fn in ('has_event', 'source_count'):
+      if not isinstance(self.lhs, Event):
+        raise ValueError(f'{self.fn} of non-event {self.lhs.ToPerfJson()}')
+      name = self.lhs.ToPerfJson()
+      if self.fn == 'source_count':
+        return f'l.get({f"source_count({name})"!r}, 1.0)'
+      if event_index is None:
+        return f'(1.0 if {name!r} in c else 0.0)'
+      if name not in event_index:
+        return '0.0'
+      return f'_has_event(c[{event_index[name]}])'
+    return (f'_{self.fn}({self.lhs.ToEvalPython(event_index, vector)}, '
+            f'{self.rhs.ToEvalPython(event_index, vector)})')
+
 
 def _FixEscapes(s: str) -> str:
   s = re.sub(r'([^\\]),', r'\1\\,', s)
@@ -314,6 +510,7 @@ class Event(Expression):
   def __init__(self, name: str, legacy_name: str = ''):
     self.name = _FixEscapes(name)
     self.legacy_name = _FixEscapes(legacy_name)
+    self._hash = hash((Event, self.name))
 
   def ToPerfJson(self):
     result = re.sub('/', '@', self.name)
@@ -331,6 +528,25 @@ class Event(Expression):
   def Substitute(self, name: str, expression: Expression) -> Expression:
     return self
 
+  def Specialize(self, literals: Dict[str, float]) -> Expression:
+    return self
+
+  def Intern(self, table: 'InternTable') -> Expression:
+    return table.Lookup(self)
+
+  def Leaves(self) -> FrozenSet[Expression]:
+    return frozenset([self])
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    name = self.ToPerfJson()
+    if event_index is None:
+      return f'c[{name!r}]'
+    if name not in event_index:
+      # Like a missing key, only an error if evaluated.
+      return f'_missing_event({name!r})'
+    return f'c[{event_index[name]}]'
+
 
 class Constant(Expression):
   """A constant within the expression tree."""
@@ -342,6 +558,7 @@ class Constant(Expression):
     self.value = dec.normalize().to_eng_string()
     self.value = self.value.replace('+', '')
     self.value = self.value.replace('E', 'e')
+    self._hash = hash((Constant, self.value))
 
   def ToPerfJson(self):
     return self.value
@@ -358,12 +575,26 @@ class Constant(Expression):
   def Substitute(self, name: str, expression: Expression) -> Expression:
     return self
 
+  def Specialize(self, literals: Dict[str, float]) -> Expression:
+    return self
+
+  def Intern(self, table: 'InternTable') -> Expression:
+    return table.Lookup(self)
+
+  def Leaves(self) -> FrozenSet[Expression]:
+    return frozenset([self])
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    return f'({float(self.value)!r})'
+
 
 class Literal(Expression):
   """A runtime literal within the expression tree."""
 
   def __init__(self, value: str):
     self.value = value
+    self._hash = hash((Literal, self.value))
 
   def ToPerfJson(self):
     return self.value
@@ -380,6 +611,424 @@ class Literal(Expression):
   def Substitute(self, name: str, expression: Expression) -> Expression:
     return self
 
+  def Specialize(self, literals: Dict[str, float]) -> Expression:
+    value = _LookupLiteral(self.value, literals)
+    return self if value is None else Constant(value)
+
+  def Intern(self, table: 'InternTable') -> Expression:
+    return table.Lookup(self)
+
+  def Leaves(self) -> FrozenSet[Expression]:
+    return frozenset([self])
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    return f'l[{self.value!r}]'
+
+
+def _LookupLiteral(name: str, literals: Dict[str, float]) -> Optional[float]:
+  """The value of a literal, ignoring case as perf does, or None."""
+  if name in literals:
+    return literals[name]
+  for (key, value) in literals.items():
+    if key.lower() == name.lower():
+      return value
+  return None
+
+
+# Arithmetic on the values of Constants.
+_EXACT_OPERATIONS = {
+    '+': decimal.Context.add,
+    '-': decimal.Context.subtract,
+    '*': decimal.Context.multiply,
+    '/': decimal.Context.divide,
+}
+
+
+def _ExactDecimal(operator: str, lhs: decimal.Decimal,
+                  rhs: decimal.Decimal) -> Optional[decimal.Decimal]:
+  """lhs operator rhs if a Constant can hold it exactly, else None."""
+  ctx = decimal.Context(prec=20, traps=[decimal.Inexact, decimal.DivisionByZero,
+                                        decimal.InvalidOperation])
+  try:
+    return _EXACT_OPERATIONS[operator](ctx, lhs, rhs)
+  except decimal.DecimalException:
+    return None
+
+
+def _FoldConstants(e: Union[Operator, Function]) -> Expression:
+  """Returns a constant for e if its operands are constants, else e.
+
+  Arithmetic is folded only when exact. Negative values are never
+  folded as perf's expressions have no negative constants, nor are
+  values perf computes as NaN.
+  """
+  if not isinstance(e.lhs, Constant) or (e.rhs and not isinstance(e.rhs, Constant)):
+    return e
+  if isinstance(e, Function):
+    if e.fn not in ('d_ratio', 'min', 'max'):
+      return e
+    if e.fn == 'd_ratio' and float(e.rhs.value) == 0:
+      return Constant(0)
+  op = e.operator if isinstance(e, Operator) else e.fn
+  lhs = decimal.Decimal(e.lhs.value)
+  rhs = decimal.Decimal(e.rhs.value)
+  if op in _EXACT_OPERATIONS or op == 'd_ratio':
+    value = _ExactDecimal('/' if op == 'd_ratio' else op, lhs, rhs)
+    return e if value is None or value < 0 else Constant(str(value))
+  if op in ('min', 'max'):
+    return e.lhs if (lhs <= rhs) == (op == 'min') else e.rhs
+  if op in ('<', '>'):
+    return Constant(1 if (lhs < rhs if op == '<' else lhs > rhs) else 0)
+  value = e.Compile()({})
+  return e if math.isnan(value) or value < 0 else Constant(value)
+
+
+def _SortKey(e: Expression) -> Tuple[bool, str]:
+  """Orders operands of commutative operators, constants last."""
+  return (isinstance(e, Constant), e.ToPerfJson())
+
+
+def _IsSlots(e: Expression) -> bool:
+  """Is e a slots event, multiplied by 0 to add it to a metric's group?"""
+  return isinstance(e, Event) and 'slots' in e.name.lower()
+
+
+def _MayBeNaN(e: Expression) -> bool:
+  """Might perf compute e as NaN, such as by dividing by zero?"""
+  if isinstance(e, Operator):
+    if e.operator in ('/', '%'):
+      return True
+    if e.operator in ('+', '-', '*'):
+      return _MayBeNaN(e.lhs) or _MayBeNaN(e.rhs)
+    # Comparisons and logical operators are 1 or 0.
+    return False
+  if isinstance(e, Function):
+    if e.fn in ('d_ratio', 'min', 'max'):
+      return _MayBeNaN(e.lhs) or _MayBeNaN(e.rhs)
+    return False
+  if isinstance(e, Select):
+    return _MayBeNaN(e.true_val) or _MayBeNaN(e.false_val)
+  return False
+
+
+def _SimplifyProduct(e: Operator) -> Expression:
+  """Removes a factor of 1 from a '*' or '/' and sorts the operands of '*'.
+
+  Like sums, products keep their order of operations: '(a / (a + b)) *
+  c' is exactly c when b is 0, while 'a * c / (a + b)' needn't be. A
+  product with a factor of 0 is 0, unless the other factor may be NaN
+  or is a slots event, multiplied by 0 to add it to the metric's group.
+  """
+  folded = _FoldConstants(e)
+  if folded is not e:
+    return folded
+  lhs, rhs = e.lhs, e.rhs
+  if _IsOne(rhs):
+    return lhs
+  if e.operator == '/':
+    return e
+  if _IsOne(lhs):
+    return rhs
+  for (zero, other) in ((lhs, rhs), (rhs, lhs)):
+    if _IsZero(zero) and not _IsSlots(other) and not _MayBeNaN(other):
+      return Constant(0)
+  # Constant coefficients first.
+  if (not isinstance(rhs, Constant), rhs.ToPerfJson()) < \
+     (not isinstance(lhs, Constant), lhs.ToPerfJson()):
+    return Operator('*', rhs, lhs)
+  return e
+
+
+def _IsOne(e: Expression) -> bool:
+  return isinstance(e, Constant) and float(e.value) == 1
+
+
+def _IsZero(e: Expression) -> bool:
+  return isinstance(e, Constant) and float(e.value) == 0
+
+
+def _SimplifySum(e: Operator) -> Expression:
+  """Removes a term of 0 from a '+' or '-' and sorts the operands of '+'.
+
+  Terms aren't regrouped, reordered or combined as floating point
+  addition isn't associative: '1 - (a + b + c)' is exactly 0 when a + b
+  + c is 1, while '1 - a - b - c' needn't be. Only rewrites giving the
+  same value are made.
+  """
+  folded = _FoldConstants(e)
+  if folded is not e:
+    return folded
+  lhs, rhs = e.lhs, e.rhs
+  if _IsZero(rhs):
+    return lhs
+  if e.operator == '-':
+    return e
+  if _IsZero(lhs):
+    return rhs
+  if _SortKey(rhs) < _SortKey(lhs):
+    return Operator('+', rhs, lhs)
+  return e
+
+
+def _SimplifyLogical(e: Operator) -> Expression:
+  """Removes repeated and constant operands of a chain of '&' or '|'."""
+  operands: List[Expression] = []
+
+  def Flatten(x: Expression) -> None:
+    if isinstance(x, Operator) and x.operator == e.operator:
+      Flatten(x.lhs)
+      Flatten(x.rhs)
+    elif x not in operands:
+      operands.append(x)
+
+  Flatten(e)
+  constants = [float(x.value) for x in operands if isinstance(x, Constant)]
+  if e.operator == '&' and 0 in constants:
+    return Constant(0)
+  if e.operator == '|':
+    if any(constants):
+      return Constant(1)
+    operands = [x for x in operands if not isinstance(x, Constant)]
+    if not operands:
+      return Constant(0)
+  return functools.reduce(lambda lhs, rhs: Operator(e.operator, lhs, rhs),
+                          sorted(operands, key=_SortKey))
+
+
+class InternTable:
+  """Hash-consing table of expressions.
+
+  Interning an expression returns a tree in which every subtree equal
+  to one previously interned is the same object. Shared subtrees
+  reduce memory and make comparing them an identity check.
+  """
+
+  def __init__(self):
+    self._table: Dict[Expression, Expression] = {}
+
+  def Lookup(self, expression: Expression) -> Expression:
+    """Returns the shared instance of expression, adding it if new.
+
+    The children of expression are expected to already be interned.
+    """
+    return self._table.setdefault(expression, expression)
+
+  def __len__(self) -> int:
+    return len(self._table)
+
+
+def _EvalDiv(lhs: float, rhs: float) -> float:
+  return lhs / rhs if rhs else math.nan
+
+
+def _EvalMod(lhs: float, rhs: float) -> float:
+  # The operands are truncated to integers, which non-finite ones have
+  # no value as.
+  if not math.isfinite(lhs) or not math.isfinite(rhs) or not int(rhs):
+    return math.nan
+  # Like C the result has the sign of lhs.
+  return math.fmod(int(lhs), int(rhs))
+
+
+def _EvalXor(lhs: float, rhs: float) -> float:
+  return 1.0 if bool(lhs) != bool(rhs) else 0.0
+
+
+def _EvalMin(lhs: float, rhs: float) -> float:
+  # Like perf, rhs unless lhs is less, so min(NaN, x) is x but min(x,
+  # NaN) is NaN.
+  return lhs if lhs < rhs else rhs
+
+
+def _EvalMax(lhs: float, rhs: float) -> float:
+  return lhs if lhs > rhs else rhs
+
+
+def _EvalDRatio(lhs: float, rhs: float) -> float:
+  return lhs / rhs if rhs else 0.0
+
+
+def _EvalHasEvent(count: Optional[float]) -> float:
+  return 0.0 if count is None or math.isnan(count) else 1.0
+
+
+def _EvalMissingEvent(name: str) -> float:
+  raise KeyError(name)
+
+
+# Operators evaluated by functions in compiled expressions.
+_EVAL_OPERATORS = {
+    '/': '_div',
+    '%': '_mod',
+    '^': '_xor',
+}
+
+# The only globals available to compiled expressions.
+_EVAL_GLOBALS = {
+    '__builtins__': {},
+    '_no_literals': types.MappingProxyType({}),
+    '_nan': math.nan,
+    '_div': _EvalDiv,
+    '_mod': _EvalMod,
+    '_xor': _EvalXor,
+    '_min': _EvalMin,
+    '_max': _EvalMax,
+    '_d_ratio': _EvalDRatio,
+    '_has_event': _EvalHasEvent,
+    '_missing_event': _EvalMissingEvent,
+}
+
+
+def _VectorSelect(cond, true_fn: Callable[[], object],
+                  false_fn: Callable[[], object]):
+  if numpy.ndim(cond) == 0:
+    return true_fn() if cond else false_fn()
+  return numpy.where(cond, true_fn(), false_fn())
+
+
+def _VectorDiv(lhs, rhs):
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    return numpy.where(numpy.equal(rhs, 0), numpy.nan,
+                       numpy.true_divide(lhs, rhs))
+
+
+def _VectorMod(lhs, rhs):
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    return numpy.where(numpy.isfinite(lhs) & numpy.isfinite(rhs) &
+                       numpy.not_equal(numpy.trunc(rhs), 0),
+                       numpy.fmod(numpy.trunc(lhs), numpy.trunc(rhs)), numpy.nan)
+
+
+def _VectorMin(lhs, rhs):
+  return numpy.where(numpy.less(lhs, rhs), lhs, rhs)
+
+
+def _VectorMax(lhs, rhs):
+  return numpy.where(numpy.greater(lhs, rhs), lhs, rhs)
+
+
+def _VectorDRatio(lhs, rhs):
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    return numpy.where(numpy.equal(rhs, 0), 0.0, numpy.true_divide(lhs, rhs))
+
+
+def _VectorPredicate(fn: Callable[[object, object], object]
+                     ) -> Callable[[object, object], object]:
+  """Wraps a NumPy predicate to give 1.0 or 0.0 like perf."""
+  return lambda lhs, rhs: numpy.where(fn(lhs, rhs), 1.0, 0.0)
+
+
+# Operators evaluated by functions in vector compiled expressions.
+_VECTOR_OPERATORS = {
+    '<': '_lt',
+    '>': '_gt',
+    '|': '_or',
+    '&': '_and',
+    '^': '_xor',
+    '/': '_div',
+    '%': '_mod',
+}
+
+# The only globals available to vector compiled expressions.
+_VECTOR_GLOBALS = None
+if numpy is not None:
+  _VECTOR_GLOBALS = {
+      '__builtins__': {},
+      '_no_literals': types.MappingProxyType({}),
+      '_select': _VectorSelect,
+      '_lt': _VectorPredicate(numpy.less),
+      '_gt': _VectorPredicate(numpy.greater),
+      '_or': _VectorPredicate(numpy.logical_or),
+      '_and': _VectorPredicate(numpy.logical_and),
+      '_xor': _VectorPredicate(numpy.logical_xor),
+      '_div': _VectorDiv,
+      '_mod': _VectorMod,
+      '_min': _VectorMin,
+      '_max': _VectorMax,
+      '_d_ratio': _VectorDRatio,
+  }
+
+
+class BatchEvaluator:
+  """Evaluates many metrics over columns of event counts.
+
+  Each column holds the counts of an event, as named in perf json, with
+  a row per interval or CPU. With NumPy every metric is computed with
+  whole column operations in one pass: if-else becomes where, min and
+  max are element-wise and divisions are safe, following the perf
+  semantics of Expression.Compile. Without NumPy the metrics are
+  computed row by row with a function from Expression.Compile.
+  """
+
+  def __init__(self, metrics: Dict[str, Expression],
+               use_numpy: Optional[bool] = None):
+    """Compiles the metrics.
+
+    Args:
+      metrics (Dict): mapping from metric name to expression.
+      use_numpy (bool): whether to use NumPy, by default when installed.
+    """
+    self.names = list(metrics.keys())
+    self.expressions = list(metrics.values())
+    self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+    if self.use_numpy and numpy is None:
+      raise ImportError('BatchEvaluator requires NumPy')
+    self._vector_fn = None
+    self._row_fns: Dict[Tuple[str, ...], Callable[..., Tuple[float, ...]]] = {}
+    if self.use_numpy:
+      source = ', '.join(e.ToEvalPython(None, vector=True)
+                         for e in self.expressions)
+      code = compile(f'lambda c, l=_no_literals: ({source},)', '<metrics>',
+                     'eval')
+      self._vector_fn = eval(code, dict(_VECTOR_GLOBALS))  # pylint: disable=eval-used
+
+  def _RowFunction(self, events: Tuple[str, ...]
+                   ) -> Callable[..., Tuple[float, ...]]:
+    """Returns a function computing every metric from a row of counts."""
+    if events not in self._row_fns:
+      event_index = {name: i for i, name in enumerate(events)}
+      source = ', '.join(e.ToEvalPython(event_index) for e in self.expressions)
+      code = compile(f'lambda c, l=_no_literals: ({source},)', '<metrics>',
+                     'eval')
+      self._row_fns[events] = eval(code, dict(_EVAL_GLOBALS))  # pylint: disable=eval-used
+    return self._row_fns[events]
+
+  def Evaluate(self, columns: Dict[str, Sequence[float]],
+               literals: Optional[Dict[str, float]] = None
+               ) -> Dict[str, Sequence[float]]:
+    """Computes every metric for every row.
+
+    Args:
+      columns (Dict): mapping from event name to its counts, all of the
+        same length.
+      literals (Dict): values of runtime literals like '#SMT_on'.
+    Returns:
+      Dict: mapping from metric name to its values, a NumPy array when
+        using NumPy and otherwise a list.
+    """
+    literals = literals if literals is not None else {}
+    if not self.names:
+      return {}
+    if self.use_numpy:
+      arrays = {name: numpy.asarray(counts, dtype=numpy.float64)
+                for (name, counts) in columns.items()}
+      rows = len(next(iter(arrays.values()))) if arrays else 1
+      values = {}
+      for (name, result) in zip(self.names, self._vector_fn(arrays, literals)):
+        if numpy.ndim(result) == 0:
+          # Metrics of only constants and literals have a single value.
+          result = numpy.full(rows, result, dtype=numpy.float64)
+        values[name] = result
+      return values
+    events = tuple(columns.keys())
+    fn = self._RowFunction(events)
+    if events:
+      results = [fn(row, literals) for row in zip(*columns.values())]
+    else:
+      results = [fn((), literals)]
+    return dict(zip(self.names, map(list, zip(*results))))
+
 
 def min(lhs: Union[int, float, Expression], rhs: Union[int, float,
                                                        Expression]) -> Function:
@@ -514,28 +1163,171 @@ class MetricGroup:
     return self.ToPerfJson()
 
 
-class _RewriteIfExpToSelect(ast.NodeTransformer):
-  """Transformer to convert if-else nodes to Select expressions."""
+# Tokens of a perf json metric expression. Event names start with a
+# letter and continue until an operator, space, bracket or comma,
+# unless the character is escaped with a backslash like
+# 'topdown\-fe\-bound' or 'arb@event\=0x81\,umask\=0x1@'.
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)|
+    (?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)|
+    (?P<literal>\#[a-zA-Z][^-+/*\s\\(),]*(?:\\.[^-+/*\s\\(),]*)*)|
+    (?P<name>[a-zA-Z][^-+/*\s\\(),]*(?:\\.[^-+/*\s\\(),]*)*)|
+    (?P<punctuation>[()<>|^&+\-*/%,])
+""", re.VERBOSE)
+
+# Functions with the number of arguments they take.
+_FUNCTIONS = {
+    'd_ratio': 2,
+    'has_event': 1,
+    'max': 2,
+    'min': 2,
+    'source_count': 1,
+}
+
+def _ParsedOperation(op: str, lhs: Union[decimal.Decimal, Expression],
+                     rhs: Union[decimal.Decimal, Expression]
+                     ) -> Union[decimal.Decimal, Expression]:
+  """lhs op rhs, folded when both are numbers and the result is exact."""
+  if isinstance(lhs, decimal.Decimal) and isinstance(rhs, decimal.Decimal):
+    if op in _EXACT_OPERATIONS:
+      value = _ExactDecimal(op, lhs, rhs)
+      if value is not None:
+        return value
+    else:
+      folded = _FoldConstants(Operator(op, lhs, rhs))
+      if isinstance(folded, Constant):
+        return decimal.Decimal(folded.value)
+  return Operator(op, lhs, rhs)
+
+
+class _PerfJsonParser:
+  """Precedence climbing parser of perf json metric expressions.
+
+  The grammar matches that of perf's expr.y:
+
+    if_expr: expr 'if' expr 'else' if_expr | expr
+    expr: NUMBER | EVENT | '#' LITERAL | '-' expr | '(' if_expr ')'
+        | min '(' if_expr ',' if_expr ')' | max '(' if_expr ',' if_expr ')'
+        | d_ratio '(' if_expr ',' if_expr ')'
+        | source_count '(' EVENT ')' | has_event '(' EVENT ')'
+        | expr BINARY_OP expr
+
+  with binary operators being left associative and having the
+  precedences in _PRECEDENCE.
+  """
+
+  def __init__(self, orig: str):
+    self.orig = orig
+    # Workaround Valkyrie perf json metric bug.
+    text = orig.strip().replace('#( ', '(')
+    self.tokens: List[Tuple[str, str]] = []
+    pos = 0
+    while pos < len(text):
+      m = _TOKEN_RE.match(text, pos)
+      if not m:
+        self.Error(f'unexpected character {text[pos]!r}')
+      if m.lastgroup != 'space':
+        self.tokens.append((m.lastgroup, m.group(0)))
+      pos = m.end()
+    self.pos = 0
+
+  def Error(self, message: str):
+    raise SyntaxError(f'Parsing expression:\n{self.orig}\n{message}')
+
+  def Peek(self) -> Optional[str]:
+    """Returns the text of the next token or None at the end."""
+    return self.tokens[self.pos][1] if self.pos < len(self.tokens) else None
+
+  def Next(self) -> Tuple[str, str]:
+    if self.pos >= len(self.tokens):
+      self.Error('unexpected end of expression')
+    token = self.tokens[self.pos]
+    self.pos += 1
+    return token
+
+  def Expect(self, text: str):
+    _, got = self.Next()
+    if got != text:
+      self.Error(f'expected {text!r} but found {got!r}')
+
+  def Parse(self) -> Expression:
+    result = self.ParseIfExpr()
+    if self.pos != len(self.tokens):
+      self.Error(f'unexpected {self.Peek()!r}')
+    return _Constify(result)
+
+  def ParseIfExpr(self) -> Union[decimal.Decimal, Expression]:
+    true_val = self.ParseBinary(0)
+    if self.Peek() != 'if':
+      return true_val
+    self.Next()
+    cond = self.ParseBinary(0)
+    self.Expect('else')
+    false_val = self.ParseIfExpr()
+    return Select(true_val, cond, false_val)
+
+  def ParseBinary(self, min_precedence: int) -> Union[decimal.Decimal, Expression]:
+    lhs = self.ParseUnary()
+    while True:
+      op = self.Peek()
+      if op not in _PRECEDENCE or _PRECEDENCE[op] < min_precedence:
+        return lhs
+      self.Next()
+      rhs = self.ParseBinary(_PRECEDENCE[op] + 1)
+      lhs = _ParsedOperation(op, lhs, rhs)
+
+  def ParseUnary(self) -> Union[decimal.Decimal, Expression]:
+    if self.Peek() != '-':
+      return self.ParsePrimary()
+    self.Next()
+    operand = self.ParseUnary()
+    if isinstance(operand, decimal.Decimal):
+      return -operand
+    return Operator('-', 0, operand)
+
+  def ParsePrimary(self) -> Union[decimal.Decimal, Expression]:
+    kind, text = self.Next()
+    if kind == 'number':
+      return decimal.Decimal(text)
+    if kind == 'literal':
+      return Literal(text)
+    if kind == 'name':
+      if text in _FUNCTIONS:
+        self.Expect('(')
+        args = [self.ParseIfExpr()]
+        while self.Peek() == ',':
+          self.Next()
+          args.append(self.ParseIfExpr())
+        self.Expect(')')
+        if len(args) != _FUNCTIONS[text]:
+          self.Error(f'{text} expects {_FUNCTIONS[text]} arguments but has {len(args)}')
+        return Function(text, *args)
+      if text in ('if', 'else'):
+        self.Error(f'unexpected {text!r}')
+      return Event(text)
+    if text == '(':
+      result = self.ParseIfExpr()
+      self.Expect(')')
+      return result
+    self.Error(f'unexpected {text!r}')
+
 
-  def visit_IfExp(self, node):
-    # pylint: disable=invalid-name
-    self.generic_visit(node)
-    call = ast.Call(
-        func=ast.Name(id='Select', ctx=ast.Load()),
-        args=[node.body, node.test, node.orelse],
-        keywords=[])
-    ast.copy_location(call, node.test)
-    return call
+# Maximum number of parsed expressions held by ParsePerfJson's cache.
+_PARSE_CACHE_SIZE = 8192
 
 
+@functools.lru_cache(maxsize=_PARSE_CACHE_SIZE)
 def ParsePerfJson(orig: str) -> Expression:
-  """A simple json metric expression decoder.
+  """A json metric expression decoder.
 
-  Converts a json encoded metric expression by way of python's ast and
-  eval routine. First tokens are mapped to Event calls, then
-  accidentally converted keywords or literals are mapped to their
-  appropriate calls. Python's ast is used to match if-else that can't
-  be handled via operator overloading. Finally the ast is evaluated.
+  Tokenizes the json encoded metric expression and parses it with a
+  precedence climbing parser, building the Expression tree
+  directly. Operations whose operands are both numbers are folded into
+  a Constant.
+
+  Results are held in a process-wide, size bounded, least recently
+  used cache as the same formulas are parsed for many models. The
+  returned Expression may be shared and so must not be modified.
 
   Args:
     orig (str): String to parse.
@@ -543,25 +1335,17 @@ def ParsePerfJson(orig: str) -> Expression:
   Returns:
     Expression: The parsed string.
   """
-  # pylint: disable=eval-used
-  py = orig.strip()
-  py = re.sub(r'([a-zA-Z][^-+/\* \\\(\),]*(?:\\.[^-+/\* \\\(\),]*)*)',
-              r'Event(r"\1")', py)
-  py = re.sub(r'#Event\(r"([^"]*)"\)', r'Literal("#\1")', py)
-  py = re.sub(r'([0-9]+)Event\(r"(e[0-9]+)"\)', r'\1\2', py)
-  # Workaround Valkyrie perf json metric bug.
-  py = py.replace('#( ', '(')
-  keywords = ['if', 'else', 'min', 'max', 'd_ratio', 'source_count', 'has_event']
-  for kw in keywords:
-    py = re.sub(rf'Event\(r"{kw}"\)', kw, py)
+  return _PerfJsonParser(orig).Parse()
 
-  try:
-    parsed = ast.parse(py, mode='eval')
-  except SyntaxError as e:
-    raise SyntaxError(f'Parsing expression:\n{orig}') from e
-  _RewriteIfExpToSelect().visit(parsed)
-  parsed = ast.fix_missing_locations(parsed)
-  return _Constify(eval(compile(parsed, orig, 'eval')))
+
+def ParseCacheInfo() -> Tuple[int, int, int, int]:
+  """Returns the hits, misses, maximum size and size of the parse cache."""
+  return tuple(ParsePerfJson.cache_info())
+
+
+def ClearParseCache() -> None:
+  """Empties the parse cache and resets its statistics."""
+  ParsePerfJson.cache_clear()
 
 
 def RewriteMetricsInTermsOfOthers(metrics: list[Tuple[str, Expression]]
@@ -577,15 +1361,254 @@ def RewriteMetricsInTermsOfOthers(metrics: list[Tuple[str, Expression]]
   for outer_name, outer_expression in metrics:
     updated = outer_expression
     while True:
+      updated_leaves = updated.Leaves()
       for inner_name, inner_expression in metrics:
         if inner_name.lower() == outer_name.lower():
           continue
         if inner_name in updates:
           inner_expression = updates[inner_name]
-        updated = updated.Substitute(inner_name, inner_expression)
+        # An inner expression can only be a subtree of updated if
+        # all of its events, constants and literals are in updated.
+        if not inner_expression.Leaves() <= updated_leaves:
+          continue
+        substituted = updated.Substitute(inner_name, inner_expression)
+        if substituted is not updated:
+          updated = substituted
+          updated_leaves = updated.Leaves()
       if updated.Equals(outer_expression):
         break
       if outer_name in updates and updated.Equals(updates[outer_name]):
         break
       updates[outer_name] = updated
   return updates
+
+
+def RenameEvents(e: Expression, names: Dict[str, str]) -> Expression:
+  """Returns e with each event named in names renamed to its value."""
+  if isinstance(e, Event):
+    return Event(names[e.name]) if e.name in names else e
+  if not any(isinstance(leaf, Event) and leaf.name in names for leaf in e.Leaves()):
+    return e
+  if isinstance(e, Select):
+    return Select(RenameEvents(e.true_val, names), RenameEvents(e.cond, names),
+                  RenameEvents(e.false_val, names))
+  if isinstance(e, Operator):
+    return Operator(e.operator, RenameEvents(e.lhs, names), RenameEvents(e.rhs, names))
+  if isinstance(e, Function):
+    return Function(e.fn, RenameEvents(e.lhs, names),
+                    RenameEvents(e.rhs, names) if e.rhs else None)
+  return e
+
+
+def _LiveLeaves(e: Expression, literals: Dict[str, float]
+                ) -> FrozenSet[Expression]:
+  """The leaves of e not in if-else branches that literals exclude."""
+  if not literals or not any(isinstance(leaf, Literal) for leaf in e.Leaves()):
+    return e.Leaves()
+  if isinstance(e, Select):
+    cond_leaves = e.cond.Leaves()
+    values = {leaf.value: _LookupLiteral(leaf.value, literals)
+              for leaf in cond_leaves if isinstance(leaf, Literal)}
+    if all(isinstance(leaf, Constant) or
+           (isinstance(leaf, Literal) and values[leaf.value] is not None)
+           for leaf in cond_leaves):
+      live = e.true_val if e.cond.Compile()({}, values) else e.false_val
+      return cond_leaves | _LiveLeaves(live, literals)
+    return (_LiveLeaves(e.true_val, literals) | _LiveLeaves(e.cond, literals) |
+            _LiveLeaves(e.false_val, literals))
+  if isinstance(e, (Operator, Function)) and e.rhs:
+    return _LiveLeaves(e.lhs, literals) | _LiveLeaves(e.rhs, literals)
+  return e.Leaves()
+
+
+def MetricClosures(metrics: Dict[str, Expression],
+                   literals: Optional[Dict[str, float]] = None
+                   ) -> Dict[str, Tuple[FrozenSet[Expression], FrozenSet[str]]]:
+  """Follows the references between metrics.
+
+  Args:
+    metrics (Dict): mapping from metric name to expression, in which
+      events named like a metric, ignoring case, reference that metric.
+    literals (Dict): values of runtime literals, like '#SMT_on', known
+      ahead of time, whose names are matched ignoring case. if-else
+      branches they exclude are ignored.
+  Returns:
+    Dict: mapping from metric name to the events, constants and literals
+      of it and of the metrics it references, transitively, and the names
+      of those referenced metrics.
+  Raises:
+    ValueError: if metrics reference each other in a cycle.
+  """
+  by_lower_name = {name.lower(): name for name in metrics}
+  closures: Dict[str, Tuple[FrozenSet[Expression], FrozenSet[str]]] = {}
+  resolving: List[str] = []
+
+  def Closure(name: str) -> Tuple[FrozenSet[Expression], FrozenSet[str]]:
+    if name in closures:
+      return closures[name]
+    if name in resolving:
+      cycle = resolving[resolving.index(name):] + [name]
+      raise ValueError(f'Cycle in metric references: {" -> ".join(cycle)}')
+    resolving.append(name)
+    leaves = set()
+    references = set()
+    for leaf in _LiveLeaves(metrics[name], literals or {}):
+      if isinstance(leaf, Event) and leaf.name.lower() in by_lower_name:
+        reference = by_lower_name[leaf.name.lower()]
+        reference_leaves, reference_references = Closure(reference)
+        leaves.update(reference_leaves)
+        references.add(reference)
+        references.update(reference_references)
+      else:
+        leaves.add(leaf)
+    resolving.pop()
+    closures[name] = (frozenset(leaves), frozenset(references))
+    return closures[name]
+
+  for name in metrics:
+    Closure(name)
+  return closures
+
+
+class _Variable(Expression):
+  """A previously computed value standing in for a subtree of a MetricDag."""
+
+  def __init__(self, name: str):
+    self.name = name
+    self._hash = hash((_Variable, self.name))
+
+  def ToEvalPython(self, event_index: Optional[Dict[str, int]],
+                   vector: bool = False) -> str:
+    return self.name
+
+
+class MetricDag:
+  """The metrics of a perf json file as one directed acyclic graph.
+
+  Metrics that reference other metrics, like 'tma_info_thread_slots',
+  share the referenced metric's node and duplicate subtrees, within and
+  across metrics, are numbered as one value. The graph is compiled into
+  a single function in which each distinct node is computed once, in
+  dependency order, so evaluating every metric for an interval costs a
+  visit of each node rather than of each metric's expanded tree.
+
+  Counts absent for an interval read as NaN, so metrics needing them
+  are NaN rather than an error. As every node is computed, both sides
+  of an if-else are computed and the condition selects the value.
+  """
+
+  def __init__(self, metrics: Dict[str, Expression],
+               roots: Optional[Sequence[str]] = None):
+    """Builds and compiles the graph.
+
+    Args:
+      metrics (Dict): mapping from metric name to expression, in which
+        events named like a metric, ignoring case, reference that metric.
+      roots (Sequence[str]): names of the metrics to evaluate, by default
+        all of them.
+    Raises:
+      ValueError: if metrics reference each other in a cycle.
+    """
+    self._metrics = metrics
+    self._by_lower_name = {name.lower(): name for name in metrics}
+    self.names = [self._by_lower_name[name.lower()]
+                  for name in (roots if roots is not None else metrics)]
+    self._lines: List[str] = []
+    self._events: Dict[str, None] = {}
+    self._literals: Dict[str, None] = {}
+    self._variable_of_source: Dict[str, str] = {}
+    self._value_of_expression: Dict[Expression, str] = {}
+    self._value_of_metric: Dict[str, str] = {}
+    self._resolving: List[str] = []
+    results = [self._MetricValue(name) for name in self.names]
+    source = '\n'.join(['def _evaluate(c, l=_no_literals):', '  get = c.get'] +
+                       self._lines +
+                       [f'  return ({"".join(r + ", " for r in results)})'])
+    namespace = dict(_EVAL_GLOBALS)
+    exec(compile(source, '<metrics>', 'exec'), namespace)  # pylint: disable=exec-used
+    self._evaluate = namespace['_evaluate']
+    # Only needed while building.
+    del self._variable_of_source, self._value_of_expression, self._resolving
+
+  @staticmethod
+  def FromPerfJson(json_metrics: List[Dict[str, str]],
+                   roots: Optional[Sequence[str]] = None) -> 'MetricDag':
+    """Builds the graph of the metrics decoded from a perf metrics json."""
+    return MetricDag({m['MetricName']: ParsePerfJson(m['MetricExpr'])
+                      for m in json_metrics if 'MetricExpr' in m}, roots)
+
+  def Nodes(self) -> int:
+    """Returns the number of distinct nodes computed by Evaluate."""
+    return len(self._lines)
+
+  def Events(self) -> List[str]:
+    """Returns the perf json names of the events counts are read for."""
+    return list(self._events)
+
+  def Literals(self) -> List[str]:
+    """Returns the runtime literals, like '#SMT_on', that are read."""
+    return list(self._literals)
+
+  def _Assign(self, source: str) -> str:
+    """Returns the variable holding the value of source, adding it if new."""
+    if source not in self._variable_of_source:
+      variable = f'v{len(self._lines)}'
+      self._lines.append(f'  {variable} = {source}')
+      self._variable_of_source[source] = variable
+    return self._variable_of_source[source]
+
+  def _MetricValue(self, name: str) -> str:
+    if name not in self._value_of_metric:
+      if name in self._resolving:
+        cycle = self._resolving[self._resolving.index(name):] + [name]
+        raise ValueError(f'Cycle in metric references: {" -> ".join(cycle)}')
+      self._resolving.append(name)
+      self._value_of_metric[name] = self._Value(self._metrics[name])
+      self._resolving.pop()
+    return self._value_of_metric[name]
+
+  def _Value(self, e: Expression) -> str:
+    """Returns a variable or constant with the value of e."""
+    if e in self._value_of_expression:
+      return self._value_of_expression[e]
+    if isinstance(e, Constant):
+      value = e.ToEvalPython(None)
+    elif isinstance(e, Event) and e.name.lower() in self._by_lower_name:
+      value = self._MetricValue(self._by_lower_name[e.name.lower()])
+    elif isinstance(e, Event):
+      self._events[e.ToPerfJson()] = None
+      value = self._Assign(f'get({e.ToPerfJson()!r}, _nan)')
+    elif isinstance(e, Literal):
+      self._literals[e.value] = None
+      value = self._Assign(e.ToEvalPython(None))
+    elif isinstance(e, Function) and e.fn in ('has_event', 'source_count'):
+      value = self._Assign(e.ToEvalPython(None))
+    elif isinstance(e, Operator):
+      value = self._Assign(Operator(e.operator,
+                                    _Variable(self._Value(e.lhs)),
+                                    _Variable(self._Value(e.rhs))
+                                    ).ToEvalPython(None))
+    elif isinstance(e, Select):
+      value = self._Assign(Select(_Variable(self._Value(e.true_val)),
+                                  _Variable(self._Value(e.cond)),
+                                  _Variable(self._Value(e.false_val))
+                                  ).ToEvalPython(None))
+    else:
+      value = self._Assign(Function(e.fn, _Variable(self._Value(e.lhs)),
+                                    _Variable(self._Value(e.rhs))
+                                    ).ToEvalPython(None))
+    self._value_of_expression[e] = value
+    return value
+
+  def Evaluate(self, counts: Dict[str, float],
+               literals: Optional[Dict[str, float]] = None) -> Dict[str, float]:
+    """Computes every metric from one interval's counts.
+
+    Args:
+      counts (Dict): mapping from perf json event name to its count.
+      literals (Dict): values of runtime literals like '#SMT_on'.
+    Returns:
+      Dict: mapping from metric name to its value.
+    """
+    values = self._evaluate(counts, literals if literals is not None else {})
+    return dict(zip(self.names, values))
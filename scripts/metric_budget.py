@@ -0,0 +1,236 @@
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# metric_budget.py
+# --metrics-json <Perf metrics json written by create_perf_json.py, like perf/skylakex/skx-metrics.json>
+# --events-json <Perfmon core events json of the model, like SKX/events/skylakex_core.json>
+# --metrics <Comma separated metric or metric group names, or metric name
+#            patterns, each optionally followed by =weight, like
+#            tma_backend_bound=4,TopdownL1=2,tma_info_thread_*>
+# --gp-counters <Programmable counters that may be used per thread - default all>
+# --pmu <Core PMU of the metrics and events - default cpu>
+# --smt <on or off - default on>
+# --nmi-watchdog <on or off - default on>
+# --system-wide <Plan for perf stat -a, counting all of a core's threads>
+#
+# OUTPUT: A perf stat command line counting the metrics of the greatest
+#         total weight whose events fit on the core PMU's counters at
+#         once, so that nothing is multiplexed. Metrics have a weight
+#         of 1 unless given. The enabled NMI watchdog holds one of the
+#         programmable counters. The selected and dropped metrics are
+#         written as comments.
+#
+# EXAMPLE: python metric_budget.py --metrics-json perf/skylakex/skx-metrics.json \
+#            --events-json SKX/events/skylakex_core.json --gp-counters 3 \
+#            --metrics tma_frontend_bound=2,tma_backend_bound=2,tma_info_thread_ipc
+import argparse
+from collection_plan import CollectionPlan, EventKey, event_needs, metric_events
+from dataclasses import dataclass
+import event_groups
+import functools
+import json
+import math
+from perf_stat_metrics import select_metrics
+from script_args import on_off
+import sys
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Tuple
+
+
+# The most nodes the search for a selection visits before settling for
+# the best selection found.
+MAX_SEARCH_NODES = 20000
+
+
+@dataclass
+class BudgetedSelection:
+    """The metrics selected within a counter budget and how to count them."""
+    # The selected metrics, sorted.
+    metrics: List[str]
+    weight: float
+    # The metrics that didn't fit, sorted.
+    dropped: List[str]
+    plan: CollectionPlan
+    # False when the search stopped before proving no selection weighs more.
+    optimal: bool = True
+
+
+def select_within_budget(core_pmu: event_groups.CorePmu,
+                         metric_events: Dict[str, Sequence[str]],
+                         weights: Dict[str, float],
+                         gp_counters: Optional[int] = None,
+                         smt_on: bool = True,
+                         nmi_watchdog: bool = True,
+                         max_nodes: int = MAX_SEARCH_NODES) -> BudgetedSelection:
+    """
+    Select the metrics of greatest total weight whose events, including
+    those of metrics they reference, can all be counted in one group on
+    the core PMU using at most gp_counters programmable counters, one of
+    them held by an enabled NMI watchdog. Events not on the core PMU's
+    counters, like uncore events, don't count against the budget.
+
+    Found by a branch and bound search, starting from a greedy selection,
+    that visits at most max_nodes nodes. A branch is pruned when even a
+    fractional selection of the remaining metrics, each charged for its
+    new programmable events shared with the other metrics needing them,
+    can't weigh more than the best selection found.
+    """
+    found = event_needs(core_pmu, metric_events)
+    counters = found.counters
+    needs = found.metrics
+    if gp_counters is None:
+        gp_counters = len(core_pmu.counters if smt_on else core_pmu.counters_smt_off)
+    budget = gp_counters - (1 if nmi_watchdog else 0)
+
+    def programmable(keys: Iterable[EventKey]) -> int:
+        return sum(counters[k].fixed is None for k in keys)
+
+    @functools.lru_cache(maxsize=1 << 16)
+    def fits(keys: FrozenSet[EventKey]) -> bool:
+        return programmable(keys) <= budget and \
+            event_groups.schedulable(core_pmu, [counters[k] for k in keys],
+                                     smt_on, nmi_watchdog)
+
+    # Metrics with the same events are selected together.
+    items: Dict[FrozenSet[EventKey], Tuple[float, List[str]]] = {}
+    for name in sorted(needs):
+        core = frozenset(needs[name][0])
+        if weights.get(name, 0) > 0 and fits(core):
+            weight, names = items.get(core, (0.0, []))
+            items[core] = (weight + weights[name], names + [name])
+    # How many of the metrics need each programmable event.
+    uses: Dict[EventKey, int] = {}
+    for core in items:
+        for key in core:
+            if counters[key].fixed is None:
+                uses[key] = uses.get(key, 0) + 1
+
+    def cost(core: FrozenSet[EventKey], keys: FrozenSet[EventKey]) -> float:
+        """The metric's share of the programmable events it adds to keys."""
+        return sum(1 / uses[k] for k in core - keys if k in uses)
+
+    def ratio(cost: float, weight: float) -> float:
+        return weight / cost if cost else math.inf
+
+    order = sorted(items, key=lambda core: (-ratio(cost(core, frozenset()), items[core][0]),
+                                            items[core][1]))
+
+    def bound(i: int, keys: FrozenSet[EventKey]) -> float:
+        """The most the metrics from position i in order could add to keys."""
+        free = budget - programmable(keys)
+        total = 0.0
+        for (c, w) in sorted(((cost(core, keys), items[core][0]) for core in order[i:]),
+                             key=lambda cw: -ratio(*cw)):
+            if c > free:
+                return total + w * free / c
+            total += w
+            free -= c
+        return total
+
+    # Start from the greedy selection in order.
+    keys: FrozenSet[EventKey] = frozenset()
+    chosen: List[str] = []
+    weight = 0.0
+    for core in order:
+        if fits(keys | core):
+            keys |= core
+            chosen += items[core][1]
+            weight += items[core][0]
+    best: Tuple[float, List[str]] = (weight, chosen)
+    nodes = 0
+
+    def search(i: int, keys: FrozenSet[EventKey], chosen: List[str], weight: float) -> None:
+        nonlocal best, nodes
+        nodes += 1
+        if weight > best[0]:
+            best = (weight, chosen)
+        if i == len(order) or nodes > max_nodes or weight + bound(i, keys) <= best[0]:
+            return
+        core = order[i]
+        w, names = items[core]
+        if core <= keys:
+            # Selecting metrics whose events are already counted is free.
+            search(i + 1, keys, chosen + names, weight + w)
+            return
+        if fits(keys | core):
+            search(i + 1, keys | core, chosen + names, weight + w)
+        search(i + 1, keys, chosen, weight)
+
+    search(0, frozenset(), [], 0.0)
+    weight, chosen = best
+
+    grouped = set().union(*[needs[n][0] | needs[n][1] for n in chosen])
+    ungrouped = set().union(*[needs[n][2] for n in chosen]) - grouped
+    spellings = found.spellings
+    group_metrics = sorted(n for n in chosen if needs[n][0] or needs[n][1])
+    return BudgetedSelection(
+        metrics=sorted(chosen),
+        weight=weight,
+        dropped=sorted(n for n in needs if n not in chosen),
+        plan=CollectionPlan(
+            groups=[[spellings[k] for k in sorted(grouped)]] if grouped else [],
+            ungrouped=[spellings[k] for k in sorted(ungrouped)],
+            group_metrics=[group_metrics] if grouped else [],
+            ungrouped_metrics=sorted(n for n in chosen if n not in group_metrics)),
+        optimal=nodes <= max_nodes)
+
+
+def _weighted(arg: str) -> List[Tuple[str, float]]:
+    result = []
+    for selection in arg.split(','):
+        name, sep, weight = selection.partition('=')
+        try:
+            result.append((name, float(weight) if sep else 1.0))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'Expected name=weight but found {selection}')
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--metrics-json', required=True,
+                    help='Perf metrics json written by create_perf_json.py.')
+    ap.add_argument('--events-json', required=True,
+                    help='Perfmon core events json of the model.')
+    ap.add_argument('--metrics', type=_weighted, required=True,
+                    help='Comma separated metric or metric group names, or metric name '
+                    'patterns like tma_*, each optionally followed by =weight.')
+    ap.add_argument('--gp-counters', type=int,
+                    help='Programmable counters that may be used per thread.')
+    ap.add_argument('--pmu', default='cpu',
+                    help='Core PMU of the metrics and events, like cpu_core.')
+    ap.add_argument('--smt', type=on_off, default=True,
+                    help='Whether SMT is on or off.')
+    ap.add_argument('--nmi-watchdog', type=on_off, default=True,
+                    help='Whether the NMI watchdog holds a counter.')
+    ap.add_argument('--system-wide', action='store_true',
+                    help='Plan for perf stat -a, counting all of a core\'s threads.')
+    args = ap.parse_args()
+
+    with open(args.metrics_json, 'r') as f:
+        json_metrics = [m for m in json.load(f) if m.get('Unit', 'cpu') == args.pmu]
+    with open(args.events_json, 'r') as f:
+        core_pmu = event_groups.CorePmu.from_json(args.pmu, json.load(f)['Events'])
+    try:
+        weights: Dict[str, float] = {}
+        for (selection, weight) in args.metrics:
+            for name in select_metrics(json_metrics, [selection]):
+                weights[name] = max(weight, weights.get(name, weight))
+        # perf's #core_wide is only true when counting system wide.
+        literals = {'#SMT_on': 1 if args.smt else 0,
+                    '#core_wide': 1 if args.system_wide else 0}
+        events = metric_events(json_metrics, list(weights), literals)
+    except ValueError as e:
+        sys.exit(str(e))
+    selection = select_within_budget(core_pmu, events, weights, args.gp_counters,
+                                     args.smt, args.nmi_watchdog)
+    if not selection.metrics:
+        sys.exit('No metric fits within the counter budget')
+    print(selection.plan.command_line(args.system_wide))
+    print(f'# Selected, weight {selection.weight:g}: {", ".join(selection.metrics)}')
+    if not selection.optimal:
+        print(f'# Search stopped after {MAX_SEARCH_NODES} nodes, a heavier selection may fit')
+    if selection.dropped:
+        print(f'# Dropped: {", ".join(selection.dropped)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# perf_stat_metrics.py
+# --metrics-json <Perf metrics json written by create_perf_json.py, like perf/sapphirerapids/spr-metrics.json>
+# --input <Output of perf stat -I with -x, or -j - default stdin>
+# --output <CSV file the metric values are written to - default stdout>
+# --metrics <Comma separated metric or metric group names, or metric name
+#            patterns like 'tma_*' - default all>
+# --literal <Value of a runtime literal like '#SMT_on=1', repeated for each literal>
+# --drill-down <Only compute TMA metrics whose parent's threshold passed>
+#
+# ASSUMES: perf stat was run in interval mode, -I, with CSV, -x, or JSON, -j, output.
+# OUTPUT: For each interval, as it closes, a CSV row of the time, the
+#         aggregate (CPU, core, die or socket when perf stat aggregated
+#         per one of them), the metric name and value of every metric
+#         with a value. With --drill-down, the TMA tree is walked from
+#         its level 1 metrics and a child is only computed when its
+#         parent's MetricThreshold passed. Children that weren't
+#         computed are written with the value 'pruned', their own
+#         children are skipped silently. When --metrics selects TMA
+#         metrics, only they and their descendants are walked.
+#
+# EXAMPLE: perf stat -a -I 1000 -x, -M TopdownL1 -o stat.csv &
+#          tail -f stat.csv | python perf_stat_metrics.py \
+#            --metrics-json perf/sapphirerapids/spr-metrics.json \
+#            --metrics TopdownL1 --literal '#SMT_on=1'
+import argparse
+import csv
+from dataclasses import dataclass
+import fnmatch
+import json
+import math
+import metric
+import re
+from script_args import literal
+import sys
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, TextIO, Tuple
+
+# The aggregate column of perf stat -x, output when not aggregating
+# globally, like 'CPU3' with -A or 'S0-D0-C1' with --per-core.
+_csv_aggregate = re.compile(r'CPU[0-9]+|S[0-9]+(-D[0-9]+)?(-C[0-9]+)?|N[0-9]+')
+
+# The aggregate keys of perf stat -j output.
+_json_aggregates = ['cpu', 'thread', 'core', 'die', 'socket', 'node']
+
+# The metric group holding the children of a TMA metric.
+_tma_child_group = re.compile(r'(tma_.+)_group')
+
+
+@dataclass(frozen=True)
+class Sample:
+    """A count read from a line of perf stat output."""
+    time: str
+    aggregate: str
+    event: str
+    # None when perf stat reported the event as not counted or supported.
+    count: Optional[float]
+
+
+def _count(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _csv_sample(line: str) -> Optional[Sample]:
+    """
+    Read a perf stat -I -x, line that is the interval's time, optional
+    aggregate and number of CPUs aggregated, count, unit, event, ...
+    """
+    fields = next(csv.reader([line]))
+    aggregate = ''
+    count_field = 1
+    if len(fields) > 1 and _csv_aggregate.fullmatch(fields[1]):
+        aggregate = fields[1]
+        # Aggregates other than CPUs are followed by the number of CPUs.
+        count_field = 2 if aggregate.startswith('CPU') else 3
+    if len(fields) < count_field + 3 or not fields[count_field + 2]:
+        # Lines only holding a metric computed by perf.
+        return None
+    return Sample(fields[0], aggregate, fields[count_field + 2],
+                  _count(fields[count_field]))
+
+
+def _json_sample(line: str) -> Optional[Sample]:
+    """Read a perf stat -j line that is a JSON object per count."""
+    obj = json.loads(line)
+    if 'event' not in obj or 'counter-value' not in obj:
+        return None
+    aggregate = next((str(obj[key]) for key in _json_aggregates if key in obj), '')
+    return Sample(str(obj.get('interval', '')), aggregate, obj['event'],
+                  _count(str(obj['counter-value'])))
+
+
+def read_samples(lines: Iterable[str]) -> Iterator[Sample]:
+    """Read the samples of perf stat -x, or -j output, one line at a time."""
+    for (number, line) in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            sample = _json_sample(line) if line.startswith('{') else _csv_sample(line)
+        except ValueError as e:
+            raise ValueError(f'Line {number} of perf stat output: {e}') from e
+        if sample:
+            yield sample
+
+
+def read_intervals(samples: Iterable[Sample]
+                   ) -> Iterator[Tuple[str, Dict[str, Dict[str, float]]]]:
+    """
+    Group samples into intervals, yielding the time and the counts of
+    each aggregate when the next interval starts. Only one interval's
+    counts are held at a time. Counts of the same event, such as from
+    unmerged uncore PMUs, are summed.
+    """
+    time = None
+    counts: Dict[str, Dict[str, float]] = {}
+    for sample in samples:
+        if sample.time != time:
+            if time is not None:
+                yield (time, counts)
+            time = sample.time
+            counts = {}
+        aggregate_counts = counts.setdefault(sample.aggregate, {})
+        if sample.count is None:
+            continue
+        aggregate_counts[sample.event] = aggregate_counts.get(sample.event, 0.0) + sample.count
+    if time is not None:
+        yield (time, counts)
+
+
+def _canonical_event(name: str) -> str:
+    """
+    Event names in metrics are written like 'cpu_core@TOPDOWN.SLOTS@' or
+    'topdown\\-fe\\-bound' but perf stat reports them like
+    'cpu_core/TOPDOWN.SLOTS/' or 'topdown-fe-bound'.
+    """
+    return name.replace('\\', '').replace('/', '@').lower()
+
+
+def select_metrics(json_metrics: List[Dict[str, str]],
+                   selections: Sequence[str]) -> List[str]:
+    """
+    The names of the metrics selected by name, metric group or a case
+    insensitive pattern of metric names like 'tma_*'.
+    """
+    selected = {}
+    for selection in selections:
+        pattern = any(c in selection for c in '*?[')
+        found = False
+        for m in json_metrics:
+            groups = m.get('MetricGroup', '').split(';')
+            if selection.lower() == m['MetricName'].lower() or selection in groups or \
+               (pattern and fnmatch.fnmatch(m['MetricName'].lower(), selection.lower())):
+                selected[m['MetricName']] = None
+                found = True
+        if not found:
+            raise ValueError(f'No metric or metric group matches {selection}')
+    return list(selected)
+
+
+def tma_children(json_metrics: List[Dict[str, str]]) -> Dict[Optional[str], List[str]]:
+    """
+    The TMA tree of the metrics, mapping each TMA metric to its children,
+    the metrics in its tma_<metric>_group, and None to the metrics at the
+    top of the tree, those with children but no parent or, other than
+    the tma_info_ metrics, in tma_L1_group.
+    """
+    names = {m['MetricName'] for m in json_metrics}
+    children: Dict[Optional[str], List[str]] = {None: []}
+    parents = set()
+    for m in json_metrics:
+        for group in m.get('MetricGroup', '').split(';'):
+            match = _tma_child_group.fullmatch(group)
+            if match and match.group(1) in names:
+                children.setdefault(match.group(1), []).append(m['MetricName'])
+                parents.add(m['MetricName'])
+    for m in json_metrics:
+        name = m['MetricName']
+        if name not in parents and \
+           (name in children or (not name.startswith('tma_info_') and
+                                 'tma_L1_group' in m.get('MetricGroup', '').split(';'))):
+            children[None].append(name)
+    return children
+
+
+class MetricCalculator:
+    """Computes metrics from the counts of perf stat's event names."""
+
+    def __init__(self, dag: metric.MetricDag, literals: Dict[str, float]):
+        self.dag = dag
+        # The given literals by lower case name, as perf ignores their case.
+        self._given_literals = {name.lower(): value for (name, value) in literals.items()}
+        # The literals' values by their names in the dags.
+        self.literals: Dict[str, float] = {}
+        self._json_events: Dict[str, str] = {}
+        # Memoized mapping of perf stat event names to metric event names.
+        self._perf_events: Dict[str, Optional[str]] = {}
+        self._add_dag(dag)
+
+    def _add_dag(self, dag: metric.MetricDag):
+        """Check the literals and map the events of a dag to be evaluated."""
+        missing = [name for name in dag.Literals() if name.lower() not in self._given_literals]
+        if missing:
+            raise ValueError(f'Values are needed for the runtime literals: {", ".join(missing)}')
+        for name in dag.Literals():
+            self.literals[name] = self._given_literals[name.lower()]
+        for name in dag.Events():
+            canonical = _canonical_event(name)
+            self._json_events[canonical] = name
+            # perf stat may not report the PMU of 'cpu@INST_RETIRED.ANY@'.
+            m = re.fullmatch(r'[^@]+@([^@=]+)@', canonical)
+            if m:
+                self._json_events.setdefault(m.group(1), name)
+
+    def _json_event(self, perf_event: str) -> Optional[str]:
+        if perf_event not in self._perf_events:
+            self._perf_events[perf_event] = self._json_events.get(
+                _canonical_event(perf_event))
+        return self._perf_events[perf_event]
+
+    def _json_counts(self, counts: Dict[str, float]) -> Dict[str, float]:
+        json_counts = {}
+        for (perf_event, count) in counts.items():
+            name = self._json_event(perf_event)
+            if name:
+                json_counts[name] = count
+        return json_counts
+
+    def calculate(self, counts: Dict[str, float]) -> Dict[str, float]:
+        """The value of each metric having a value given the counts."""
+        values = self.dag.Evaluate(self._json_counts(counts), self.literals)
+        return {name: value for (name, value) in values.items()
+                if not math.isnan(value)}
+
+    def calculate_pruned(self, counts: Dict[str, float]
+                         ) -> Tuple[Dict[str, float], List[str]]:
+        """
+        The value of each metric having a value given the counts and the
+        metrics that weren't computed as they were pruned.
+        """
+        return (self.calculate(counts), [])
+
+
+class DrillDownCalculator(MetricCalculator):
+    """
+    Computes the TMA metrics top-down, only computing the children of a
+    metric whose MetricThreshold passes, and the other metrics always.
+    """
+
+    def __init__(self, json_metrics: List[Dict[str, str]], literals: Dict[str, float],
+                 others: Optional[Sequence[str]] = None,
+                 roots: Optional[Sequence[str]] = None):
+        """
+        Constructed from the metrics of a perf metrics json, the values of
+        their runtime literals, by default all, the names of metrics
+        outside of the TMA tree to compute and, by default the top of the
+        tree, the TMA metrics to walk down from. Only these roots and
+        their descendants are computed, so only their literals are needed.
+        """
+        children = tma_children(json_metrics)
+        tree = [name for names in children.values() for name in names]
+        if roots is not None:
+            parents = {child: parent for (parent, names) in children.items()
+                       if parent for child in names}
+
+            def below_root(name: str) -> bool:
+                parent = parents.get(name)
+                return parent is not None and (parent in roots or below_root(parent))
+
+            children = {**children, None: [name for name in roots
+                                           if name in tree and not below_root(name)]}
+        # The subtrees walked from the roots.
+        self.children: Dict[Optional[str], List[str]] = {None: children[None]}
+        nodes = []
+        pending = list(children[None])
+        while pending:
+            name = pending.pop(0)
+            nodes.append(name)
+            if name in children:
+                self.children[name] = children[name]
+                pending.extend(children[name])
+        expressions = {m['MetricName']: metric.ParsePerfJson(m['MetricExpr'])
+                       for m in json_metrics if 'MetricExpr' in m}
+        if others is None:
+            others = list(expressions)
+        self._others = [name for name in others if name not in tree]
+        self._expressions = expressions
+        self._thresholds = {m['MetricName']: metric.ParsePerfJson(m['MetricThreshold'])
+                            for m in json_metrics
+                            if m['MetricName'] in nodes and 'MetricThreshold' in m}
+        # One dag computing the other metrics and the walked TMA metrics
+        # and their thresholds, named with a space so no metric can
+        # reference them, sharing the subexpressions between them all.
+        dag_expressions = dict(expressions)
+        dag_expressions.update((f'{name} threshold', threshold)
+                               for (name, threshold) in self._thresholds.items())
+        super().__init__(metric.MetricDag(dag_expressions, self._others + nodes +
+                                          [f'{name} threshold' for name in nodes
+                                           if name in self._thresholds]),
+                         literals)
+        # Memoized dags of thresholds reading some metrics from the counts.
+        self._threshold_dags: Dict[Tuple[str, FrozenSet[str]], metric.MetricDag] = {}
+
+    def calculate(self, counts: Dict[str, float]) -> Dict[str, float]:
+        return self.calculate_pruned(counts)[0]
+
+    def calculate_pruned(self, counts: Dict[str, float]
+                         ) -> Tuple[Dict[str, float], List[str]]:
+        """
+        The values of the other metrics and the TMA metrics computed top
+        down, with the children of metrics whose thresholds didn't pass,
+        or that had no value, as pruned. Their descendants are skipped
+        without being reported.
+        """
+        computed = self.dag.Evaluate(self._json_counts(counts), self.literals)
+        values = {name: computed[name] for name in self._others
+                  if not math.isnan(computed[name])}
+        pruned = []
+        pending = list(self.children[None])
+        while pending:
+            name = pending.pop(0)
+            value = computed[name]
+            if not math.isnan(value):
+                values[name] = value
+            if self._passed(name, computed):
+                pending.extend(self.children.get(name, []))
+            else:
+                pruned.extend(self.children.get(name, []))
+        return (values, pruned)
+
+    def _passed(self, name: str, computed: Dict[str, float]) -> bool:
+        """Whether the threshold of a TMA metric computed by the dag passed."""
+        # Metrics without a threshold pass when they have a value.
+        passed = computed.get(f'{name} threshold', 0.0 if math.isnan(computed[name]) else 1.0)
+        return bool(passed) and not math.isnan(passed)
+
+    def evaluate_node(self, name: str, counts: Dict[str, float],
+                      ancestors: Optional[Dict[str, float]] = None) -> Tuple[float, bool]:
+        """
+        The value of a TMA metric and whether its threshold passed. When
+        given the values of its ancestors, computed from other counts,
+        its threshold uses them rather than computing them from counts.
+        """
+        json_counts = self._json_counts(counts)
+        computed = self.dag.Evaluate(json_counts, self.literals)
+        value = computed[name]
+        if ancestors is None:
+            return (value, self._passed(name, computed))
+        if name not in self._thresholds:
+            return (value, not math.isnan(value))
+        given = {n.lower(): v for (n, v) in ancestors.items()}
+        given[name.lower()] = value
+        key = (name, frozenset(given))
+        if key not in self._threshold_dags:
+            expressions = {n: e for (n, e) in self._expressions.items()
+                           if n.lower() not in given}
+            expressions[f'{name} threshold'] = self._thresholds[name]
+            self._threshold_dags[key] = metric.MetricDag(expressions, [f'{name} threshold'])
+        dag = self._threshold_dags[key]
+        # The given metrics are read like events.
+        json_counts.update((e, given[e.lower()]) for e in dag.Events() if e.lower() in given)
+        passed = dag.Evaluate(json_counts, self.literals)[f'{name} threshold']
+        return (value, bool(passed) and not math.isnan(passed))
+
+
+def write_metrics(calculator: MetricCalculator, lines: Iterable[str],
+                  output: TextIO):
+    """Write the metric values of each interval as the interval closes."""
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(['time', 'aggregate', 'metric', 'value'])
+    for (time, counts) in read_intervals(read_samples(lines)):
+        for (aggregate, aggregate_counts) in counts.items():
+            values, pruned = calculator.calculate_pruned(aggregate_counts)
+            for (name, value) in values.items():
+                writer.writerow([time, aggregate, name, value])
+            for name in pruned:
+                writer.writerow([time, aggregate, name, 'pruned'])
+        output.flush()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--metrics-json', required=True,
+                    help='Perf metrics json written by create_perf_json.py.')
+    ap.add_argument('--input', type=argparse.FileType('r'), default=sys.stdin,
+                    help='Output of perf stat -I with -x, or -j.')
+    ap.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout,
+                    help='CSV file the metric values are written to.')
+    ap.add_argument('--metrics', default=None,
+                    help='Comma separated metric or metric group names, or metric name '
+                    'patterns like tma_*.')
+    ap.add_argument('--literal', type=literal, action='append', default=[],
+                    help="Value of a runtime literal like '#SMT_on=1'.")
+    ap.add_argument('--drill-down', action='store_true',
+                    help="Only compute TMA metrics whose parent's threshold passed.")
+    args = ap.parse_args()
+
+    with open(args.metrics_json, 'r') as f:
+        json_metrics = json.load(f)
+    roots = None
+    if args.metrics:
+        roots = select_metrics(json_metrics, args.metrics.split(','))
+    try:
+        if args.drill_down:
+            calculator = DrillDownCalculator(json_metrics, dict(args.literal), roots, roots)
+        else:
+            calculator = MetricCalculator(metric.MetricDag.FromPerfJson(json_metrics, roots),
+                                          dict(args.literal))
+        write_metrics(calculator, args.input, args.output)
+    except ValueError as e:
+        sys.exit(str(e))
+
+if __name__ == '__main__':
+    main()
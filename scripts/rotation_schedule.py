@@ -0,0 +1,251 @@
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# rotation_schedule.py
+# --metrics-json <Perf metrics json written by create_perf_json.py, like perf/sapphirerapids/spr-metrics.json>
+# --events-json <Perfmon core events json of the model, like SPR/events/sapphirerapids_core.json>
+# --metrics <Comma separated metric or metric group names, or metric name
+#            patterns like 'tma_*' - default all metrics>
+# --output-prefix <Prefix of the files perf stat writes each run to - default rotation>
+# --merge-map <Merge map json to write, mapping each metric to the file of its run>
+# --pmu <Core PMU of the metrics and events - default cpu>
+# --smt <on or off - default on>
+# --nmi-watchdog <on or off - default on>
+# --system-wide <Plan for perf stat -a, counting all of a core's threads>
+#
+# OUTPUT: A perf stat command line for each of the fewest runs that
+#         between them count the events of all the metrics without
+#         multiplexing. The core PMU events of each run form one group
+#         holding all the events of each metric computed from the run.
+#         Each command line is preceded by a comment naming the metrics
+#         computed from its run. Metrics that can never be counted
+#         without multiplexing, because of their MetricConstraint or
+#         events, are given runs of their own.
+#
+# EXAMPLE: python rotation_schedule.py --metrics-json perf/sapphirerapids/spr-metrics.json \
+#            --events-json SPR/events/sapphirerapids_core.json --metrics 'tma_*' \
+#            --system-wide --merge-map spr-merge.json
+import argparse
+from collection_plan import CollectionPlan, EventKey, event_key, event_needs, metric_events
+from dataclasses import dataclass
+import event_groups
+import json
+from perf_stat_metrics import select_metrics
+from script_args import on_off
+import sys
+from typing import Dict, FrozenSet, List, Optional, Sequence, Set
+
+
+@dataclass
+class RotationSchedule:
+    """Runs counting the events of metrics without multiplexing."""
+    runs: List[CollectionPlan]
+    # Metrics whose events are counted ungrouped in their run as they
+    # can never be counted together.
+    multiplexed: List[str]
+
+    def run_metrics(self, run: int) -> List[str]:
+        """The metrics computed from a run."""
+        plan = self.runs[run]
+        return sorted(plan.ungrouped_metrics + [n for ns in plan.group_metrics for n in ns])
+
+    def merge_map(self, outputs: Sequence[str]) -> Dict[str, str]:
+        """The output of the run each metric is computed from."""
+        return {name: outputs[i] for i in range(len(self.runs))
+                for name in self.run_metrics(i)}
+
+
+def _ungroupable(constraint: Optional[str], smt_on: bool, nmi_watchdog: bool) -> bool:
+    """Does a MetricConstraint stop the metric's events being grouped?"""
+    return constraint == event_groups.NO_GROUP_EVENTS or \
+        (constraint == event_groups.NO_GROUP_EVENTS_SMT and smt_on) or \
+        (constraint == event_groups.NO_GROUP_EVENTS_NMI and nmi_watchdog)
+
+
+def schedule_runs(core_pmu: event_groups.CorePmu,
+                  metric_events: Dict[str, Sequence[str]],
+                  constraints: Optional[Dict[str, Optional[str]]] = None,
+                  smt_on: bool = True,
+                  nmi_watchdog: bool = True) -> RotationSchedule:
+    """
+    Partition the metrics into as few runs as possible where the core
+    PMU events of each run, including those of metrics the run's metrics
+    reference, can be counted together in one group. Topdown events are
+    grouped with the slots event. Metrics are placed by best fit in order
+    of decreasing programmable events, then runs are removed while their
+    metrics can be placed in the other runs. Events not on the core PMU's
+    counters are counted ungrouped in the run of their metrics.
+    """
+    found = event_needs(core_pmu, metric_events)
+    spellings = found.spellings
+    counters = found.counters
+    needs = found.metrics
+    constraints = constraints or {}
+    slots = event_key('TOPDOWN.SLOTS', core_pmu.name)
+    for (name, (core, free, _)) in needs.items():
+        if free and not any(k[1] in ['TOPDOWN.SLOTS', 'SLOTS'] for k in core):
+            slots_counters = core_pmu.event_counters('TOPDOWN.SLOTS')
+            if slots_counters:
+                spellings.setdefault(slots, 'TOPDOWN.SLOTS')
+                counters[slots] = slots_counters[1]
+                core.add(slots)
+    feasible: Dict[FrozenSet[EventKey], bool] = {}
+
+    def fits(keys: FrozenSet[EventKey]) -> bool:
+        if keys not in feasible:
+            feasible[keys] = event_groups.schedulable(core_pmu, [counters[k] for k in keys],
+                                                      smt_on, nmi_watchdog)
+        return feasible[keys]
+
+    def run_keys(run: List[str]) -> FrozenSet[EventKey]:
+        return frozenset().union(*[needs[n][0] for n in run])
+
+    def programmable(keys: FrozenSet[EventKey]) -> int:
+        return sum(counters[k].fixed is None for k in keys)
+
+    def best_fit(name: str, runs: List[List[str]], skip: int = -1) -> Optional[int]:
+        """The run the metric fits in adding the fewest counters, if any."""
+        core = needs[name][0]
+        best: Optional[int] = None
+        best_added = (0, 0)
+        for (i, run) in enumerate(runs):
+            if i == skip:
+                continue
+            keys = run_keys(run)
+            added = (programmable(core - keys), len(core - keys))
+            if (best is None or added < best_added) and fits(keys | core):
+                best = i
+                best_added = added
+        return best
+
+    runs: List[List[str]] = []
+    multiplexed = []
+    uncounted = []
+    # Place the metrics needing the most programmable counters first.
+    for name in sorted(needs, key=lambda n: (-programmable(frozenset(needs[n][0])),
+                                             -len(needs[n][0]), n)):
+        core, free, _ = needs[name]
+        if not core and not free:
+            uncounted.append(name)
+        elif not fits(frozenset(core)) or \
+             _ungroupable(constraints.get(name), smt_on, nmi_watchdog):
+            multiplexed.append(name)
+        else:
+            best = best_fit(name, runs)
+            if best is None:
+                runs.append([])
+                best = len(runs) - 1
+            runs[best].append(name)
+
+    def place(name: str, runs: List[List[str]], skip: int) -> bool:
+        """
+        Place the metric in a run other than skip, moving one metric of
+        that run to another run if needed to make room.
+        """
+        best = best_fit(name, runs, skip)
+        if best is not None:
+            runs[best].append(name)
+            return True
+        for (i, run) in enumerate(runs):
+            if i == skip:
+                continue
+            for other in run:
+                rest = [n for n in run if n != other]
+                if not fits(run_keys(rest) | needs[name][0]):
+                    continue
+                runs[i] = rest + [name]
+                moved_to = best_fit(other, runs, skip)
+                if moved_to is not None and moved_to != i:
+                    runs[moved_to].append(other)
+                    return True
+                runs[i] = run
+        return False
+
+    # Remove the runs, with the fewest metrics first, whose metrics can
+    # all be placed in the other runs.
+    removed = True
+    while removed and len(runs) > 1:
+        removed = False
+        for i in sorted(range(len(runs)), key=lambda i: (len(runs[i]), i)):
+            moved = [list(run) for run in runs]
+            if all(place(name, moved, i) for name in runs[i]):
+                runs = moved[:i] + moved[i + 1:]
+                removed = True
+                break
+
+    if uncounted:
+        if not runs:
+            runs.append([])
+        runs[0].extend(uncounted)
+
+    def plan(grouped: List[str], ungrouped: List[str]) -> CollectionPlan:
+        group: Set[EventKey] = set().union(*[needs[n][0] | needs[n][1] for n in grouped])
+        other: Set[EventKey] = set().union(*[needs[n][2] for n in grouped + ungrouped])
+        for n in ungrouped:
+            other |= needs[n][0] | needs[n][1]
+        group_metrics = sorted(n for n in grouped if needs[n][0] or needs[n][1])
+        return CollectionPlan(
+            groups=[[spellings[k] for k in sorted(group)]] if group else [],
+            ungrouped=[spellings[k] for k in sorted(other - group)],
+            group_metrics=[group_metrics] if group else [],
+            ungrouped_metrics=sorted(set(grouped + ungrouped) - set(group_metrics)))
+
+    return RotationSchedule(
+        runs=[plan(run, []) for run in runs] + [plan([], [n]) for n in multiplexed],
+        multiplexed=sorted(multiplexed))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--metrics-json', required=True,
+                    help='Perf metrics json written by create_perf_json.py.')
+    ap.add_argument('--events-json', required=True,
+                    help='Perfmon core events json of the model.')
+    ap.add_argument('--metrics',
+                    help='Comma separated metric or metric group names, or metric name '
+                    'patterns like tma_*.')
+    ap.add_argument('--output-prefix', default='rotation',
+                    help='Prefix of the files perf stat writes each run to.')
+    ap.add_argument('--merge-map',
+                    help='Merge map json to write, mapping each metric to the file of its run.')
+    ap.add_argument('--pmu', default='cpu',
+                    help='Core PMU of the metrics and events, like cpu_core.')
+    ap.add_argument('--smt', type=on_off, default=True,
+                    help='Whether SMT is on or off.')
+    ap.add_argument('--nmi-watchdog', type=on_off, default=True,
+                    help='Whether the NMI watchdog holds a counter.')
+    ap.add_argument('--system-wide', action='store_true',
+                    help='Plan for perf stat -a, counting all of a core\'s threads.')
+    args = ap.parse_args()
+
+    with open(args.metrics_json, 'r') as f:
+        json_metrics = [m for m in json.load(f) if m.get('Unit', 'cpu') == args.pmu]
+    with open(args.events_json, 'r') as f:
+        core_pmu = event_groups.CorePmu.from_json(args.pmu, json.load(f)['Events'])
+    try:
+        if args.metrics:
+            names = select_metrics(json_metrics, args.metrics.split(','))
+        else:
+            names = [m['MetricName'] for m in json_metrics]
+        # perf's #core_wide is only true when counting system wide.
+        literals = {'#SMT_on': 1 if args.smt else 0,
+                    '#core_wide': 1 if args.system_wide else 0}
+        events = metric_events(json_metrics, names, literals)
+    except ValueError as e:
+        sys.exit(str(e))
+    constraints = {m['MetricName']: m.get('MetricConstraint') for m in json_metrics}
+    schedule = schedule_runs(core_pmu, events, constraints, args.smt, args.nmi_watchdog)
+    outputs = [f'{args.output_prefix}{i + 1}.json' for i in range(len(schedule.runs))]
+    for (i, run) in enumerate(schedule.runs):
+        print(f'# Run {i + 1}: {", ".join(schedule.run_metrics(i))}')
+        print(run.command_line(args.system_wide, outputs[i]))
+    if schedule.multiplexed:
+        print(f'# Multiplexed: {", ".join(schedule.multiplexed)}')
+    if args.merge_map:
+        with open(args.merge_map, 'w', encoding='ascii') as f:
+            json.dump(schedule.merge_map(outputs), f, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
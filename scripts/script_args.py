@@ -0,0 +1,22 @@
+# SPDX-License-Identifier: BSD-3-Clause
+"""Types of the command line arguments shared by the scripts."""
+import argparse
+from typing import Tuple
+
+
+def on_off(arg: str) -> bool:
+    """An argument of on or off, like --smt on."""
+    if arg not in ['on', 'off']:
+        raise argparse.ArgumentTypeError(f'Expected on or off but found {arg}')
+    return arg == 'on'
+
+
+def literal(arg: str) -> Tuple[str, float]:
+    """
+    A runtime literal and its value, like '#num_dies=1'. The name is in
+    lower case, as perf ignores the case of literals.
+    """
+    name, sep, value = arg.partition('=')
+    if not sep or not name.startswith('#'):
+        raise argparse.ArgumentTypeError(f'Expected #name=value but found {arg}')
+    return (name.lower(), float(value))
@@ -0,0 +1,122 @@
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# specialize_metrics.py
+# --metrics-json <Perf metrics json written by create_perf_json.py, like perf/icelakex/icx-metrics.json>
+# --output <Metrics json to write - default stdout>
+# --smt <on or off>
+# --system-wide <Specialize for perf stat -a, counting all of a core's threads>
+# --cores <Number of cores>
+# --dies <Number of dies>
+# --sockets <Number of sockets>
+# --pmem <on or off, whether persistent memory is present>
+# --tsc-freq <TSC frequency in Hz>
+# --source-count <Number of PMUs counting an uncore event like 'UNC_CHA_CLOCKTICKS=40',
+#                 repeated for each event>
+# --literal <Value of any other runtime literal like '#num_dies=1', repeated for each literal>
+#
+# OUTPUT: The metrics json with each MetricExpr and MetricThreshold
+#         specialized to the host described. The given runtime literals
+#         are replaced by their values and folded with the constants
+#         around them. The branches of if-else an SMT or system-wide
+#         literal rules out are dropped, along with the events only they
+#         needed. Literals not described are left for perf to read.
+#
+# EXAMPLE: python specialize_metrics.py --metrics-json perf/icelakex/icx-metrics.json \
+#            --smt off --sockets 2 --dies 2 --pmem off --output icx-host-metrics.json
+import argparse
+import json
+import metric
+from script_args import literal, on_off
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+_SPECIALIZED_FIELDS = ['MetricExpr', 'MetricThreshold']
+
+
+def host_literals(smt: Optional[bool] = None, system_wide: Optional[bool] = None,
+                  cores: Optional[int] = None, dies: Optional[int] = None,
+                  sockets: Optional[int] = None, pmem: Optional[bool] = None,
+                  tsc_freq: Optional[float] = None,
+                  source_counts: Sequence[Tuple[str, int]] = ()) -> Dict[str, float]:
+    """The values of perf's runtime literals for a host, for those given."""
+    literals: Dict[str, float] = {}
+    for (name, value) in [('#SMT_on', smt), ('#core_wide', system_wide),
+                          ('#num_cores', cores), ('#num_dies', dies),
+                          ('#num_packages', sockets), ('#has_pmem', pmem),
+                          ('#SYSTEM_TSC_FREQ', tsc_freq)]:
+        if value is not None:
+            literals[name] = float(value)
+    for (event, count) in source_counts:
+        literals[f'source_count({event})'] = float(count)
+    return literals
+
+
+def specialize_metrics(json_metrics: List[Dict[str, str]],
+                       literals: Dict[str, float]) -> List[Dict[str, str]]:
+    """
+    The metrics with their expressions and thresholds specialized for
+    the literals. Expressions the literals don't change keep their
+    original text.
+    """
+    result = []
+    for m in json_metrics:
+        m = dict(m)
+        for field in _SPECIALIZED_FIELDS:
+            if field not in m:
+                continue
+            parsed = metric.ParsePerfJson(m[field])
+            specialized = parsed.Specialize(literals)
+            if not specialized.Equals(parsed):
+                m[field] = specialized.Simplify().ToPerfJson()
+        result.append(m)
+    return result
+
+
+def _source_count(arg: str) -> Tuple[str, int]:
+    event, sep, count = arg.partition('=')
+    if not sep or not count.isdigit():
+        raise argparse.ArgumentTypeError(f'Expected event=count but found {arg}')
+    return (event, int(count))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--metrics-json', required=True,
+                    help='Perf metrics json written by create_perf_json.py.')
+    ap.add_argument('--output', help='Metrics json to write, default stdout.')
+    ap.add_argument('--smt', type=on_off, help='Whether SMT is on or off.')
+    ap.add_argument('--system-wide', action='store_true', default=None,
+                    help='Specialize for perf stat -a, counting all of a core\'s threads.')
+    ap.add_argument('--cores', type=int, help='Number of cores.')
+    ap.add_argument('--dies', type=int, help='Number of dies.')
+    ap.add_argument('--sockets', type=int, help='Number of sockets.')
+    ap.add_argument('--pmem', type=on_off,
+                    help='Whether persistent memory is present.')
+    ap.add_argument('--tsc-freq', type=float, help='TSC frequency in Hz.')
+    ap.add_argument('--source-count', type=_source_count, action='append', default=[],
+                    help="Number of PMUs counting an uncore event like 'UNC_CHA_CLOCKTICKS=40'.")
+    ap.add_argument('--literal', type=literal, action='append', default=[],
+                    help="Value of any other runtime literal like '#num_dies=1'.")
+    args = ap.parse_args()
+
+    # In lower case, like the names of --literal, so those override them.
+    literals = {name.lower(): value for (name, value)
+                in host_literals(args.smt, args.system_wide, args.cores, args.dies,
+                                 args.sockets, args.pmem, args.tsc_freq,
+                                 args.source_count).items()}
+    literals.update(args.literal)
+    with open(args.metrics_json, 'r') as f:
+        json_metrics = json.load(f)
+    try:
+        specialized = specialize_metrics(json_metrics, literals)
+    except ValueError as e:
+        sys.exit(str(e))
+    out = open(args.output, 'w', encoding='ascii') if args.output else sys.stdout
+    json.dump(specialized, out, sort_keys=True, indent=4, separators=(',', ': '))
+    out.write('\n')
+    if args.output:
+        out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# tma_passes.py
+# --metrics-json <Perf metrics json written by create_perf_json.py, like perf/sapphirerapids/spr-metrics.json>
+# --events-json <Perfmon core events json of the model, like SPR/events/sapphirerapids_core.json>
+# --results <perf stat -j output of a previous pass, repeated for each pass in order>
+# --output-prefix <Prefix of the files perf stat writes each pass to - default tma-pass>
+# --pmu <Core PMU of the metrics and events - default cpu>
+# --smt <on or off - default on>
+# --nmi-watchdog <on or off - default on>
+# --system-wide <Plan for perf stat -a, counting all of a core's threads>
+# --literal <Value of a runtime literal like '#num_dies=1', repeated for each literal>
+#
+# OUTPUT: The perf stat command line of the next pass of a top-down
+#         drill-down of the TMA tree. The first pass counts the events of
+#         the level 1 metrics. Each later pass counts the events of the
+#         children of the metrics whose MetricThreshold passed given the
+#         results of the earlier passes. Each metric is counted with the
+#         events its MetricThreshold reads, other than those of its
+#         ancestors, which use the ancestors' values from their passes.
+#         The metrics of the previous passes and whether their thresholds
+#         passed are written as comments. Nothing but those comments is
+#         written once no threshold passes.
+#
+# EXAMPLE: python tma_passes.py --metrics-json perf/sapphirerapids/spr-metrics.json \
+#            --events-json SPR/events/sapphirerapids_core.json --system-wide \
+#            --literal '#has_pmem=0'
+#          perf stat -a -j -o tma-pass1.json -e '...' sleep 10
+#          python tma_passes.py ... --system-wide --results tma-pass1.json
+#          perf stat -a -j -o tma-pass2.json -e '...' sleep 10
+#          python tma_passes.py ... --system-wide --results tma-pass1.json --results tma-pass2.json
+import argparse
+from collection_plan import CollectionPlan, metric_events, plan_collection
+from dataclasses import dataclass
+import event_groups
+import json
+import metric
+from perf_stat_metrics import DrillDownCalculator, read_samples
+from script_args import literal, on_off
+import sys
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+
+def read_counts(lines: Iterable[str]) -> Dict[str, float]:
+    """The count of each event of perf stat output, summed over intervals and CPUs."""
+    counts: Dict[str, float] = {}
+    for sample in read_samples(lines):
+        if sample.count is not None:
+            counts[sample.event] = counts.get(sample.event, 0.0) + sample.count
+    return counts
+
+
+@dataclass
+class PassResult:
+    """A TMA metric counted by a pass."""
+    name: str
+    value: float
+    passed: bool
+
+
+@dataclass
+class NextPass:
+    """The TMA metrics of the next pass and how to count their events."""
+    # The TMA metrics counted by earlier passes in order.
+    results: List[PassResult]
+    # The TMA metrics to count next, none when the drill-down is done.
+    metrics: List[str]
+    plan: CollectionPlan
+
+
+class TmaPassPlanner:
+    """Plans each pass of a drill-down of the TMA tree."""
+
+    def __init__(self, json_metrics: List[Dict[str, str]],
+                 core_pmu: event_groups.CorePmu, literals: Dict[str, float],
+                 smt_on: bool = True, nmi_watchdog: bool = True):
+        self.json_metrics = json_metrics
+        self.core_pmu = core_pmu
+        self.literals = literals
+        self.smt_on = smt_on
+        self.nmi_watchdog = nmi_watchdog
+        self.calculator = DrillDownCalculator(json_metrics, literals, others=[])
+        self._parents = {child: parent for (parent, children) in self.calculator.children.items()
+                         if parent for child in children}
+        self._expressions = {m['MetricName']: metric.ParsePerfJson(m['MetricExpr'])
+                             for m in json_metrics if 'MetricExpr' in m}
+        self._thresholds = {m['MetricName']: metric.ParsePerfJson(m['MetricThreshold'])
+                            for m in json_metrics if 'MetricThreshold' in m}
+
+    def _ancestors(self, name: str) -> List[str]:
+        result = []
+        parent = self._parents.get(name)
+        while parent:
+            result.append(parent)
+            parent = self._parents.get(parent)
+        return result
+
+    def _threshold_events(self, name: str) -> List[str]:
+        """
+        The events a metric's threshold reads, including those of metrics
+        it references other than its ancestors, whose values come from
+        earlier passes.
+        """
+        if name not in self._thresholds:
+            return []
+        ancestors = {n.lower() for n in self._ancestors(name)}
+        expressions = {n: e for (n, e) in self._expressions.items()
+                       if n.lower() not in ancestors}
+        expressions[f'{name} threshold'] = self._thresholds[name]
+        leaves = metric.MetricClosures(expressions, self.literals)[f'{name} threshold'][0]
+        return [e.ToPerfJson() for e in leaves
+                if isinstance(e, metric.Event) and e.name.lower() not in ancestors]
+
+    def next_pass(self, pass_counts: Sequence[Dict[str, float]]) -> NextPass:
+        """
+        The next pass given the counts of each earlier pass. Each pass's
+        metrics are computed from that pass's counts alone, while their
+        thresholds use the values of their ancestors from the passes
+        that computed them.
+        """
+        values: Dict[str, float] = {}
+        results = []
+        metrics = list(self.calculator.children[None])
+        for counts in pass_counts:
+            passed = []
+            for name in metrics:
+                ancestors = {a: values[a] for a in self._ancestors(name)}
+                value, fired = self.calculator.evaluate_node(name, counts, ancestors)
+                values[name] = value
+                results.append(PassResult(name, value, fired))
+                if fired:
+                    passed.append(name)
+            metrics = [child for name in passed
+                       for child in self.calculator.children.get(name, [])]
+        # Each metric is counted with the events its threshold reads.
+        events = {name: sorted(set(events) | set(self._threshold_events(name)))
+                  for (name, events)
+                  in metric_events(self.json_metrics, metrics, self.literals).items()}
+        return NextPass(results, metrics,
+                        plan_collection(self.core_pmu, events, self.smt_on, self.nmi_watchdog))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--metrics-json', required=True,
+                    help='Perf metrics json written by create_perf_json.py.')
+    ap.add_argument('--events-json', required=True,
+                    help='Perfmon core events json of the model.')
+    ap.add_argument('--results', action='append', default=[],
+                    help='perf stat -j output of a previous pass, in order.')
+    ap.add_argument('--output-prefix', default='tma-pass',
+                    help='Prefix of the files perf stat writes each pass to.')
+    ap.add_argument('--pmu', default='cpu',
+                    help='Core PMU of the metrics and events, like cpu_core.')
+    ap.add_argument('--smt', type=on_off, default=True,
+                    help='Whether SMT is on or off.')
+    ap.add_argument('--nmi-watchdog', type=on_off, default=True,
+                    help='Whether the NMI watchdog holds a counter.')
+    ap.add_argument('--system-wide', action='store_true',
+                    help='Plan for perf stat -a, counting all of a core\'s threads.')
+    ap.add_argument('--literal', type=literal, action='append', default=[],
+                    help="Value of a runtime literal like '#num_dies=1'.")
+    args = ap.parse_args()
+
+    with open(args.metrics_json, 'r') as f:
+        json_metrics = [m for m in json.load(f) if m.get('Unit', 'cpu') == args.pmu]
+    with open(args.events_json, 'r') as f:
+        core_pmu = event_groups.CorePmu.from_json(args.pmu, json.load(f)['Events'])
+    # In lower case, like the names of --literal, so those override them.
+    literals = {'#smt_on': 1 if args.smt else 0,
+                '#core_wide': 1 if args.system_wide else 0}
+    literals.update(args.literal)
+    try:
+        planner = TmaPassPlanner(json_metrics, core_pmu, literals, args.smt,
+                                 args.nmi_watchdog)
+        pass_counts = []
+        for results in args.results:
+            with open(results, 'r') as f:
+                pass_counts.append(read_counts(f))
+        next_pass = planner.next_pass(pass_counts)
+    except ValueError as e:
+        sys.exit(str(e))
+    for result in next_pass.results:
+        print(f'# {result.name} {result.value} {"passed" if result.passed else "-"}')
+    if next_pass.metrics:
+        output = f'{args.output_prefix}{len(args.results) + 1}.json'
+        print(f'# Pass {len(args.results) + 1}: {", ".join(next_pass.metrics)}')
+        print(next_pass.plan.command_line(args.system_wide, output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import collection_plan
+import event_groups
+
+
+def _pmu(name: str = 'cpu') -> event_groups.CorePmu:
+    """A core PMU with 4 programmable counters and 2 fixed counters."""
+    json_events = [
+        {'EventName': 'INST_RETIRED.ANY', 'Counter': 'Fixed counter 0'},
+        {'EventName': 'CPU_CLK_UNHALTED.THREAD', 'Counter': 'Fixed counter 1'},
+        {'EventName': 'TOPDOWN.SLOTS', 'Counter': 'Fixed counter 3'},
+    ] + [{'EventName': f'E.{i}', 'Counter': '0,1,2,3'} for i in range(6)]
+    return event_groups.CorePmu.from_json(name, json_events)
+
+
+class TestCollectionPlan(unittest.TestCase):
+
+    def test_event_key(self):
+        key = collection_plan.event_key('E.1', 'cpu')
+        self.assertEqual(collection_plan.event_key('cpu@e.1@', 'cpu'), key)
+        self.assertEqual(collection_plan.event_key('E.1:p', 'cpu'), key)
+        self.assertEqual(collection_plan.event_key('E.1:uk', 'cpu'),
+                         collection_plan.event_key('cpu@E.1@ku', 'cpu'))
+        self.assertNotEqual(collection_plan.event_key('E.1:u', 'cpu'), key)
+        self.assertEqual(collection_plan.event_key('cpu@E.1\\,cmask\\=1@', 'cpu'),
+                         collection_plan.event_key('cpu/E.1,CMASK=1/', 'cpu'))
+
+    def test_perf_event(self):
+        self.assertEqual(collection_plan.perf_event('cpu@E.1\\,cmask\\=1@', 'cpu'),
+                         'cpu/E.1,cmask=1/')
+        self.assertEqual(collection_plan.perf_event('E.1:u', 'cpu_core'),
+                         'cpu_core/E.1/u')
+
+    def test_plan(self):
+        plan = collection_plan.plan_collection(_pmu(), {
+            'ipc': ['INST_RETIRED.ANY', 'CPU_CLK_UNHALTED.THREAD'],
+            'a': ['E.0', 'cpu@E.1@', 'CPU_CLK_UNHALTED.THREAD'],
+            'b': ['e.1', 'E.2', 'INST_RETIRED.ANY'],
+            'c': ['E.3', 'E.4', 'E.5'],
+            'retiring': ['topdown\\-retiring', 'TOPDOWN.SLOTS'],
+            'freq': ['CPU_CLK_UNHALTED.THREAD', 'duration_time'],
+            'big': ['E.0', 'E.1', 'E.2', 'E.3', 'E.4'],
+        })
+        # With the NMI watchdog holding a counter, 3 remain.
+        self.assertEqual(plan.groups, [
+            ['CPU_CLK_UNHALTED.THREAD', 'E.0', 'cpu/E.1/', 'E.2', 'INST_RETIRED.ANY',
+             'topdown-retiring', 'TOPDOWN.SLOTS'],
+            ['E.3', 'E.4', 'E.5'],
+        ])
+        self.assertEqual(plan.group_metrics, [['a', 'b', 'freq', 'ipc', 'retiring'],
+                                              ['c']])
+        self.assertEqual(plan.ungrouped, ['duration_time'])
+        self.assertEqual(plan.ungrouped_metrics, ['big'])
+        self.assertEqual(
+            plan.command_line(system_wide=True),
+            "perf stat -a -e '{CPU_CLK_UNHALTED.THREAD,E.0,cpu/E.1/,E.2,INST_RETIRED.ANY,"
+            "topdown-retiring,TOPDOWN.SLOTS},{E.3,E.4,E.5},duration_time'")
+
+        plan = collection_plan.plan_collection(_pmu(), {
+            'big': ['E.0', 'E.1', 'E.2', 'E.3', 'E.4'],
+            'a': ['E.0', 'E.1'],
+        }, nmi_watchdog=False)
+        self.assertEqual(plan.groups, [['E.0', 'E.1']])
+        self.assertEqual(plan.ungrouped, ['E.2', 'E.3', 'E.4'])
+
+    def test_metric_events(self):
+        json_metrics = [
+            {'MetricName': 'clks', 'MetricExpr': 'E.0 if #SMT_on else E.1'},
+            {'MetricName': 'ipc', 'MetricExpr': 'INST_RETIRED.ANY / CLKS'},
+        ]
+        self.assertEqual(collection_plan.metric_events(json_metrics, ['ipc'],
+                                                       {'#SMT_on': 0}),
+                         {'ipc': ['E.1', 'INST_RETIRED.ANY']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import glob
+import io
+import json
+import os
+import re
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import create_perf_json
+import event_groups
+
+
+def _reference_topic(event_name: str) -> str:
+    """The original, per-regular expression, topic classification of CPU events."""
+    result = None
+    result_priority = -1
+    for topic in sorted(create_perf_json._topics.keys()):
+        for regexp, priority in create_perf_json._topics[topic]:
+            if re.match(regexp, event_name) and priority >= result_priority:
+                result = topic
+                result_priority = priority
+            if priority < result_priority:
+                break
+    return result if result else 'Other'
+
+
+class TestTopic(unittest.TestCase):
+
+    def test_all_events(self):
+        event_files = glob.glob(os.path.join(scripts_dir, '..', '*', 'events', '*.json'))
+        self.assertGreater(len(event_files), 0)
+        names = set()
+        for event_file in event_files:
+            with open(event_file, 'r') as f:
+                for event in json.load(f).get('Events', []):
+                    name = event.get('EventName')
+                    if name:
+                        names.add(name)
+                        names.add(create_perf_json.PerfmonJsonEvent.fix_name(name))
+        for name in sorted(names):
+            self.assertEqual(create_perf_json.topic(name, None),
+                             _reference_topic(name), name)
+            self.assertEqual(create_perf_json.topic(name, 'cpu_core'),
+                             _reference_topic(name), name)
+
+    def test_uncore_units(self):
+        self.assertEqual(create_perf_json.topic('UNC_CHA_CLOCKTICKS', 'CHA'),
+                         'Uncore-Cache')
+        self.assertEqual(create_perf_json.topic('UNC_M_CAS_COUNT.RD', 'imc'),
+                         'Uncore-Memory')
+        with self.assertRaises(ValueError):
+            create_perf_json.topic('UNC_X', 'not_a_pmu')
+
+
+def _tma_sheet(rows: list[str]) -> create_perf_json.TmaSheet:
+    """A TMA spreadsheet with a SPR column and the given rows."""
+    header = 'Key,Level1,Level2,SPR,Metric Description,Metric Group,Threshold,Locate-with'
+    csv = '\n'.join([header] + rows) + '\n'
+    return create_perf_json.TmaSheet(io.StringIO(csv))
+
+
+class TestExtractTmaMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.model = create_perf_json.Model('SPR', 'sapphirerapids', 'v1',
+                                            {'GenuineIntel-6-8F'}, {})
+        self.events = {
+            name: create_perf_json.PerfmonJsonEvent('SPR', 'cpu', {'EventName': name})
+            for name in ['INST_RETIRED.ANY', 'CPU_CLK_UNHALTED.THREAD']
+        }
+
+    def test_nested_aux(self):
+        sheet = _tma_sheet([
+            'Aux,#Clks,,CPU_CLK_UNHALTED.THREAD,,,,',
+            'Aux,#Twice,,2 * #Clks,,,,',
+            'Info.Thread,IPC,,INST_RETIRED.ANY / #Twice,Instructions per cycle,,,',
+        ])
+        metrics = self.model.extract_tma_metrics(sheet, 'cpu', self.events)
+        self.assertEqual([m['MetricName'] for m in metrics], ['tma_info_thread_ipc'])
+        self.assertEqual(metrics[0]['MetricExpr'],
+                         'INST_RETIRED.ANY / (2 * CPU_CLK_UNHALTED.THREAD)')
+
+    def test_cycle(self):
+        sheet = _tma_sheet([
+            'Aux,#A,,#B + 1,,,,',
+            'Aux,#B,,2 * #A,,,,',
+            'Info.Thread,IPC,,INST_RETIRED.ANY / #A,Instructions per cycle,,,',
+        ])
+        with self.assertRaisesRegex(ValueError, '#A -> #B -> #A'):
+            self.model.extract_tma_metrics(sheet, 'cpu', self.events)
+
+
+class TestPreferFixedCounters(unittest.TestCase):
+
+    def test_prefer_fixed_counters(self):
+        core_pmu = event_groups.CorePmu.from_json('cpu', [
+            {'EventName': 'INST_RETIRED.ANY', 'Counter': 'Fixed counter 0'},
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD', 'Counter': 'Fixed counter 1'},
+            {'EventName': 'INST_RETIRED.ANY_P', 'Counter': '0,1'},
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD_P', 'Counter': '0,1'},
+        ])
+        equivalents = {'INST_RETIRED.ANY_P': 'INST_RETIRED.ANY',
+                       'CPU_CLK_UNHALTED.THREAD_P': 'CPU_CLK_UNHALTED.THREAD'}
+        metrics = create_perf_json.prefer_fixed_counters([
+            {'MetricName': 'cpi', 'MetricExpr': 'CPU_CLK_UNHALTED.THREAD_P:k / INST_RETIRED.ANY_P:k'},
+            {'MetricName': 'clks', 'MetricExpr': 'cpu@CPU_CLK_UNHALTED.THREAD_P@'},
+            # Fixed counter 1 can't count both THREAD and THREAD:k.
+            {'MetricName': 'kernel', 'MetricExpr': 'CPU_CLK_UNHALTED.THREAD_P:k / CPU_CLK_UNHALTED.THREAD'},
+            # A fixed counter can't count with a cmask.
+            {'MetricName': 'ge1', 'MetricExpr': 'cpu@INST_RETIRED.ANY_P\\,cmask\\=1@ / clks'},
+            # Using the fixed counter here would clash with ipc_k.
+            {'MetricName': 'ipc', 'MetricExpr': 'INST_RETIRED.ANY_P / CPU_CLK_UNHALTED.THREAD'},
+            {'MetricName': 'ipc_k', 'MetricExpr': 'ipc * INST_RETIRED.ANY:k'},
+        ], core_pmu, equivalents)
+        self.assertEqual([m['MetricExpr'] for m in metrics], [
+            'CPU_CLK_UNHALTED.THREAD:k / INST_RETIRED.ANY:k',
+            'cpu@CPU_CLK_UNHALTED.THREAD@',
+            'CPU_CLK_UNHALTED.THREAD_P:k / CPU_CLK_UNHALTED.THREAD',
+            'cpu@INST_RETIRED.ANY_P\\,cmask\\=1@ / clks',
+            'INST_RETIRED.ANY_P / CPU_CLK_UNHALTED.THREAD',
+            'ipc * INST_RETIRED.ANY:k',
+        ])
+
+
+class TestMetricsIndex(unittest.TestCase):
+
+    def test_index(self):
+        index = create_perf_json.metrics_index([
+            {'MetricName': 'slots', 'MetricExpr': '4 * CPU_CLK_UNHALTED.THREAD',
+             'MetricGroup': 'Info'},
+            {'MetricName': 'retiring', 'MetricExpr': 'UOPS_RETIRED.SLOTS / slots',
+             'MetricGroup': 'TopdownL1;Default'},
+            {'MetricName': 'smt', 'MetricExpr': '(1 if #SMT_on else 0) * retiring'},
+            {'MetricName': 'retiring', 'MetricExpr': 'TOPDOWN_RETIRING.ALL',
+             'Unit': 'cpu_atom'},
+        ])
+        self.assertEqual(list(index), ['cpu', 'cpu_atom'])
+        self.assertEqual(index['cpu']['Metrics']['smt'], {
+            'Events': ['CPU_CLK_UNHALTED.THREAD', 'UOPS_RETIRED.SLOTS'],
+            'Metrics': ['retiring', 'slots'],
+            'Literals': ['#SMT_on'],
+        })
+        self.assertEqual(index['cpu']['Events'], {
+            'CPU_CLK_UNHALTED.THREAD': ['retiring', 'slots', 'smt'],
+            'UOPS_RETIRED.SLOTS': ['retiring', 'smt'],
+        })
+        self.assertEqual(index['cpu']['MetricGroups'], {
+            'Default': ['retiring'],
+            'Info': ['slots'],
+            'TopdownL1': ['retiring'],
+        })
+        self.assertEqual(index['cpu_atom']['Events'],
+                         {'TOPDOWN_RETIRING.ALL': ['retiring']})
+
+
+if __name__ == '__main__':
+    unittest.main()
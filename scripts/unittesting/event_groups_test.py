@@ -0,0 +1,158 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import event_groups
+from event_groups import EventCounters
+
+
+def _pmu() -> event_groups.CorePmu:
+    """A core PMU like Skylake's with 4 counters, or 8 with SMT off."""
+    json_events = [
+        {'EventName': 'INST_RETIRED.ANY', 'Counter': 'Fixed counter 0'},
+        {'EventName': 'CPU_CLK_UNHALTED.THREAD', 'Counter': 'Fixed counter 1'},
+        {'EventName': 'CPU_CLK_UNHALTED.THREAD_ANY', 'Counter': 'Fixed counter 1'},
+        {'EventName': 'MEM_LOAD_RETIRED.L1_MISS', 'Counter': '0,1,2,3',
+         'CounterHTOff': '0,1,2,3,4,5,6,7'},
+        {'EventName': 'L1D_PEND_MISS.PENDING', 'Counter': '2',
+         'CounterHTOff': '2'},
+        {'EventName': 'FRONTEND_RETIRED.DSB_MISS', 'Counter': '0,1,2,3',
+         'CounterHTOff': '0,1,2,3,4,5,6,7', 'TakenAlone': '1',
+         'MSRIndex': '0x3F7', 'MSRValue': '0x11'},
+        {'EventName': 'FRONTEND_RETIRED.ITLB_MISS', 'Counter': '0,1,2,3',
+         'CounterHTOff': '0,1,2,3,4,5,6,7', 'TakenAlone': '1',
+         'MSRIndex': '0x3F7', 'MSRValue': '0x14'},
+        {'EventName': 'OFFCORE_RESPONSE.A', 'Counter': '0,1,2,3',
+         'CounterHTOff': '0,1,2,3,4,5,6,7', 'MSRIndex': '0x1a6,0x1a7',
+         'MSRValue': '0x1'},
+        {'EventName': 'OFFCORE_RESPONSE.B', 'Counter': '0,1,2,3',
+         'CounterHTOff': '0,1,2,3,4,5,6,7', 'MSRIndex': '0x1a6,0x1a7',
+         'MSRValue': '0x2'},
+        {'EventName': 'OFFCORE_RESPONSE.C', 'Counter': '0,1,2,3',
+         'CounterHTOff': '0,1,2,3,4,5,6,7', 'MSRIndex': '0x1a6,0x1a7',
+         'MSRValue': '0x4'},
+    ]
+    return event_groups.CorePmu.from_json('cpu', json_events)
+
+
+class TestEventGroups(unittest.TestCase):
+
+    def test_event_counters(self):
+        self.assertEqual(
+            EventCounters.from_json({'Counter': 'Fixed counter 2', 'MSRIndex': '0'}),
+            EventCounters(2, frozenset(), frozenset()))
+        self.assertEqual(
+            EventCounters.from_json({'Counter': '0,1', 'CounterHTOff': '0,1,4',
+                                     'TakenAlone': '1', 'MSRIndex': '0x3F7',
+                                     'MSRValue': '0x11'}),
+            EventCounters(None, frozenset([0, 1]), frozenset([0, 1, 4]), True,
+                          '0x3f7', '0x11'))
+
+    def test_parse_event(self):
+        self.assertEqual(event_groups.parse_event('cpu_core@INST_RETIRED.ANY@'),
+                         ('cpu_core', 'INST_RETIRED.ANY', ()))
+        self.assertEqual(event_groups.parse_event('CPU_CLK_UNHALTED.THREAD_P:k'),
+                         (None, 'CPU_CLK_UNHALTED.THREAD_P', ('k',)))
+        self.assertEqual(event_groups.parse_event('cpu@A.B\\,cmask\\=1@u'),
+                         ('cpu', 'A.B', ('cmask=1', 'u')))
+
+    def test_event_counters_of_pmu(self):
+        pmu = _pmu()
+        self.assertIsNone(pmu.event_counters('topdown\\-retiring'))
+        self.assertIsNone(pmu.event_counters('UNC_ARB_TRK_OCCUPANCY.ALL'))
+        self.assertIsNone(pmu.event_counters('msr@tsc@'))
+        self.assertEqual(pmu.event_counters('cycles-ct')[1].counters, frozenset([2]))
+        self.assertEqual(pmu.event_counters('cpu@inst_retired.any@')[1].fixed, 0)
+
+    def test_metric_constraint(self):
+        pmu = _pmu()
+
+        def constraint(events, smt_off_events=None):
+            return event_groups.metric_constraint(
+                pmu, [events], [events if smt_off_events is None else smt_off_events])
+
+        self.assertIsNone(constraint(['INST_RETIRED.ANY', 'CPU_CLK_UNHALTED.THREAD',
+                                      'MEM_LOAD_RETIRED.L1_MISS']))
+        # Different modifiers are different events.
+        l1_miss = ['MEM_LOAD_RETIRED.L1_MISS', 'MEM_LOAD_RETIRED.L1_MISS:u',
+                   'MEM_LOAD_RETIRED.L1_MISS:k']
+        self.assertIsNone(constraint(l1_miss + ['mem_load_retired.l1_miss:k']))
+        self.assertEqual(constraint(l1_miss + ['L1D_PEND_MISS.PENDING']),
+                         event_groups.NO_GROUP_EVENTS_NMI)
+        self.assertEqual(constraint(l1_miss + ['cycles-ct']),
+                         event_groups.NO_GROUP_EVENTS_NMI)
+        # Two events only counting on counter 2.
+        self.assertEqual(constraint(['L1D_PEND_MISS.PENDING', 'cycles-ct']),
+                         event_groups.NO_GROUP_EVENTS)
+        self.assertEqual(constraint(l1_miss + ['MEM_LOAD_RETIRED.L1_MISS:uk',
+                                               'MEM_LOAD_RETIRED.L1_MISS:H']),
+                         event_groups.NO_GROUP_EVENTS_SMT)
+        # Both events need fixed counter 1, unless SMT being off means
+        # only one of them is needed.
+        self.assertEqual(constraint(['CPU_CLK_UNHALTED.THREAD',
+                                     'CPU_CLK_UNHALTED.THREAD_ANY']),
+                         event_groups.NO_GROUP_EVENTS)
+        self.assertEqual(constraint(['CPU_CLK_UNHALTED.THREAD',
+                                     'CPU_CLK_UNHALTED.THREAD_ANY'],
+                                    ['CPU_CLK_UNHALTED.THREAD']),
+                         event_groups.NO_GROUP_EVENTS_SMT)
+
+    def test_msr_constraints(self):
+        pmu = _pmu()
+
+        def constraint(events):
+            return event_groups.metric_constraint(pmu, [events], [events])
+
+        self.assertIsNone(constraint(['OFFCORE_RESPONSE.A', 'OFFCORE_RESPONSE.B']))
+        self.assertEqual(constraint(['OFFCORE_RESPONSE.A', 'OFFCORE_RESPONSE.B',
+                                     'OFFCORE_RESPONSE.C']),
+                         event_groups.NO_GROUP_EVENTS)
+        self.assertIsNone(constraint(['FRONTEND_RETIRED.DSB_MISS',
+                                      'MEM_LOAD_RETIRED.L1_MISS']))
+        self.assertEqual(constraint(['FRONTEND_RETIRED.DSB_MISS',
+                                     'FRONTEND_RETIRED.ITLB_MISS']),
+                         event_groups.NO_GROUP_EVENTS)
+
+    def test_fixed_counter_equivalents(self):
+        json_events = [
+            {'EventName': 'INST_RETIRED.ANY', 'EventCode': '0x00', 'UMask': '0x01',
+             'Counter': 'Fixed counter 0'},
+            {'EventName': 'CPU_CLK_UNHALTED.CORE', 'EventCode': '0x00', 'UMask': '0x02',
+             'Counter': 'Fixed counter 1'},
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD', 'EventCode': '0x00', 'UMask': '0x02',
+             'Counter': 'Fixed counter 1'},
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD_ANY', 'EventCode': '0x00', 'UMask': '0x02',
+             'Counter': 'Fixed counter 1', 'AnyThread': '1'},
+            {'EventName': 'INST_RETIRED.ANY_P', 'EventCode': '0xC0', 'UMask': '0x00',
+             'Counter': '0,1,2,3'},
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD_P', 'EventCode': '0x3C', 'UMask': '0x00',
+             'Counter': '0,1,2,3'},
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD_P_ANY', 'EventCode': '0x3C', 'UMask': '0x00',
+             'Counter': '0,1,2,3', 'AnyThread': '1'},
+            # Same code but counts differently.
+            {'EventName': 'CPU_CLK_UNHALTED.RING0_TRANS', 'EventCode': '0x3C', 'UMask': '0x00',
+             'Counter': '0,1,2,3', 'CounterMask': '1', 'EdgeDetect': '1'},
+            {'EventName': 'CPU_CLK_UNHALTED.REF_XCLK', 'EventCode': '0x3C', 'UMask': '0x01',
+             'Counter': '0,1,2,3'},
+        ]
+        self.assertEqual(event_groups.fixed_counter_equivalents(json_events), {
+            'INST_RETIRED.ANY_P': 'INST_RETIRED.ANY',
+            'CPU_CLK_UNHALTED.THREAD_P': 'CPU_CLK_UNHALTED.THREAD',
+            'CPU_CLK_UNHALTED.THREAD_P_ANY': 'CPU_CLK_UNHALTED.THREAD_ANY',
+        })
+        # Models without the fixed counters' pseudo encodings.
+        self.assertEqual(event_groups.fixed_counter_equivalents([
+            {'EventName': 'INST_RETIRED.ANY', 'EventCode': '0x0', 'UMask': '0x0',
+             'Counter': 'Fixed counter 1'},
+            {'EventName': 'INST_RETIRED.ANY_P', 'EventCode': '0xC0', 'UMask': '0x00',
+             'Counter': '0,1'},
+        ]), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import event_groups
+import metric_budget
+
+
+def _pmu() -> event_groups.CorePmu:
+    """A core PMU with 4 programmable counters and 2 fixed counters."""
+    json_events = [
+        {'EventName': 'INST_RETIRED.ANY', 'Counter': 'Fixed counter 0'},
+        {'EventName': 'CPU_CLK_UNHALTED.THREAD', 'Counter': 'Fixed counter 1'},
+    ] + [{'EventName': f'E.{i}', 'Counter': '0,1,2,3'} for i in range(6)]
+    return event_groups.CorePmu.from_json('cpu', json_events)
+
+
+class TestMetricBudget(unittest.TestCase):
+
+    def test_select_within_budget(self):
+        metric_events = {
+            'ipc': ['INST_RETIRED.ANY', 'CPU_CLK_UNHALTED.THREAD'],
+            'a': ['E.0', 'E.4', 'E.5', 'CPU_CLK_UNHALTED.THREAD'],
+            'b': ['E.2'],
+            'c': ['E.3'],
+            'd': ['E.1'],
+            'big': ['E.0', 'E.1', 'E.2', 'E.3', 'E.4'],
+            'freq': ['CPU_CLK_UNHALTED.THREAD', 'duration_time'],
+        }
+        weights = {'ipc': 1, 'a': 3, 'b': 2, 'c': 2, 'd': 0.5, 'big': 10, 'freq': 1}
+        # With the NMI watchdog holding a counter, 3 remain. Greedily
+        # taking a would leave room for none of b, c and d.
+        selection = metric_budget.select_within_budget(_pmu(), metric_events, weights)
+        self.assertEqual(selection.metrics, ['b', 'c', 'd', 'freq', 'ipc'])
+        self.assertEqual(selection.weight, 6.5)
+        self.assertEqual(selection.dropped, ['a', 'big'])
+        self.assertEqual(selection.plan.groups, [['CPU_CLK_UNHALTED.THREAD', 'E.1', 'E.2',
+                                                  'E.3', 'INST_RETIRED.ANY']])
+        self.assertEqual(selection.plan.ungrouped, ['duration_time'])
+
+        selection = metric_budget.select_within_budget(_pmu(), metric_events, weights,
+                                                       gp_counters=2)
+        # The NMI watchdog leaves 1 counter of the 2.
+        self.assertEqual(selection.metrics, ['b', 'freq', 'ipc'])
+
+        selection = metric_budget.select_within_budget(_pmu(), metric_events, weights,
+                                                       nmi_watchdog=False)
+        self.assertEqual(selection.metrics, ['a', 'b', 'freq', 'ipc'])
+        self.assertEqual(selection.weight, 7)
+        self.assertTrue(selection.optimal)
+
+        # Stopped before searching, the greedy selection is kept.
+        selection = metric_budget.select_within_budget(_pmu(), metric_events, weights,
+                                                       nmi_watchdog=False, max_nodes=0)
+        self.assertEqual(selection.metrics, ['b', 'c', 'd', 'freq', 'ipc'])
+        self.assertFalse(selection.optimal)
+
+        selection = metric_budget.select_within_budget(_pmu(), metric_events, {'big': 1},
+                                                       nmi_watchdog=False, gp_counters=5)
+        self.assertEqual(selection.metrics, [])
+        self.assertEqual(selection.plan.groups, [])
+        self.assertEqual(selection.plan.ungrouped, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,7 @@
 # SPDX-License-Identifier: BSD-3-Clause
+import glob
+import json
+import math
 import os
 import sys
 import unittest
@@ -8,10 +11,18 @@ format_converter_dir = os.path.join(unittest_dir, '..')
 sys.path.append(format_converter_dir)
 
 # pylint: disable=g-import-not-at-top
+import metric
+from metric import BatchEvaluator
+from metric import ClearParseCache
 from metric import Constant
 from metric import Event
-from metric import Expression
+from metric import InternTable
+from metric import MetricClosures
+from metric import MetricDag
+from metric import Literal
+from metric import ParseCacheInfo
 from metric import ParsePerfJson
+from metric import RenameEvents
 from metric import RewriteMetricsInTermsOfOthers
 
 
@@ -68,6 +79,39 @@ class TestMetricExpressions(unittest.TestCase):
     after = before
     self.assertEqual(ParsePerfJson(before).ToPerfJson(), after)
 
+  def test_ParsePerfJsonRepoMetrics(self):
+    # Every perf json metric in the repo parses and round trips.
+    metric_files = glob.glob(os.path.join(unittest_dir, '..', '..', '*',
+                                          'metrics', 'perf', '*.json'))
+    self.assertGreater(len(metric_files), 0)
+    for metric_file in metric_files:
+      with open(metric_file, 'r') as f:
+        for m in json.load(f):
+          for key in ['MetricExpr', 'MetricThreshold']:
+            if key in m:
+              parsed = ParsePerfJson(m[key])
+              self.assertEqual(ParsePerfJson(parsed.ToPerfJson()), parsed,
+                               m[key])
+
+  def test_ParsePerfJsonErrors(self):
+    for bad in ['a b', 'a +', '(a', 'a if b', 'min(a)', 'a ** b', 'if']:
+      with self.assertRaises(SyntaxError, msg=bad):
+        ParsePerfJson(bad)
+
+  def test_ParsePerfJsonPrecedence(self):
+    # Comparisons bind tighter than the bitwise operators, unlike python.
+    before = 'a > 1 & b < 2 | c'
+    parsed = ParsePerfJson(before)
+    self.assertEqual(parsed.operator, '|')
+    self.assertEqual(parsed.lhs.operator, '&')
+    self.assertEqual(parsed.lhs.lhs, ParsePerfJson('(a > 1)'))
+    self.assertEqual(parsed.ToPerfJson(), before)
+
+    # Operations on constants are folded.
+    self.assertEqual(ParsePerfJson('2 * 3 * a').ToPerfJson(), '6 * a')
+    self.assertEqual(ParsePerfJson('a - -1').ToPerfJson(), 'a - -1')
+    self.assertEqual(ParsePerfJson('-a').ToPerfJson(), '0 - a')
+
   def test_IfElseTests(self):
     # if-else needs rewriting to Select and back.
     before = r'Event1 if #smt_on else Event2'
@@ -162,14 +206,276 @@ class TestMetricExpressions(unittest.TestCase):
     before = '0 * SLOTS'
     after = '0 * SLOTS'
     self.assertEqual(ParsePerfJson(before).Simplify().ToPerfJson(), after)
+    before = 'a + 0 * SLOTS'
+    after = '0 * SLOTS + a'
+    self.assertEqual(ParsePerfJson(before).Simplify().ToPerfJson(), after)
+
+  def test_SimplifyNormalizes(self):
+    def simplified(before: str) -> str:
+      return ParsePerfJson(before).Simplify().ToPerfJson()
+
+    # Chains of '&' and '|' are flattened and their operands sorted.
+    self.assertEqual(simplified('b > 1 & (a > 1 & b > 1)'), 'a > 1 & b > 1')
+    self.assertEqual(simplified('a + b'), simplified('b + a'))
+    self.assertEqual(simplified('b * 2'), '2 * b')
+
+    # Sums and products keep their order of operations, only the
+    # operands of each '+' and '*' are swapped, as floating point
+    # addition and multiplication aren't associative.
+    self.assertEqual(simplified('c + (b + a)'), 'a + b + c')
+    self.assertEqual(simplified('c + b + a'), 'a + (b + c)')
+    self.assertEqual(simplified('a - (c - b)'), 'a - (c - b)')
+    self.assertEqual(simplified('1 - (a + b + c)'), '1 - (a + b + c)')
+    self.assertEqual(simplified('(3 * a) - (2 * a)'), '3 * a - 2 * a')
+    self.assertEqual(simplified('a - a'), 'a - a')
+    self.assertEqual(simplified('a + 0 - 0'), 'a')
+    self.assertEqual(simplified('c * (b * a)'), 'a * b * c')
+    self.assertEqual(simplified('a / b / c'), 'a / b / c')
+    self.assertEqual(simplified('a / (b / 2)'), 'a / (b / 2)')
+    self.assertEqual(simplified('1 * a / 1'), 'a')
+    counts = {'a': 0.1, 'b': 0.2, 'c': 0.7}
+    self.assertEqual(counts['a'] + counts['b'] + counts['c'], 1.0)
+    self.assertEqual(ParsePerfJson('1 - (a + b + c)').Simplify().Compile()(counts), 0.0)
+    self.assertEqual(ParsePerfJson('max(1 - (a + b + c), 0)').Simplify().Compile()(counts), 0.0)
+    counts = {'a': 3, 'b': 0, 'c': 0.1}
+    self.assertEqual(ParsePerfJson('c - a / (a + b) * c').Simplify().Compile()(counts), 0.0)
+
+    # Expressions perf computes as NaN, when a count is 0, stay NaN.
+    self.assertEqual(simplified('#a / #b * #b'), '#a / #b * #b')
+    self.assertEqual(simplified('a / b - a / b'), 'a / b - a / b')
+    self.assertEqual(simplified('0 * (a / b)'), '0 * (a / b)')
+    self.assertEqual(simplified('0 * min(a / b, 1)'), '0 * min(a / b, 1)')
+    self.assertEqual(simplified('0 * (a > b)'), '0')
+    for (form, counts) in [('a / (b / c)', {'a': 1, 'b': 2, 'c': 0}),
+                           ('a * b / b', {'a': 1, 'b': 0}),
+                           ('a / b - a / b', {'a': 1, 'b': 0})]:
+      self.assertTrue(math.isnan(ParsePerfJson(form).Simplify().Compile()(counts)), form)
+
+    # Constants fold exactly and only when perf can read the result.
+    self.assertEqual(simplified('0.1 + 0.2'), '0.3')
+    self.assertEqual(simplified('1 / 3'), '1 / 3')
+    self.assertEqual(simplified('a / 0'), 'a / 0')
+    self.assertEqual(simplified('(2 - 1) * a'), 'a')
+    self.assertEqual(simplified('d_ratio(a, 0) + d_ratio(1, 0)'), 'd_ratio(a, 0)')
+    self.assertEqual(simplified('d_ratio(1, 8)'), '0.125')
+    self.assertEqual(simplified('max(2, min(3, 4))'), '3')
+    self.assertEqual(simplified('1 > 2 | a'), 'a')
+    self.assertEqual(simplified('a > 1 & 0'), '0')
 
   def test_RewriteMetricsInTermsOfOthers(self):
-    Expression.__eq__ = lambda e1, e2: e1.Equals(e2)
     before = [('m1', ParsePerfJson('a + b + c + d')),
               ('m2', ParsePerfJson('a + b + c'))]
     after = {'m1': ParsePerfJson('m2 + d')}
     self.assertEqual(RewriteMetricsInTermsOfOthers(before), after)
-    Expression.__eq__ = None
+
+    # Rewrites use the shortened forms of other metrics.
+    before = [('m1', ParsePerfJson('a + b + c + d')),
+              ('m2', ParsePerfJson('a + b + c')),
+              ('m3', ParsePerfJson('(a + b + c + d) * e + (x + y)')),
+              ('m4', ParsePerfJson('x + y + z'))]
+    after = {'m1': ParsePerfJson('m2 + d'),
+             'm3': ParsePerfJson('m1 * e + (x + y)')}
+    self.assertEqual(RewriteMetricsInTermsOfOthers(before), after)
+
+  def test_Hash(self):
+    before = '(a + b if #SMT_on else min(c, 1e3)) / d_ratio(e, f)'
+    e1 = ParsePerfJson(before)
+    ClearParseCache()
+    e2 = ParsePerfJson(before)
+    self.assertIsNot(e1, e2)
+    self.assertEqual(e1, e2)
+    self.assertEqual(hash(e1), hash(e2))
+    self.assertNotEqual(e1, ParsePerfJson('(a + b if #SMT_on else min(c, 1e3)) / d_ratio(f, e)'))
+    self.assertNotEqual(ParsePerfJson('a - b'), ParsePerfJson('b - a'))
+    self.assertNotEqual(Event('a'), Literal('a'))
+    self.assertEqual({e1: 1}[e2], 1)
+
+  def test_ParseCache(self):
+    ClearParseCache()
+    self.assertEqual(ParseCacheInfo()[:2], (0, 0))
+    e1 = ParsePerfJson('a + b')
+    e2 = ParsePerfJson('a + b')
+    self.assertIs(e1, e2)
+    ParsePerfJson('a + c')
+    hits, misses, maxsize, size = ParseCacheInfo()
+    self.assertEqual((hits, misses, size), (1, 2, 2))
+    self.assertGreater(maxsize, 0)
+    ClearParseCache()
+    self.assertEqual(ParseCacheInfo()[3], 0)
+    self.assertIsNot(ParsePerfJson('a + b'), e1)
+
+  def test_Intern(self):
+    table = InternTable()
+    e1 = ParsePerfJson('(a + b) / (c * (a + b))').Intern(table)
+    self.assertIs(e1.lhs, e1.rhs.rhs)
+    e2 = ParsePerfJson('(a + b) * 2').Intern(table)
+    self.assertIs(e1.lhs, e2.lhs)
+    self.assertIs(e1, ParsePerfJson('(a + b) / (c * (a + b))').Intern(table))
+    # a, b, a + b, c, c * (a + b), e1, 2, e2
+    self.assertEqual(len(table), 8)
+
+  def test_Compile(self):
+    fn = ParsePerfJson('(a + b) * 2 / c').Compile()
+    self.assertEqual(fn({'a': 1, 'b': 2, 'c': 3}), 2.0)
+    self.assertTrue(math.isnan(fn({'a': 1, 'b': 2, 'c': 0})))
+    fn = ParsePerfJson('(a + b) * 2 / c').Compile(['c', 'b', 'a'])
+    self.assertEqual(fn([3, 2, 1]), 2.0)
+    with self.assertRaises(KeyError):
+      ParsePerfJson('a + d').Compile(['a'])([1])
+
+    # Perf semantics of functions, comparisons and logical operators.
+    fn = ParsePerfJson('d_ratio(a, b)').Compile()
+    self.assertEqual(fn({'a': 1, 'b': 0}), 0.0)
+    self.assertEqual(fn({'a': 1, 'b': 4}), 0.25)
+    fn = ParsePerfJson('min(a, b) + max(a, b) * 10').Compile()
+    self.assertEqual(fn({'a': 1, 'b': 2}), 21.0)
+    # Like perf, the second argument unless the first compares less or
+    # greater.
+    self.assertEqual(fn({'a': math.nan, 'b': 1}), 11.0)
+    self.assertTrue(math.isnan(fn({'a': 1, 'b': math.nan})))
+    fn = ParsePerfJson('(a > 1) + (a < 1) * 2 + (a | b) * 4 + (a & b) * 8 + '
+                       '(a ^ b) * 16').Compile()
+    self.assertEqual(fn({'a': 2, 'b': 0}), 1 + 4 + 16)
+    self.assertEqual(fn({'a': 0, 'b': 3}), 2 + 4 + 16)
+    self.assertEqual(fn({'a': 1, 'b': 3}), 4 + 8)
+
+    # Runtime literals and only the taken if-else side is evaluated.
+    fn = ParsePerfJson('(a / 2 if #SMT_on else a) * #num_dies').Compile()
+    self.assertEqual(fn({'a': 8}, {'#SMT_on': 1, '#num_dies': 2}), 8.0)
+    self.assertEqual(fn({'a': 8}, {'#SMT_on': 0, '#num_dies': 2}), 16.0)
+    fn = ParsePerfJson('b if has_event(b) else a').Compile()
+    self.assertEqual(fn({'a': 1}), 1.0)
+    self.assertEqual(fn({'a': 1, 'b': 2}), 2.0)
+    fn = ParsePerfJson('b if has_event(b) else a').Compile(['a'])
+    self.assertEqual(fn([1]), 1.0)
+    fn = ParsePerfJson('a / source_count(a)').Compile()
+    self.assertEqual(fn({'a': 6}), 6.0)
+    self.assertEqual(fn({'a': 6}, {'source_count(a)': 3}), 2.0)
+
+    # Perf json event names are used for counts.
+    fn = ParsePerfJson(r'cpu@INST_RETIRED.ANY@ / topdown\-fe\-bound').Compile()
+    self.assertEqual(fn({'cpu@INST_RETIRED.ANY@': 4,
+                         r'topdown\-fe\-bound': 2}), 2.0)
+
+  def _BatchTest(self, use_numpy: bool):
+    evaluator = BatchEvaluator({
+        'ipc': ParsePerfJson('inst / cycles'),
+        'smt': ParsePerfJson('(a / 2 if #SMT_on else a) + d_ratio(a, cycles)'),
+        'sel': ParsePerfJson('max(a, inst) if a > inst else min(a, inst) - 1'),
+        'has': ParsePerfJson('b if has_event(b) else a % 3'),
+        'dies': ParsePerfJson('#num_dies * 2'),
+        'mod': ParsePerfJson('(a % big) + (big % a)'),
+    }, use_numpy=use_numpy)
+    values = evaluator.Evaluate({
+        'inst': [2, 4, 6],
+        'cycles': [1, 0, 3],
+        'a': [8, 1, 5],
+        'big': [math.inf, 7.5, 2],
+    }, {'#SMT_on': 1, '#num_dies': 2})
+    self.assertEqual(list(values['ipc'][::2]), [2.0, 2.0])
+    self.assertTrue(math.isnan(values['ipc'][1]))
+    self.assertEqual(list(values['smt']), [12.0, 0.5, 2.5 + 5 / 3])
+    self.assertEqual(list(values['sel']), [8.0, 0.0, 4.0])
+    self.assertEqual(list(values['has']), [2.0, 1.0, 2.0])
+    self.assertEqual(list(values['dies']), [4.0, 4.0, 4.0])
+    # Modulo of a non-finite value is NaN.
+    self.assertTrue(math.isnan(values['mod'][0]))
+    self.assertEqual(list(values['mod'][1:]), [1.0, 3.0])
+
+  def test_BatchEvaluator(self):
+    self._BatchTest(use_numpy=False)
+
+  @unittest.skipIf(metric.numpy is None, 'NumPy is not installed')
+  def test_BatchEvaluatorNumPy(self):
+    self._BatchTest(use_numpy=True)
+
+  @unittest.skipUnless(metric.numpy is None, 'NumPy is installed')
+  def test_BatchEvaluatorNoNumPy(self):
+    self.assertFalse(BatchEvaluator({}).use_numpy)
+    with self.assertRaises(ImportError):
+      BatchEvaluator({}, use_numpy=True)
+
+  def test_MetricDag(self):
+    json_metrics = [
+        {'MetricName': 'slots', 'MetricExpr': '4 * cycles'},
+        {'MetricName': 'ipc', 'MetricExpr': 'inst / cycles'},
+        {'MetricName': 'retiring', 'MetricExpr': 'uops / SLOTS'},
+        {'MetricName': 'frac', 'MetricExpr': '(uops / (4 * cycles)) * '
+                                             '(a if #SMT_on else b)'},
+    ]
+    dag = MetricDag.FromPerfJson(json_metrics)
+    # cycles, 4 * cycles, inst, ipc, uops, retiring, a, #SMT_on, b,
+    # the if-else and frac.
+    self.assertEqual(dag.Nodes(), 11)
+    values = dag.Evaluate({'cycles': 2, 'inst': 4, 'uops': 4, 'a': 3},
+                          {'#SMT_on': 1})
+    self.assertEqual(values, {'slots': 8.0, 'ipc': 2.0, 'retiring': 0.5,
+                              'frac': 1.5})
+    values = dag.Evaluate({'cycles': 0, 'inst': 4}, {'#SMT_on': 0})
+    self.assertTrue(math.isnan(values['ipc']))
+    self.assertTrue(math.isnan(values['frac']))
+
+    self.assertEqual(dag.Events(), ['cycles', 'inst', 'uops', 'a', 'b'])
+    self.assertEqual(dag.Literals(), ['#SMT_on'])
+    dag = MetricDag.FromPerfJson(json_metrics, roots=['RETIRING'])
+    self.assertEqual(dag.names, ['retiring'])
+    self.assertEqual(dag.Events(), ['uops', 'cycles'])
+
+    with self.assertRaisesRegex(ValueError, 'a -> b -> a'):
+      MetricDag({'a': ParsePerfJson('b + 1'), 'b': ParsePerfJson('2 * a')})
+
+  def test_MetricClosures(self):
+    metrics = {
+        'slots': ParsePerfJson('4 * cycles'),
+        'retiring': ParsePerfJson('uops / SLOTS'),
+        'clks': ParsePerfJson('(any / 2 if #SMT_on else cycles) if #core_wide '
+                              'else cycles'),
+    }
+    closures = MetricClosures(metrics)
+    self.assertEqual(closures['retiring'],
+                     (frozenset([Event('uops'), Constant(4), Event('cycles')]),
+                      frozenset(['slots'])))
+    self.assertEqual(closures['slots'][1], frozenset())
+    self.assertEqual(len(closures['clks'][0]), 5)
+
+    def events(literals):
+      return sorted(str(e.name) for e in MetricClosures(metrics, literals)['clks'][0]
+                    if isinstance(e, Event))
+    self.assertEqual(events({'#SMT_on': 1, '#core_wide': 1}), ['any'])
+    self.assertEqual(events({'#SMT_on': 0, '#core_wide': 1}), ['cycles'])
+    self.assertEqual(events({'#SMT_on': 1}), ['any', 'cycles'])
+    # Like perf, the case of literals is ignored.
+    self.assertEqual(events({'#smt_on': 0, '#CORE_WIDE': 1}), ['cycles'])
+
+    with self.assertRaisesRegex(ValueError, 'a -> b -> a'):
+      MetricClosures({'a': ParsePerfJson('b + 1'), 'b': ParsePerfJson('2 * a')})
+
+  def test_RenameEvents(self):
+    before = ParsePerfJson('(a / b if #SMT_on else max(a, c)) + d')
+    after = RenameEvents(before, {'a': 'x', 'c': 'y'})
+    self.assertEqual(after.ToPerfJson(), '(x / b if #SMT_on else max(x, y)) + d')
+    self.assertIs(RenameEvents(before, {'z': 'x'}), before)
+
+  def test_Specialize(self):
+    clks = ParsePerfJson('(any / 2 if #SMT_on else cycles) if #core_wide else cycles')
+    self.assertEqual(clks.Specialize({'#smt_on': 0}).Simplify().ToPerfJson(),
+                     'cycles')
+    self.assertEqual(clks.Specialize({'#SMT_on': 1, '#core_wide': 1}).ToPerfJson(),
+                     'any / 2')
+    self.assertEqual(clks.Specialize({'#SMT_on': 1}).ToPerfJson(),
+                     '(any / 2 if #core_wide else cycles)')
+    self.assertEqual(clks.Specialize({}).ToPerfJson(), clks.ToPerfJson())
+
+    bw = ParsePerfJson('a / (source_count(a) * #num_packages) / (2 * max(1, 3))')
+    self.assertEqual(bw.Specialize({'source_count(a)': 4, '#num_packages': 2}).ToPerfJson(),
+                     'a / 8 / 6')
+    self.assertEqual(bw.Specialize({'#num_packages': 2}).ToPerfJson(),
+                     'a / (source_count(a) * 2) / 6')
+    # Values perf computes as NaN aren't folded.
+    self.assertEqual(ParsePerfJson('a * (1 / #x)').Specialize({'#x': 0}).ToPerfJson(),
+                     'a * (1 / 0)')
+    self.assertEqual(ParsePerfJson('d_ratio(1, #x)').Specialize({'#x': 0}).ToPerfJson(),
+                     '0')
 
 if __name__ == '__main__':
   unittest.main()
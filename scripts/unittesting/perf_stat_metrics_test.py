@@ -0,0 +1,245 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import io
+import json
+import os
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import metric
+import perf_stat_metrics
+
+test_inputs_dir = os.path.join(unittest_dir, 'test_inputs')
+
+
+def _calculator(roots=None, smt_on=1.0) -> perf_stat_metrics.MetricCalculator:
+    with open(os.path.join(test_inputs_dir, 'perf_stat_metrics.json'), 'r') as f:
+        json_metrics = json.load(f)
+    return perf_stat_metrics.MetricCalculator(
+        metric.MetricDag.FromPerfJson(json_metrics, roots), {'#SMT_on': smt_on})
+
+
+def _rows(calculator: perf_stat_metrics.MetricCalculator, input_name: str):
+    output = io.StringIO()
+    with open(os.path.join(test_inputs_dir, input_name), 'r') as lines:
+        perf_stat_metrics.write_metrics(calculator, lines, output)
+    return output.getvalue().splitlines()
+
+
+class TestReadSamples(unittest.TestCase):
+
+    def test_csv(self):
+        samples = list(perf_stat_metrics.read_samples([
+            '# started on Tue Oct 14 10:00:00 2025',
+            '',
+            '     1.001,2000,,INST_RETIRED.ANY,1001,100.00,2.00,insn per cycle',
+            '     1.001,CPU3,10,,cpu_core/TOPDOWN.SLOTS/,1001,100.00,,',
+            '     1.001,S0-D0-C1,2,30,,cycles,1001,100.00,,',
+            '     1.001,<not counted>,,topdown-retiring,0,0.00,,',
+            '     1.001,,,,,,1.5,insn per cycle',
+        ]))
+        self.assertEqual(samples, [
+            perf_stat_metrics.Sample('1.001', '', 'INST_RETIRED.ANY', 2000.0),
+            perf_stat_metrics.Sample('1.001', 'CPU3', 'cpu_core/TOPDOWN.SLOTS/', 10.0),
+            perf_stat_metrics.Sample('1.001', 'S0-D0-C1', 'cycles', 30.0),
+            perf_stat_metrics.Sample('1.001', '', 'topdown-retiring', None),
+        ])
+
+    def test_json(self):
+        samples = list(perf_stat_metrics.read_samples([
+            '{"interval" : 1.5, "cpu" : "2", "counter-value" : "7.000000", "event" : "cycles"}',
+            '{"interval" : 1.5, "metric-value" : "none", "metric-unit" : ""}',
+        ]))
+        self.assertEqual(samples, [perf_stat_metrics.Sample('1.5', '2', 'cycles', 7.0)])
+
+    def test_error(self):
+        with self.assertRaisesRegex(ValueError, 'Line 2'):
+            list(perf_stat_metrics.read_samples(['1.0,1,,a,,,,', '{"interval"']))
+
+
+class TestReadIntervals(unittest.TestCase):
+
+    def test_intervals(self):
+        samples = [
+            perf_stat_metrics.Sample('1.0', '', 'a', 1.0),
+            perf_stat_metrics.Sample('1.0', '', 'a', 2.0),
+            perf_stat_metrics.Sample('1.0', '', 'b', None),
+            perf_stat_metrics.Sample('2.0', 'S0', 'a', 3.0),
+        ]
+        self.assertEqual(list(perf_stat_metrics.read_intervals(samples)), [
+            ('1.0', {'': {'a': 3.0}}),
+            ('2.0', {'S0': {'a': 3.0}}),
+        ])
+
+    def test_streaming(self):
+        # After the header, each interval's metric is written once the
+        # next interval's first line is read, without reading further.
+        calculator = _calculator(['tma_info_thread_ipc'])
+        output = io.StringIO()
+        written = []
+
+        def lines():
+            for interval in ['1.0', '2.0', '3.0']:
+                yield f'{interval},4,,INST_RETIRED.ANY,1,100.00,,'
+                written.append(len(output.getvalue().splitlines()))
+                yield f'{interval},2,,CPU_CLK_UNHALTED.THREAD,1,100.00,,'
+
+        perf_stat_metrics.write_metrics(calculator, lines(), output)
+        self.assertEqual(written, [1, 2, 3])
+        self.assertEqual(len(output.getvalue().splitlines()), 4)
+
+
+class TestWriteMetrics(unittest.TestCase):
+
+    def test_csv(self):
+        self.assertEqual(_rows(_calculator(), 'perf_stat_interval.csv'), [
+            'time,aggregate,metric,value',
+            '1.001095325,,tma_info_thread_ipc,2.0',
+            '1.001095325,,tma_info_core_coreipc,2.5',
+            '1.001095325,,tma_info_core_core_clks,800.0',
+            '1.001095325,,tma_info_thread_clks,1000.0',
+            '1.001095325,,tma_retiring,0.25',
+            '1.001095325,,tma_info_thread_slots,4000.0',
+            # The topdown events weren't counted.
+            '2.002311456,,tma_info_thread_ipc,1.5',
+            '2.002311456,,tma_info_core_coreipc,3.0',
+            '2.002311456,,tma_info_core_core_clks,1000.0',
+            '2.002311456,,tma_info_thread_clks,2000.0',
+        ])
+
+    def test_json(self):
+        with open(os.path.join(test_inputs_dir, 'perf_stat_metrics.json'), 'r') as f:
+            roots = perf_stat_metrics.select_metrics(json.load(f), ['Summary', 'SMT'])
+        self.assertEqual(roots, ['tma_info_thread_ipc', 'tma_info_core_coreipc',
+                                 'tma_info_core_core_clks'])
+        self.assertEqual(_rows(_calculator(roots, smt_on=0.0), 'perf_stat_interval.json'), [
+            'time,aggregate,metric,value',
+            '1.001095325,S0,tma_info_thread_ipc,2.0',
+            '1.001095325,S0,tma_info_core_coreipc,2.0',
+            '1.001095325,S0,tma_info_core_core_clks,1000.0',
+            '1.001095325,S1,tma_info_thread_ipc,0.5',
+            '1.001095325,S1,tma_info_core_coreipc,0.5',
+            '1.001095325,S1,tma_info_core_core_clks,2000.0',
+            '2.002311456,S0,tma_info_core_core_clks,1000.0',
+            '2.002311456,S1,tma_info_thread_ipc,4.0',
+            '2.002311456,S1,tma_info_core_coreipc,4.0',
+            '2.002311456,S1,tma_info_core_core_clks,1000.0',
+        ])
+
+    def test_missing_literal(self):
+        with open(os.path.join(test_inputs_dir, 'perf_stat_metrics.json'), 'r') as f:
+            dag = metric.MetricDag.FromPerfJson(json.load(f))
+        with self.assertRaisesRegex(ValueError, '#SMT_on'):
+            perf_stat_metrics.MetricCalculator(dag, {})
+
+    def test_literal_case(self):
+        # Like perf, the case of literals is ignored.
+        with open(os.path.join(test_inputs_dir, 'perf_stat_metrics.json'), 'r') as f:
+            dag = metric.MetricDag.FromPerfJson(json.load(f))
+        calculator = perf_stat_metrics.MetricCalculator(dag, {'#smt_on': 0.0})
+        self.assertEqual(calculator.literals, {'#SMT_on': 0.0})
+
+    def test_pmu_prefix(self):
+        dag = metric.MetricDag({'ipc': metric.ParsePerfJson(
+            'cpu_core@INST_RETIRED.ANY@ / cpu_core@CPU_CLK_UNHALTED.THREAD@')})
+        calculator = perf_stat_metrics.MetricCalculator(dag, {})
+        self.assertEqual(calculator.calculate({'cpu_core/INST_RETIRED.ANY/': 4.0,
+                                               'CPU_CLK_UNHALTED.THREAD': 2.0}),
+                         {'ipc': 2.0})
+
+
+# A TMA tree with a level 1 metric, 'fe', whose children are 'lat' and
+# 'bw', and 'lat' has the child 'icache'.
+_tma_metrics = [
+    {'MetricName': 'tma_fe', 'MetricExpr': 'FE / SLOTS', 'MetricGroup': 'TopdownL1;tma_L1_group',
+     'MetricThreshold': 'tma_fe > 0.15'},
+    {'MetricName': 'tma_lat', 'MetricExpr': 'LAT / SLOTS', 'MetricGroup': 'tma_fe_group',
+     'MetricThreshold': 'tma_lat > 0.1 & tma_fe > 0.15'},
+    {'MetricName': 'tma_bw', 'MetricExpr': 'tma_fe - tma_lat', 'MetricGroup': 'tma_fe_group'},
+    {'MetricName': 'tma_icache', 'MetricExpr': 'ICACHE / SLOTS',
+     'MetricGroup': 'tma_lat_group', 'MetricThreshold': 'tma_icache > 0.05 & #P'},
+    {'MetricName': 'ipc', 'MetricExpr': 'INST / CYCLES', 'MetricGroup': 'Summary'},
+]
+
+
+class TestDrillDown(unittest.TestCase):
+
+    def test_select_metrics(self):
+        self.assertEqual(perf_stat_metrics.select_metrics(_tma_metrics, ['IPC', 'TopdownL1']),
+                         ['ipc', 'tma_fe'])
+        self.assertEqual(perf_stat_metrics.select_metrics(_tma_metrics, ['TMA_*', 'tma_fe']),
+                         ['tma_fe', 'tma_lat', 'tma_bw', 'tma_icache'])
+        with self.assertRaises(ValueError):
+            perf_stat_metrics.select_metrics(_tma_metrics, ['x*'])
+
+    def test_tma_children(self):
+        self.assertEqual(perf_stat_metrics.tma_children(_tma_metrics), {
+            None: ['tma_fe'],
+            'tma_fe': ['tma_lat', 'tma_bw'],
+            'tma_lat': ['tma_icache'],
+        })
+
+    def test_calculate_pruned(self):
+        calculator = perf_stat_metrics.DrillDownCalculator(_tma_metrics, {'#P': 1})
+        counts = {'SLOTS': 100, 'FE': 30, 'LAT': 20, 'ICACHE': 10, 'INST': 2, 'CYCLES': 1}
+        self.assertEqual(calculator.calculate_pruned(counts), (
+            {'ipc': 2.0, 'tma_fe': 0.3, 'tma_lat': 0.2, 'tma_bw': 0.09999999999999998,
+             'tma_icache': 0.1}, []))
+        # Only the level 1 metric when it is below its threshold.
+        counts['FE'] = 10
+        self.assertEqual(calculator.calculate_pruned(counts),
+                         ({'ipc': 2.0, 'tma_fe': 0.1}, ['tma_lat', 'tma_bw']))
+        # Without counts for 'lat', its children are pruned.
+        counts['FE'] = 30
+        del counts['LAT']
+        self.assertEqual(calculator.calculate_pruned(counts),
+                         ({'ipc': 2.0, 'tma_fe': 0.3}, ['tma_icache']))
+        self.assertEqual(calculator.calculate(counts), {'ipc': 2.0, 'tma_fe': 0.3})
+        # The metrics and thresholds are computed by one evaluation of one dag.
+        evaluations = []
+        evaluate = calculator.dag.Evaluate
+        calculator.dag.Evaluate = lambda *args: evaluations.append(args) or evaluate(*args)
+        calculator.calculate_pruned(counts)
+        self.assertEqual(len(evaluations), 1)
+
+    def test_others(self):
+        calculator = perf_stat_metrics.DrillDownCalculator(_tma_metrics, {'#P': 1}, [])
+        self.assertEqual(calculator.calculate({'FE': 1, 'SLOTS': 100, 'INST': 1}),
+                         {'tma_fe': 0.01})
+        with self.assertRaisesRegex(ValueError, '#P'):
+            perf_stat_metrics.DrillDownCalculator(_tma_metrics, {})
+
+    def test_roots(self):
+        # Only the subtree of 'bw' is walked, so '#P' isn't needed.
+        calculator = perf_stat_metrics.DrillDownCalculator(_tma_metrics, {}, ['ipc', 'tma_bw'],
+                                                           ['ipc', 'tma_bw'])
+        self.assertEqual(calculator.children, {None: ['tma_bw']})
+        self.assertEqual(calculator.calculate({'SLOTS': 100, 'FE': 30, 'LAT': 20, 'INST': 2,
+                                               'CYCLES': 1}),
+                         {'ipc': 2.0, 'tma_bw': 0.09999999999999998})
+        # 'icache' is walked down to from 'lat'.
+        calculator = perf_stat_metrics.DrillDownCalculator(_tma_metrics, {'#P': 1}, [],
+                                                           ['tma_icache', 'tma_lat'])
+        self.assertEqual(calculator.children, {None: ['tma_lat'], 'tma_lat': ['tma_icache']})
+
+    def test_write_metrics(self):
+        calculator = perf_stat_metrics.DrillDownCalculator(_tma_metrics, {'#P': 1}, [])
+        output = io.StringIO()
+        perf_stat_metrics.write_metrics(calculator, [
+            '1.0,100,,TOPDOWN.SLOTS,1,100.00,,',
+            '1.0,10,,FE,1,100.00,,',
+            '1.0,100,,SLOTS,1,100.00,,',
+        ], output)
+        self.assertEqual(output.getvalue().splitlines(), [
+            'time,aggregate,metric,value',
+            '1.0,,tma_fe,0.1',
+            '1.0,,tma_lat,pruned',
+            '1.0,,tma_bw,pruned',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import event_groups
+import rotation_schedule
+
+
+def _pmu() -> event_groups.CorePmu:
+    """
+    A core PMU with 4 programmable counters and 3 fixed counters, with
+    W.0 and Z.0 restricted to counter 0 and U.1 and V.1 to counter 1.
+    """
+    json_events = [
+        {'EventName': 'INST_RETIRED.ANY', 'Counter': 'Fixed counter 0'},
+        {'EventName': 'CPU_CLK_UNHALTED.THREAD', 'Counter': 'Fixed counter 1'},
+        {'EventName': 'TOPDOWN.SLOTS', 'Counter': 'Fixed counter 3'},
+        {'EventName': 'W.0', 'Counter': '0'},
+        {'EventName': 'Z.0', 'Counter': '0'},
+        {'EventName': 'U.1', 'Counter': '1'},
+        {'EventName': 'V.1', 'Counter': '1'},
+    ] + [{'EventName': f'E.{i}', 'Counter': '0,1,2,3'} for i in range(8)]
+    return event_groups.CorePmu.from_json('cpu', json_events)
+
+
+class TestRotationSchedule(unittest.TestCase):
+
+    def test_schedule_runs(self):
+        schedule = rotation_schedule.schedule_runs(_pmu(), {
+            'a': ['E.0', 'E.1', 'CPU_CLK_UNHALTED.THREAD'],
+            'b': ['E.2', 'E.3'],
+            'c': ['E.4', 'E.5', 'E.6'],
+            'd': ['E.1', 'E.7', 'INST_RETIRED.ANY'],
+            'e': ['E.3'],
+            'retiring': ['topdown\\-retiring'],
+            'freq': ['duration_time'],
+            'big': ['E.0', 'E.1', 'E.2', 'E.3'],
+            'constrained': ['E.0'],
+        }, {'constrained': event_groups.NO_GROUP_EVENTS_NMI})
+        # With the NMI watchdog holding a counter, 3 remain.
+        self.assertEqual(schedule.multiplexed, ['big', 'constrained'])
+        self.assertEqual([schedule.run_metrics(i) for i in range(len(schedule.runs))], [
+            ['c', 'freq', 'retiring'],
+            ['a', 'd'],
+            ['b', 'e'],
+            ['big'],
+            ['constrained'],
+        ])
+        # The topdown event is grouped with the slots event.
+        self.assertEqual(schedule.runs[0].command_line(output='r1.json'),
+                         "perf stat -j -o r1.json -e '{E.4,E.5,E.6,topdown-retiring,"
+                         "TOPDOWN.SLOTS},duration_time'")
+        self.assertEqual(schedule.runs[3].command_line(), "perf stat -e 'E.0,E.1,E.2,E.3'")
+        self.assertEqual(schedule.merge_map(['r1', 'r2', 'r3', 'r4', 'r5'])['e'], 'r3')
+
+        # Placed in order, s fills the run of p leaving z a run of its
+        # own, as z and q need counter 1. Moving p aside to the run of z
+        # lets q join s, removing a run.
+        schedule = rotation_schedule.schedule_runs(_pmu(), {
+            'p': ['E.0', 'W.0'],
+            'q': ['Z.0', 'U.1'],
+            's': ['E.4'],
+            'z': ['V.1'],
+        })
+        self.assertEqual([schedule.run_metrics(i) for i in range(len(schedule.runs))],
+                         [['q', 's'], ['p', 'z']])
+
+        schedule = rotation_schedule.schedule_runs(_pmu(), {
+            'a': ['E.0', 'E.1'],
+            'b': ['E.2', 'E.3'],
+            'constrained': ['E.0'],
+        }, {'constrained': event_groups.NO_GROUP_EVENTS_NMI}, nmi_watchdog=False)
+        self.assertEqual(schedule.multiplexed, [])
+        self.assertEqual(schedule.run_metrics(0), ['a', 'b', 'constrained'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import specialize_metrics
+
+
+class TestSpecializeMetrics(unittest.TestCase):
+
+    def test_host_literals(self):
+        self.assertEqual(specialize_metrics.host_literals(), {})
+        self.assertEqual(specialize_metrics.host_literals(
+            smt=False, sockets=2, pmem=True, source_counts=[('UNC_CHA_CLOCKTICKS', 40)]),
+                         {'#SMT_on': 0.0, '#num_packages': 2.0, '#has_pmem': 1.0,
+                          'source_count(UNC_CHA_CLOCKTICKS)': 40.0})
+
+    def test_specialize_metrics(self):
+        json_metrics = [
+            {'MetricName': 'clks', 'MetricExpr': '(any / 2 if #SMT_on else cycles)'},
+            {'MetricName': 'pmm_bw', 'MetricExpr': '(64 * PMM / duration_time if #has_pmem > 0 else 0)',
+             'MetricThreshold': 'pmm_bw > 1 & #has_pmem'},
+            # Unchanged expressions keep their spelling.
+            {'MetricName': 'ipc', 'MetricExpr': 'INST/cycles'},
+        ]
+        literals = specialize_metrics.host_literals(smt=False, pmem=False)
+        self.assertEqual(specialize_metrics.specialize_metrics(json_metrics, literals), [
+            {'MetricName': 'clks', 'MetricExpr': 'cycles'},
+            {'MetricName': 'pmm_bw', 'MetricExpr': '0', 'MetricThreshold': '0'},
+            {'MetricName': 'ipc', 'MetricExpr': 'INST/cycles'},
+        ])
+        self.assertEqual(json_metrics[0]['MetricExpr'], '(any / 2 if #SMT_on else cycles)')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: BSD-3-Clause
+import os
+import sys
+import unittest
+
+unittest_dir = os.path.dirname(__file__)
+scripts_dir = os.path.join(unittest_dir, '..')
+sys.path.append(scripts_dir)
+
+import event_groups
+import tma_passes
+
+# A TMA tree with the level 1 metrics 'fe' and 'be'. 'fe' has the
+# children 'lat' and 'bw', 'lat' has the child 'icache' and 'bw' has the
+# child 'mite', whose threshold reads 'ipc' outside of the tree. 'mite'
+# has the child 'decoder'.
+_tma_metrics = [
+    {'MetricName': 'tma_fe', 'MetricExpr': 'FE / TOTAL', 'MetricGroup': 'tma_L1_group',
+     'MetricThreshold': 'tma_fe > 0.15'},
+    {'MetricName': 'tma_be', 'MetricExpr': 'BE / TOTAL', 'MetricGroup': 'tma_L1_group',
+     'MetricThreshold': 'tma_be > 0.2'},
+    {'MetricName': 'tma_lat', 'MetricExpr': 'LAT / TOTAL', 'MetricGroup': 'tma_fe_group',
+     'MetricThreshold': 'tma_lat > 0.1 & tma_fe > 0.15'},
+    {'MetricName': 'tma_bw', 'MetricExpr': 'tma_fe - tma_lat', 'MetricGroup': 'tma_fe_group',
+     'MetricThreshold': 'tma_bw > 0.1 & tma_fe > 0.15'},
+    {'MetricName': 'tma_icache', 'MetricExpr': 'ICACHE / CLKS if #SMT_on else ICACHE / TOTAL',
+     'MetricGroup': 'tma_lat_group',
+     'MetricThreshold': 'tma_icache > 0.05 & tma_lat > 0.1 & tma_fe > 0.15'},
+    {'MetricName': 'tma_mite', 'MetricExpr': 'MITE / TOTAL', 'MetricGroup': 'tma_bw_group',
+     'MetricThreshold': 'tma_mite > 0.05 & tma_info_ipc > 1 & tma_bw > 0.1 & tma_fe > 0.15'},
+    {'MetricName': 'tma_decoder', 'MetricExpr': 'DECODER / TOTAL',
+     'MetricGroup': 'tma_mite_group'},
+    {'MetricName': 'tma_info_ipc', 'MetricExpr': 'INST / CLKS', 'MetricGroup': 'Summary'},
+]
+
+
+def _planner() -> tma_passes.TmaPassPlanner:
+    json_events = [
+        {'EventName': 'INST', 'Counter': 'Fixed counter 0'},
+        {'EventName': 'CLKS', 'Counter': 'Fixed counter 1'},
+    ] + [{'EventName': name, 'Counter': '0,1,2,3'}
+         for name in ['FE', 'BE', 'LAT', 'ICACHE', 'MITE', 'DECODER', 'TOTAL']]
+    return tma_passes.TmaPassPlanner(_tma_metrics,
+                                     event_groups.CorePmu.from_json('cpu', json_events),
+                                     {'#SMT_on': 0})
+
+
+class TestTmaPasses(unittest.TestCase):
+
+    def test_read_counts(self):
+        self.assertEqual(tma_passes.read_counts([
+            '{"interval" : 1.0, "cpu" : "0", "counter-value" : "2", "event" : "FE"}',
+            '{"interval" : 1.0, "cpu" : "1", "counter-value" : "3", "event" : "FE"}',
+            '{"interval" : 2.0, "cpu" : "0", "counter-value" : "5", "event" : "FE"}',
+            '{"counter-value" : "<not counted>", "event" : "TOTAL"}',
+        ]), {'FE': 10.0})
+
+    def test_passes(self):
+        planner = _planner()
+        first = planner.next_pass([])
+        self.assertEqual(first.results, [])
+        self.assertEqual(first.metrics, ['tma_fe', 'tma_be'])
+        self.assertEqual(first.plan.groups, [['BE', 'FE', 'TOTAL']])
+        self.assertEqual(first.plan.command_line(output='tma-pass1.json'),
+                         "perf stat -j -o tma-pass1.json -e '{BE,FE,TOTAL}'")
+
+        pass1 = {'FE': 30.0, 'BE': 10.0, 'TOTAL': 100.0}
+        second = planner.next_pass([pass1])
+        self.assertEqual(second.results, [
+            tma_passes.PassResult('tma_fe', 0.3, True),
+            tma_passes.PassResult('tma_be', 0.1, False),
+        ])
+        self.assertEqual(second.metrics, ['tma_lat', 'tma_bw'])
+        self.assertEqual(second.plan.groups, [['FE', 'LAT', 'TOTAL']])
+
+        # Each pass's metrics use only its counts, so 'bw' is computed
+        # from the second pass's FE, while the thresholds of 'lat' and
+        # 'bw' use 'fe' from the first pass.
+        pass2 = {'FE': 30.0, 'LAT': 50.0, 'TOTAL': 100.0}
+        third = planner.next_pass([pass1, pass2])
+        self.assertEqual(third.results[2:], [
+            tma_passes.PassResult('tma_lat', 0.5, True),
+            tma_passes.PassResult('tma_bw', -0.2, False),
+        ])
+        # With SMT off, 'icache' doesn't need CLKS.
+        self.assertEqual(third.metrics, ['tma_icache'])
+        self.assertEqual(third.plan.groups, [['ICACHE', 'TOTAL']])
+
+        # The threshold of 'icache' uses 'lat' and 'fe' from the earlier
+        # passes rather than dividing their counts by this pass's TOTAL.
+        done = planner.next_pass([pass1, pass2, {'ICACHE': 500.0, 'TOTAL': 1000.0}])
+        self.assertEqual(done.results[-1], tma_passes.PassResult('tma_icache', 0.5, True))
+        self.assertEqual(done.metrics, [])
+        self.assertEqual(done.plan.groups, [])
+
+        done = planner.next_pass([pass1, pass2, {'ICACHE': 10.0, 'TOTAL': 1000.0}])
+        self.assertEqual(done.results[-1], tma_passes.PassResult('tma_icache', 0.01, False))
+        self.assertEqual(done.metrics, [])
+
+    def test_threshold_events(self):
+        planner = _planner()
+        pass1 = {'FE': 30.0, 'BE': 10.0, 'TOTAL': 100.0}
+        pass2 = {'FE': 30.0, 'LAT': 15.0, 'TOTAL': 100.0}
+        third = planner.next_pass([pass1, pass2])
+        self.assertEqual(third.metrics, ['tma_icache', 'tma_mite'])
+        # The threshold of 'mite' reads 'ipc', so INST and CLKS are
+        # counted with it, but not the events of its ancestors.
+        self.assertEqual(third.plan.groups, [['CLKS', 'ICACHE', 'INST', 'MITE', 'TOTAL']])
+
+        pass3 = {'ICACHE': 1.0, 'MITE': 10.0, 'INST': 200.0, 'CLKS': 100.0, 'TOTAL': 100.0}
+        fourth = planner.next_pass([pass1, pass2, pass3])
+        self.assertEqual(fourth.results[-1], tma_passes.PassResult('tma_mite', 0.1, True))
+        self.assertEqual(fourth.metrics, ['tma_decoder'])
+
+        # Without ipc the threshold of 'mite' can't pass.
+        del pass3['INST']
+        self.assertEqual(planner.next_pass([pass1, pass2, pass3]).metrics, [])
+
+
+if __name__ == '__main__':
+    unittest.main()